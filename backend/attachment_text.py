@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import os
+import re
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional
+
+from cfg import (
+    ATTACHMENT_MAX_BYTES,
+    ATTACHMENT_TEXT_MAX_CHARS,
+    ATTACHMENT_TIMEOUT_SECONDS,
+    ATTACHMENT_WORKERS,
+)
+from mail_fetch import ATTACHMENTS_DIR, ImapSessionPool, fetch_attachment
+from metrics import ATTACHMENT_RESULTS, observe_stage
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {".pdf": "pdf", ".docx": "docx", ".xlsx": "xlsx"}
+CONTENT_TYPES = {
+    "application/pdf": "pdf",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docx",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": "xlsx",
+}
+
+FACTORY_NUMBER_RE = re.compile(
+    r"(?:зав(?:одской)?\.?\s*(?:номер|№|n)|серийный\s+номер|s/?n)\s*[:№#.]?\s*([A-ZА-Я0-9][A-ZА-Я0-9\-/]{3,19})",
+    re.I,
+)
+# Коды ошибок приборов: E05, Е-12 (латинская или кириллическая Е)
+ERROR_CODE_RE = re.compile(r"\b[EЕ]-?\d{2,3}\b")
+
+
+def attachment_kind(file: Dict) -> str:
+    kind = CONTENT_TYPES.get(file.get("content_type", ""))
+    if kind:
+        return kind
+    return EXTENSIONS.get(os.path.splitext(file.get("filename", ""))[1].lower(), "")
+
+
+def _extract_pdf(path: str) -> str:
+    import fitz
+
+    parts, total = [], 0
+    with fitz.open(path) as doc:
+        for page in doc:
+            text = page.get_text()
+            parts.append(text)
+            total += len(text)
+            if total >= ATTACHMENT_TEXT_MAX_CHARS:
+                break
+    return "\n".join(parts)
+
+
+def _extract_docx(path: str) -> str:
+    with zipfile.ZipFile(path) as archive:
+        xml = archive.read("word/document.xml").decode("utf-8", errors="ignore")
+    xml = re.sub(r"</w:p>|<w:br[^>]*/>|<w:tab[^>]*/>", "\n", xml)
+    return re.sub(r"<[^>]+>", "", xml)
+
+
+def _extract_xlsx(path: str) -> str:
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    lines, total = [], 0
+    try:
+        for sheet in workbook.worksheets:
+            for row in sheet.iter_rows(values_only=True):
+                line = " ".join(str(value) for value in row if value is not None)
+                if line:
+                    lines.append(line)
+                    total += len(line)
+                if total >= ATTACHMENT_TEXT_MAX_CHARS:
+                    return "\n".join(lines)
+    finally:
+        workbook.close()
+    return "\n".join(lines)
+
+
+def extract_text(path: str, kind: str) -> str:
+    """Выполняется в дочернем процессе: разбор PDF/DOCX/XLSX не держит GIL воркера."""
+    extractor = {"pdf": _extract_pdf, "docx": _extract_docx, "xlsx": _extract_xlsx}[kind]
+    return extractor(path)[:ATTACHMENT_TEXT_MAX_CHARS]
+
+
+def find_facts(text: str) -> Dict[str, List[str]]:
+    error_codes = [
+        code.upper().replace("Е", "E").replace("-", "") for code in ERROR_CODE_RE.findall(text)
+    ]
+    return {
+        "factory_numbers": list(dict.fromkeys(FACTORY_NUMBER_RE.findall(text))),
+        "error_codes": list(dict.fromkeys(error_codes)),
+    }
+
+
+class AttachmentProcessor:
+    """
+    Достает из вложений заводские номера и коды ошибок для extract_data.
+    Разбор идет в ограниченном пуле процессов с таймаутом, текст кешируется
+    рядом с файлом по хешу содержимого (<sha256>.txt). Хеш и путь сохраняются
+    в метаданных вложения, поэтому повтор задачи не качает файл из IMAP заново.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = ATTACHMENT_WORKERS,
+        timeout: float = ATTACHMENT_TIMEOUT_SECONDS,
+        store_dir: str = ATTACHMENTS_DIR,
+    ):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.store_dir = store_dir
+        self.imap_pool = ImapSessionPool(size=1)
+        self._executor = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def _kill_executor(self, executor: ProcessPoolExecutor):
+        """
+        Завершает зависший разбор: shutdown не останавливает уже запущенную
+        задачу, поэтому процессы пула убиваются, а следующий вызов создаст новый пул.
+        """
+        if self._executor is executor:
+            self._executor = None
+        for process in list((executor._processes or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _extract(self, path: str, kind: str) -> str:
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            executor = self.executor
+            try:
+                return await asyncio.wait_for(
+                    loop.run_in_executor(executor, extract_text, path, kind),
+                    timeout=self.timeout,
+                )
+            except asyncio.TimeoutError:
+                self._kill_executor(executor)
+                raise
+            except BrokenProcessPool:
+                # Пул убит из-за чужого зависшего вложения - повторяем в новом
+                if self._executor is executor:
+                    self._executor = None
+                if attempt:
+                    raise
+
+    def _cache_path(self, sha256: str) -> str:
+        return os.path.join(self.store_dir, sha256[:2], sha256 + ".txt")
+
+    async def _text(self, file: Dict, kind: str) -> str:
+        # Текст уже извлекался прошлой попыткой: вложение не качаем
+        if file.get("sha256"):
+            cache_path = self._cache_path(file["sha256"])
+            if os.path.exists(cache_path):
+                ATTACHMENT_RESULTS.labels("cached").inc()
+                with open(cache_path, encoding="utf-8") as f:
+                    return f.read()
+
+        if file.get("path") and os.path.exists(file["path"]):
+            # Вложение уже сохранено (импорт архива почты или прошлая попытка)
+            info = file
+        else:
+            info = await asyncio.to_thread(
+                fetch_attachment,
+                file["uid"],
+                file["section"],
+                self.store_dir,
+                session_pool=self.imap_pool,
+            )
+            file["sha256"], file["path"] = info["sha256"], info["path"]
+        cache_path = os.path.splitext(info["path"])[0] + ".txt"
+        if os.path.exists(cache_path):
+            ATTACHMENT_RESULTS.labels("cached").inc()
+            with open(cache_path, encoding="utf-8") as f:
+                return f.read()
+
+        text = await self._extract(info["path"], kind)
+        with open(cache_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        ATTACHMENT_RESULTS.labels("extracted").inc()
+        return text
+
+    async def _describe_file(self, file) -> Optional[str]:
+        # Старые задачи хранят пути к файлам, а не метаданные
+        if not isinstance(file, dict) or ("section" not in file and "path" not in file):
+            return None
+        kind = attachment_kind(file)
+        if not kind or (file.get("size") or 0) > ATTACHMENT_MAX_BYTES:
+            ATTACHMENT_RESULTS.labels("skipped").inc()
+            return None
+
+        try:
+            with observe_stage("attachment_text"):
+                text = await self._text(file, kind)
+        except asyncio.TimeoutError:
+            ATTACHMENT_RESULTS.labels("timeout").inc()
+            logger.warning(f"Разбор вложения {file.get('filename')} не уложился в {self.timeout} с")
+            return None
+        except Exception as e:
+            ATTACHMENT_RESULTS.labels("error").inc()
+            logger.warning(f"Не удалось разобрать вложение {file.get('filename')}: {e}")
+            return None
+
+        facts = find_facts(text)
+        found = []
+        if facts["factory_numbers"]:
+            found.append("заводские номера: " + ", ".join(facts["factory_numbers"]))
+        if facts["error_codes"]:
+            found.append("коды ошибок: " + ", ".join(facts["error_codes"]))
+        if not found:
+            return None
+        return f"- {file.get('filename') or kind}: " + "; ".join(found)
+
+    async def describe(self, files: List) -> str:
+        """
+        Строки для контекста письма; ошибки вложений не останавливают обработку.
+        Вложения разбираются параллельно, в files дописываются sha256 и path.
+        """
+        lines = await asyncio.gather(*(self._describe_file(file) for file in files or []))
+        lines = [line for line in lines if line]
+        if not lines:
+            return ""
+        return "\n\nДанные из вложений:\n" + "\n".join(lines)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self.imap_pool.close()
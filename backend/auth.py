@@ -0,0 +1,161 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import bcrypt
+
+logger = logging.getLogger(__name__)
+
+AUTH_SECRET = os.getenv("AUTH_SECRET", "")
+# Случайный секрет процесса - только для локального запуска в один процесс:
+# токены не подходят другим воркерам и репликам API и пропадают при перезапуске
+AUTH_EPHEMERAL_SECRET = os.getenv("AUTH_EPHEMERAL_SECRET", "0") == "1"
+if not AUTH_SECRET:
+    if not AUTH_EPHEMERAL_SECRET:
+        raise RuntimeError(
+            "AUTH_SECRET не задан: задайте общий секрет для всех процессов API "
+            "(или AUTH_EPHEMERAL_SECRET=1 для локального запуска в один процесс)"
+        )
+    AUTH_SECRET = secrets.token_hex(32)
+    logger.warning("AUTH_SECRET не задан, токены будут недействительны после перезапуска")
+# Токен проверяется по подписи; отключенный пользователь теряет доступ
+# не позже чем через AUTH_CACHE_TTL_SECONDS (ActiveUserCache)
+AUTH_TOKEN_TTL_SECONDS = int(os.getenv("AUTH_TOKEN_TTL_SECONDS", "3600"))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "256"))
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "300"))
+# bcrypt отпускает GIL, отдельный пул ограничивает, сколько ядер уходит на хеши
+AUTH_BCRYPT_WORKERS = int(os.getenv("AUTH_BCRYPT_WORKERS", "2"))
+
+_secret = AUTH_SECRET.encode("utf8")
+_bcrypt_executor = ThreadPoolExecutor(
+    max_workers=AUTH_BCRYPT_WORKERS, thread_name_prefix="bcrypt"
+)
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(data: bytes) -> bytes:
+    return hmac.new(_secret, data, hashlib.sha256).digest()
+
+
+def issue_token(login: str, ttl: int = AUTH_TOKEN_TTL_SECONDS) -> str:
+    """Подписанный токен сессии: base64(payload).base64(hmac)"""
+    payload = json.dumps({"sub": login, "exp": int(time.time()) + ttl}).encode("utf8")
+    body = _b64encode(payload)
+    return f"{body}.{_b64encode(_sign(body.encode('ascii')))}"
+
+
+def verify_token(token: str) -> Optional[str]:
+    """Логин из токена или None. Проверка без БД и bcrypt."""
+    try:
+        body, signature = token.split(".", 1)
+        if not hmac.compare_digest(_b64decode(signature), _sign(body.encode("ascii"))):
+            return None
+        payload = json.loads(_b64decode(body))
+    except (ValueError, UnicodeError):
+        return None
+    if payload.get("exp", 0) < time.time():
+        return None
+    return payload.get("sub")
+
+
+class CredentialCache:
+    """
+    Недавно проверенные пары логин/пароль для HTTP Basic. Пароль хранится
+    только как HMAC, записи живут AUTH_CACHE_TTL_SECONDS.
+    """
+
+    def __init__(self, size: int = AUTH_CACHE_SIZE, ttl: float = AUTH_CACHE_TTL_SECONDS):
+        self.size = size
+        self.ttl = ttl
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(login: str, password: str) -> bytes:
+        return _sign(f"{login}\0{password}".encode("utf8"))
+
+    def check(self, login: str, password: str) -> bool:
+        with self._lock:
+            item = self._items.get(login)
+            if item is None:
+                return False
+            digest, expires_at = item
+            if expires_at < time.monotonic():
+                del self._items[login]
+                return False
+            self._items.move_to_end(login)
+        return hmac.compare_digest(digest, self._digest(login, password))
+
+    def add(self, login: str, password: str):
+        with self._lock:
+            self._items[login] = (self._digest(login, password), time.monotonic() + self.ttl)
+            self._items.move_to_end(login)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def discard(self, login: str):
+        with self._lock:
+            self._items.pop(login, None)
+
+
+class ActiveUserCache:
+    """
+    Логины, активность которых (users.is_active) недавно подтверждена в БД.
+    Дешевая проверка отзыва для токенов: запрос в БД раз в ttl на пользователя.
+    """
+
+    def __init__(self, size: int = AUTH_CACHE_SIZE, ttl: float = AUTH_CACHE_TTL_SECONDS):
+        self.size = size
+        self.ttl = ttl
+        self._items: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, login: str) -> bool:
+        with self._lock:
+            expires_at = self._items.get(login)
+            if expires_at is None:
+                return False
+            if expires_at < time.monotonic():
+                del self._items[login]
+                return False
+            self._items.move_to_end(login)
+            return True
+
+    def add(self, login: str):
+        with self._lock:
+            self._items[login] = time.monotonic() + self.ttl
+            self._items.move_to_end(login)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def discard(self, login: str):
+        with self._lock:
+            self._items.pop(login, None)
+
+
+async def check_password(password: str, password_hash: str) -> bool:
+    """bcrypt.checkpw в отдельном пуле потоков, чтобы не блокировать event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _bcrypt_executor,
+        bcrypt.checkpw,
+        password.encode("utf8"),
+        password_hash.encode("utf8"),
+    )
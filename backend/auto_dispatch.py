@@ -0,0 +1,54 @@
+import logging
+from typing import Optional
+
+from cfg import AUTO_DISPATCH_MIN_CONFIDENCE
+from mail_outbox import enqueue_mail
+from metrics import AUTO_DISPATCH
+from model_requester import HISTORY_ANSWER_PREFIX
+
+logger = logging.getLogger(__name__)
+
+# Жалобы всегда разбирает оператор, даже при уверенном ответе
+MANUAL_EMOTIONS = {"негативное"}
+
+
+class AutoDispatcher:
+    """
+    Автоотправка ответов, в которых модель уверена: совпадение из истории
+    писем или близкий фрагмент инструкции. Ответ ставится в общую очередь
+    outgoing_mail; отправляют его отправители API, как и ответы операторов
+    (повторы, лимит частоты, send_status), и они же закрывают обращения
+    пачками по message_id (OutboxSender.flush).
+    """
+
+    def __init__(self, db_pool, min_confidence: float = AUTO_DISPATCH_MIN_CONFIDENCE):
+        self.db_pool = db_pool
+        self.min_confidence = min_confidence
+
+    def qualifies(self, confidence: Optional[float], source: Optional[str], emotion: str) -> bool:
+        if source not in ("history", "rag") or confidence is None:
+            return False
+        if emotion in MANUAL_EMOTIONS:
+            return False
+        return confidence >= self.min_confidence
+
+    async def dispatch(self, message_id: str, to_email: str, subject: str, answer: str) -> bool:
+        if answer.startswith(HISTORY_ANSWER_PREFIX):
+            answer = answer[len(HISTORY_ANSWER_PREFIX) :]
+        payload = {
+            "to_emails": [to_email],
+            "subject": f"Re: {subject}" if subject else "Ответ на обращение",
+            "body": answer,
+            "message_id": message_id,
+            "reply_to_thread": True,
+        }
+        try:
+            async with self.db_pool.acquire() as conn, conn.transaction():
+                await enqueue_mail(conn, payload)
+        except Exception as e:
+            AUTO_DISPATCH.labels("failed").inc()
+            logger.warning(f"Автоответ на {message_id} не поставлен в очередь: {e}")
+            return False
+
+        AUTO_DISPATCH.labels("queued").inc()
+        return True
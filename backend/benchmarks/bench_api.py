@@ -0,0 +1,157 @@
+"""
+Задержки /api/requests, /api/getCsv и /api/getExcel при разном размере таблицы.
+Таблица requests только дополняется до нужного числа строк, поэтому запускать
+на отдельной базе.
+
+    python -m benchmarks.bench_api --sizes 10000 100000 1000000 --output bench/api.json
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+import httpx
+
+from benchmarks.common import latency_summary, write_results
+from benchmarks.letters import generate_letters
+
+COLUMNS = [
+    "req_date",
+    "full_name",
+    "object_name",
+    "phone",
+    "email",
+    "factory_number",
+    "device_type",
+    "emotion",
+    "question_summary",
+    "llm_answer",
+    "message_id",
+]
+
+LLM_ANSWER = (
+    "Проверьте подключение датчика к плате прибора и осмотрите кабель на предмет повреждений. "
+) * 8
+
+
+async def fill_table(conn, size: int, seed: int, batch_size: int = 50000):
+    """Дополняет requests синтетическими строками до size."""
+    current = await conn.fetchval("SELECT count(*) FROM requests")
+    missing = size - current
+    if missing <= 0:
+        return
+
+    print(f"Добавляем {missing} строк (сейчас {current})...")
+    batch = []
+    letters = generate_letters(missing, seed=seed, with_raw=False, id_prefix=f"api{current}_")
+    for letter in letters:
+        batch.append(
+            (
+                letter["sent_at"],
+                letter["full_name"],
+                "ООО «Бенчмарк»",
+                "+7 (495) 000-00-00",
+                letter["sender_email"],
+                letter["factory_number"],
+                letter["device_type"],
+                letter["emotion"],
+                letter["issue"],
+                LLM_ANSWER,
+                letter["message_id"],
+            )
+        )
+        if len(batch) >= batch_size:
+            await conn.copy_records_to_table("requests", records=batch, columns=COLUMNS)
+            batch = []
+    if batch:
+        await conn.copy_records_to_table("requests", records=batch, columns=COLUMNS)
+    await conn.execute("ANALYZE requests")
+
+
+async def measure(client: httpx.AsyncClient, url: str, requests: int, concurrency: int) -> dict:
+    samples = []
+    errors = 0
+    queue = asyncio.Queue()
+    for _ in range(requests):
+        queue.put_nowait(url() if callable(url) else url)
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            target = queue.get_nowait()
+            started = time.perf_counter()
+            try:
+                # Тело читается целиком: у выгрузок это основная часть времени
+                response = await client.get(target)
+                response.raise_for_status()
+                samples.append(time.perf_counter() - started)
+            except Exception:
+                errors += 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    summary = latency_summary(samples)
+    summary["errors"] = errors
+    return summary
+
+
+async def run(args) -> list:
+    import job_queue
+
+    pool = await job_queue.create_pool(max_size=2)
+    rnd = random.Random(args.seed)
+    results = []
+    try:
+        async with httpx.AsyncClient(base_url=args.api, timeout=None) as client:
+            for size in args.sizes:
+                async with pool.acquire() as conn:
+                    await fill_table(conn, size, args.seed)
+
+                pages = max(size // args.page_limit, 1)
+                scenarios = {
+                    "requests_page": (
+                        lambda: f"/api/requests?page={rnd.randint(1, pages)}&limit={args.page_limit}",
+                        args.requests,
+                        args.concurrency,
+                    ),
+                    "requests_filtered": (
+                        "/api/requests?page=1&limit=100&emotion=негативное",
+                        args.requests,
+                        args.concurrency,
+                    ),
+                    "csv_export": ("/api/getCsv", args.export_requests, 1),
+                    "excel_export": ("/api/getExcel", args.export_requests, 1),
+                }
+                for name, (url, count, concurrency) in scenarios.items():
+                    if name == "excel_export" and size > args.excel_max_rows:
+                        continue
+                    summary = await measure(client, url, count, concurrency)
+                    summary.update({"rows": size, "scenario": name})
+                    print(summary)
+                    results.append(summary)
+    finally:
+        await pool.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк API")
+    parser.add_argument("--api", default="http://localhost:8000")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--page-limit", type=int, default=100)
+    parser.add_argument("--export-requests", type=int, default=3)
+    parser.add_argument(
+        "--excel-max-rows", type=int, default=1000000, help="Excel ограничен ~1M строк на лист"
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="bench_results/api.json")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    write_results(args.output, "api", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
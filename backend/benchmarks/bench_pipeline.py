@@ -0,0 +1,111 @@
+"""
+Сквозная пропускная способность: IMAP-заглушка -> scheduler (очередь, LLM-заглушка,
+RAG) -> POST /api/requests. Нужны Postgres и запущенный API (main.py).
+
+    python -m benchmarks.bench_pipeline --letters 200 --llm-latency 0.5 --output bench/pipeline.json
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+from benchmarks.common import start_process, write_results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк обработки писем")
+    parser.add_argument("--letters", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--llm-endpoints", type=int, default=1, help="число серверов-заглушек LLM")
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--llm-tokens-per-second", type=float, default=40.0)
+    parser.add_argument("--concurrency", type=int, default=0, help="слоты воркера, 0 - по числу серверов")
+    parser.add_argument("--imap-port", type=int, default=1143)
+    parser.add_argument("--llm-port", type=int, default=11234)
+    parser.add_argument("--api", default="http://localhost:8000")
+    parser.add_argument("--output", default="bench_results/pipeline.json")
+    args = parser.parse_args()
+
+    run_id = f"run{int(time.time())}_"
+    llm_ports = [args.llm_port + i for i in range(args.llm_endpoints)]
+
+    # Конфигурация читается модулями при импорте, поэтому задается до него
+    os.environ.update(
+        {
+            "IMAP_SERVER": "127.0.0.1",
+            "IMAP_PORT": str(args.imap_port),
+            "IMAP_USE_SSL": "0",
+            "LLM_BASE_URLS": ",".join(f"http://127.0.0.1:{p}/v1" for p in llm_ports),
+            "API_BASE_URL": args.api,
+            "TRACE_EXPORTER": "none",
+        }
+    )
+    if args.concurrency:
+        os.environ["WORKER_CONCURRENCY"] = str(args.concurrency)
+
+    procs = [
+        start_process(
+            "benchmarks.imap_server",
+            "--port", str(args.imap_port),
+            "--letters", str(args.letters),
+            "--seed", str(args.seed),
+            "--id-prefix", run_id,
+        )
+    ]
+    for port in llm_ports:
+        procs.append(
+            start_process(
+                "benchmarks.mock_llm_server",
+                "--port", str(port),
+                "--latency", str(args.llm_latency),
+                "--tokens-per-second", str(args.llm_tokens_per_second),
+            )
+        )
+
+    try:
+        import job_queue
+        import scheduler
+        from mail_fetch import fetch_emails
+
+        async def run() -> dict:
+            pool = await job_queue.create_pool(max_size=scheduler.WORKER_CONCURRENCY * 2 + 2)
+            try:
+                # Индексы и модель эмбеддингов грузятся до замера
+                scheduler.get_llm().rag_db
+                scheduler.get_llm().history_db
+
+                started = time.perf_counter()
+                msgs = fetch_emails(limit=args.letters)
+                fetched = time.perf_counter()
+                async with pool.acquire() as conn:
+                    await scheduler.enqueue_letters(conn, msgs)
+                await scheduler.drain_queue(pool)
+                finished = time.perf_counter()
+
+                total = finished - started
+                return {
+                    "letters": len(msgs),
+                    "fetch_seconds": fetched - started,
+                    "process_seconds": finished - fetched,
+                    "total_seconds": total,
+                    "letters_per_minute": len(msgs) / total * 60 if total else 0.0,
+                    "concurrency": scheduler.WORKER_CONCURRENCY,
+                    "llm_endpoints": scheduler.get_llm().endpoints.stats(),
+                }
+            finally:
+                await pool.close()
+
+        result = asyncio.run(run())
+        print(
+            f"Обработано {result['letters']} писем за {result['total_seconds']:.1f} с "
+            f"({result['letters_per_minute']:.1f} писем/мин)"
+        )
+        write_results(args.output, "pipeline", vars(args), [result])
+    finally:
+        for proc in procs:
+            proc.terminate()
+
+
+if __name__ == "__main__":
+    main()
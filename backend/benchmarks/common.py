@@ -0,0 +1,52 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List
+
+
+def latency_summary(samples: List[float]) -> Dict[str, float]:
+    """p50/p95/p99 и среднее в миллисекундах."""
+    if not samples:
+        return {"count": 0}
+    ms = sorted(s * 1000 for s in samples)
+    if len(ms) == 1:
+        p50 = p95 = p99 = ms[0]
+    else:
+        q = statistics.quantiles(ms, n=100, method="inclusive")
+        p50, p95, p99 = q[49], q[94], q[98]
+    return {
+        "count": len(ms),
+        "mean_ms": statistics.fmean(ms),
+        "p50_ms": p50,
+        "p95_ms": p95,
+        "p99_ms": p99,
+        "max_ms": ms[-1],
+    }
+
+
+def write_results(path: str, benchmark: str, params: dict, results: list):
+    """Результаты в JSON, чтобы сравнивать прогоны между собой."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    data = {
+        "benchmark": benchmark,
+        "finished_at": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "machine": platform.machine(),
+        "params": params,
+        "results": results,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {path}")
+
+
+def start_process(*args: str) -> subprocess.Popen:
+    """Запускает вспомогательный сервер (mock LLM, IMAP) и дает ему подняться."""
+    proc = subprocess.Popen([sys.executable, "-m", *args])
+    time.sleep(2)
+    return proc
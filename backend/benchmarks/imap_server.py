@@ -0,0 +1,173 @@
+"""
+Минимальный IMAP-сервер без TLS, отдающий синтетические письма. Поддерживает
+ровно то, что использует mail_fetch: LOGIN, SELECT, SEARCH, CLOSE, LOGOUT и FETCH
+с RFC822, BODYSTRUCTURE, BODY.PEEK[HEADER] и BODY.PEEK[n]<offset.size>.
+
+    python -m benchmarks.imap_server --port 1143 --letters 1000
+    IMAP_SERVER=127.0.0.1 IMAP_PORT=1143 IMAP_USE_SSL=0 python scheduler.py
+"""
+
+import argparse
+import asyncio
+import email
+import logging
+import re
+from typing import List
+
+from benchmarks.letters import generate_letters
+
+logger = logging.getLogger("imap_mock")
+
+FETCH_ITEM_RE = re.compile(r"(BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?|[A-Z0-9.]+)", re.I)
+
+
+def quote(value) -> str:
+    if value is None:
+        return "NIL"
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def bodystructure(part) -> str:
+    if part.is_multipart():
+        children = "".join(bodystructure(sub) for sub in part.get_payload())
+        return f"({children} {quote(part.get_content_subtype().upper())})"
+
+    maintype, subtype = part.get_content_maintype(), part.get_content_subtype()
+    params = [(k, v) for k, v in part.get_params()[1:]] if part.get_params() else []
+    params_str = "(" + " ".join(f"{quote(k)} {quote(v)}" for k, v in params) + ")" if params else "NIL"
+    encoding = part.get("Content-Transfer-Encoding", "7bit").upper()
+    body = part.get_payload().encode("utf-8", errors="ignore")
+    fields = f"{quote(maintype.upper())} {quote(subtype.upper())} {params_str} NIL NIL {quote(encoding)} {len(body)}"
+    if maintype == "text":
+        fields += f" {len(body.splitlines())}"
+
+    disposition = "NIL"
+    if part.get_content_disposition():
+        filename = part.get_param("filename", header="Content-Disposition")
+        disp_params = f"({quote('FILENAME')} {quote(filename)})" if filename else "NIL"
+        disposition = f"({quote(part.get_content_disposition().upper())} {disp_params})"
+    return f"({fields} NIL {disposition} NIL NIL)"
+
+
+def section_bytes(raw: bytes, section: str) -> bytes:
+    if section == "":
+        return raw
+    if section.upper() == "HEADER":
+        return raw.partition(b"\n\n")[0] + b"\n\n"
+
+    part = email.message_from_bytes(raw)
+    if not part.is_multipart():
+        # Единственная часть простого письма - его тело
+        return raw.partition(b"\n\n")[2] if section == "1" else b""
+    for idx in section.split("."):
+        part = part.get_payload()[int(idx) - 1]
+    return part.get_payload().encode("utf-8", errors="ignore")
+
+
+class MockMailbox:
+    def __init__(self, messages: List[bytes]):
+        self.messages = messages
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.write(b"* OK IMAP4rev1 mock ready\r\n")
+        await writer.drain()
+
+        while not reader.at_eof():
+            line = await reader.readline()
+            if not line:
+                break
+            parts = line.decode("utf-8", errors="ignore").strip().split(" ", 2)
+            if len(parts) < 2:
+                continue
+            tag, command = parts[0], parts[1].upper()
+            args = parts[2] if len(parts) > 2 else ""
+            if command == "UID":
+                # UID и порядковый номер совпадают: письма не удаляются
+                command, _, args = args.partition(" ")
+                command = command.upper()
+
+            if command == "CAPABILITY":
+                writer.write(b"* CAPABILITY IMAP4rev1\r\n")
+            elif command == "SELECT":
+                writer.write(f"* {len(self.messages)} EXISTS\r\n".encode())
+                writer.write(b"* FLAGS (\\Seen)\r\n")
+                writer.write(f"{tag} OK [READ-WRITE] SELECT completed\r\n".encode())
+                await writer.drain()
+                continue
+            elif command == "SEARCH":
+                writer.write(f"* SEARCH {self.search(args)}\r\n".encode())
+            elif command == "FETCH":
+                self.write_fetch(writer, args)
+            elif command == "LOGOUT":
+                writer.write(b"* BYE\r\n")
+                writer.write(f"{tag} OK LOGOUT completed\r\n".encode())
+                await writer.drain()
+                break
+
+            # LOGIN, CLOSE, NOOP и прочее просто подтверждаем
+            writer.write(f"{tag} OK {command} completed\r\n".encode())
+            await writer.drain()
+
+        writer.close()
+
+    def search(self, criteria: str) -> str:
+        first = 1
+        if criteria.upper().startswith("UID "):
+            first = int(criteria.split()[1].split(":")[0])
+        ids = range(min(first, len(self.messages)), len(self.messages) + 1)
+        return " ".join(str(i) for i in ids)
+
+    def write_fetch(self, writer: asyncio.StreamWriter, args: str):
+        msg_id, _, items = args.partition(" ")
+        raw = self.messages[int(msg_id) - 1]
+        writer.write(f"* {msg_id} FETCH (UID {msg_id}".encode())
+
+        for match in FETCH_ITEM_RE.finditer(items.strip("()")):
+            item = match.group(1).upper()
+            if item in ("UID", "FLAGS"):
+                continue
+            if item == "BODYSTRUCTURE":
+                writer.write(f" BODYSTRUCTURE {bodystructure(email.message_from_bytes(raw))}".encode())
+                continue
+
+            if item == "RFC822":
+                name, data = "RFC822", raw
+            else:
+                section = match.group(2) or ""
+                data = section_bytes(raw, section)
+                name = f"BODY[{section}]"
+                if match.group(3) is not None:
+                    offset, size = int(match.group(3)), int(match.group(4))
+                    data = data[offset : offset + size]
+                    name += f"<{offset}>"
+            writer.write(f" {name} {{{len(data)}}}\r\n".encode())
+            writer.write(data)
+        writer.write(b")\r\n")
+
+
+async def serve(host: str, port: int, letters: int, seed: int, id_prefix: str):
+    messages = [
+        letter["raw"]
+        for letter in generate_letters(letters, seed=seed, id_prefix=id_prefix)
+    ]
+    mailbox = MockMailbox(messages)
+    server = await asyncio.start_server(mailbox.handle, host, port)
+    logger.info(f"IMAP-заглушка на {host}:{port}, писем: {len(messages)}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Локальный IMAP-сервер с синтетическими письмами")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1143)
+    parser.add_argument("--letters", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--id-prefix", default="bench")
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.letters, args.seed, args.id_prefix))
+
+
+if __name__ == "__main__":
+    main()
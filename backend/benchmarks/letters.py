@@ -0,0 +1,101 @@
+"""Генератор синтетических писем в техподдержку в духе seed_history.SEED_DATA."""
+
+import random
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+from email.header import Header
+from email.utils import format_datetime
+from typing import Dict, Iterator
+
+DEVICES = ["ЭРИС-130", "ЭРИС-230", "Вектор-М", "ДГС ЭРИС-210", "термостат ТР-01"]
+
+OBJECTS = [
+    "ООО «ГазПромИнвест»",
+    "ЗАО «ПромАвтоматика»",
+    "ООО «ПромНефть»",
+    "АО «СеверЭнерго»",
+    "ООО «ХимТехСервис»",
+]
+
+LAST_NAMES = ["Смирнова", "Фомин", "Соколова", "Иванов", "Кузнецов", "Попова"]
+FIRST_NAMES = ["Елена", "Дмитрий", "Мария", "Сергей", "Андрей", "Ольга"]
+PATRONYMICS = ["Александровна", "Олегович", "Петровна", "Иванович", "Сергеевна"]
+
+# (шаблон вопроса, эмоциональный окрас)
+ISSUE_TEMPLATES = [
+    ("Здравствуйте, я не понимаю, как работает {device}. Подскажите, пожалуйста.", "нейтральное"),
+    ("Как сбросить настройки до заводских на устройстве {device}?", "нейтральное"),
+    ("Ошибка Е{code:02d} на дисплее {device}, расшифруйте пожалуйста.", "нейтральное"),
+    (
+        "Ваш {device} (зав. № {factory}) опять не работает, это уже третий раз за месяц! "
+        "Требую срочно прислать специалиста.",
+        "негативное",
+    ),
+    (
+        "Прошу прислать схему подключения {device} к контроллеру по Modbus RTU, "
+        "включая настройки baud rate и адреса регистров.",
+        "нейтральное",
+    ),
+    ("Спасибо за быструю помощь с {device}, всё заработало!", "положительное"),
+]
+
+PADDING = (
+    "Условия эксплуатации: помещение с переменной температурой и повышенной влажностью. "
+    "Прибор установлен около года назад, обслуживание проводилось по регламенту. "
+)
+
+
+def generate_letters(
+    count: int, seed: int = 42, with_raw: bool = True, id_prefix: str = "bench"
+) -> Iterator[Dict]:
+    """
+    Письма в формате fetch_emails плюс сырое RFC822-сообщение в поле raw.
+    Текст зависит только от seed, id_prefix позволяет повторить прогон
+    с теми же письмами, но новыми Message-ID (очередь отсеивает дубликаты).
+    """
+    rnd = random.Random(seed)
+    start = datetime(2026, 1, 1, 9, 0)
+
+    for idx in range(count):
+        device = rnd.choice(DEVICES)
+        factory = f"{rnd.randint(100000000, 999999999)}"
+        template, tone = rnd.choice(ISSUE_TEMPLATES)
+        issue = template.format(device=device, factory=factory, code=rnd.randint(1, 20))
+        full_name = f"{rnd.choice(LAST_NAMES)} {rnd.choice(FIRST_NAMES)} {rnd.choice(PATRONYMICS)}"
+        sender = f"client{idx}@example.ru"
+        sent_at = start + timedelta(minutes=idx * 7)
+
+        text = (
+            f"ФИО: {full_name}\n"
+            f"Объект: {rnd.choice(OBJECTS)}\n"
+            f"Телефон: +7 (495) {rnd.randint(100, 999)}-{rnd.randint(10, 99)}-{rnd.randint(10, 99)}\n"
+            f"Заводской номер: {factory}\n"
+            f"{issue}\n" + PADDING * rnd.randint(0, 3)
+        )
+
+        message_id = f"<{id_prefix}{idx}.{seed}@example.ru>"
+        raw = b""
+        if with_raw:
+            mime = MIMEText(text, "plain", "utf-8")
+            mime["Subject"] = Header(f"Обращение по {device}", "utf-8")
+            mime["From"] = sender
+            mime["To"] = "support@example.ru"
+            mime["Date"] = format_datetime(sent_at)
+            mime["Message-ID"] = message_id
+            raw = mime.as_bytes()
+
+        yield {
+            "subject": f"Обращение по {device}",
+            "text": text,
+            "message_id": message_id,
+            "files": [],
+            "sender_email": sender,
+            "date": format_datetime(sent_at),
+            "emotion": tone,
+            "device_type": device,
+            "factory_number": factory,
+            "full_name": full_name,
+            "issue": issue,
+            "sent_at": sent_at,
+            "raw": raw,
+        }
@@ -0,0 +1,129 @@
+"""
+OpenAI-совместимый сервер-заглушка с настраиваемой задержкой и скоростью генерации.
+
+    python -m benchmarks.mock_llm_server --port 1234 --latency 0.5 --tokens-per-second 40
+"""
+
+import argparse
+import asyncio
+import json
+import re
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+app = FastAPI()
+app.state.latency = 0.5
+app.state.tokens_per_second = 40.0
+app.state.completion_tokens = 64
+
+ANSWER_WORDS = (
+    "Проверьте подключение датчика к плате прибора и осмотрите кабель на предмет "
+    "повреждений. Если ошибка сохраняется, выполните сброс настроек согласно "
+    "инструкции и обратитесь в сервисный центр."
+).split()
+
+
+def fake_extraction(letter: str) -> str:
+    factory = re.search(r"\b\d{9}\b", letter)
+    name = re.search(r"ФИО: (.+)", letter)
+    tone = "негативное" if re.search(r"не работает|требую", letter, re.I) else "нейтральное"
+    return json.dumps(
+        {
+            "date": "",
+            "full_name": name.group(1).strip() if name else "",
+            "object": "",
+            "phone": "",
+            "email": "",
+            "factory_number": factory.group(0) if factory else "",
+            "device_type": "",
+            "emotional_tone": tone,
+            "issue_summary": letter[-200:],
+        },
+        ensure_ascii=False,
+    )
+
+
+def build_answer(messages: list) -> str:
+    user_prompt = messages[-1]["content"] if messages else ""
+    if "Извлеки данные из письма" in user_prompt:
+        return fake_extraction(user_prompt)
+    words = ANSWER_WORDS * (app.state.completion_tokens // len(ANSWER_WORDS) + 1)
+    return " ".join(words[: app.state.completion_tokens])
+
+
+def usage(messages: list, completion: str) -> dict:
+    # Грубая оценка: одно слово - один токен
+    prompt_tokens = sum(len(m.get("content", "").split()) for m in messages)
+    completion_tokens = len(completion.split())
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+@app.get("/v1/models")
+async def models():
+    return {"object": "list", "data": [{"id": "mock", "object": "model"}]}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    messages = body.get("messages", [])
+    answer = build_answer(messages)
+    tokens = answer.split(" ")
+
+    await asyncio.sleep(app.state.latency)
+
+    if body.get("stream"):
+
+        async def generate():
+            for i, token in enumerate(tokens):
+                await asyncio.sleep(1 / app.state.tokens_per_second)
+                chunk = {
+                    "choices": [
+                        {"delta": {"content": token if i == 0 else f" {token}"}}
+                    ]
+                }
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(generate(), media_type="text/event-stream")
+
+    await asyncio.sleep(len(tokens) / app.state.tokens_per_second)
+    return {
+        "id": f"mock-{time.time_ns()}",
+        "object": "chat.completion",
+        "model": body.get("model", "mock"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": answer},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": usage(messages, answer),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI-совместимый сервер")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument("--latency", type=float, default=0.5, help="задержка до первого токена, с")
+    parser.add_argument("--tokens-per-second", type=float, default=40.0)
+    parser.add_argument("--completion-tokens", type=int, default=64)
+    args = parser.parse_args()
+
+    app.state.latency = args.latency
+    app.state.tokens_per_second = args.tokens_per_second
+    app.state.completion_tokens = args.completion_tokens
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,8 +7,65 @@ EMBEDDING_MODEL = "DeepPavlov/rubert-base-cased-sentence"
 LLM_BASE_URL = "http://localhost:1234/v1"
 LLM_MODEL = "qwen"
 LLM_API_KEY = "lm-studio"
+# Несколько OpenAI-совместимых серверов через запятую
+LLM_BASE_URLS = [
+    url.strip()
+    for url in os.getenv("LLM_BASE_URLS", LLM_BASE_URL).split(",")
+    if url.strip()
+]
+LLM_MAX_CONCURRENCY_PER_ENDPOINT = int(os.getenv("LLM_MAX_CONCURRENCY_PER_ENDPOINT", "1"))
+LLM_CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", "3"))
+LLM_CIRCUIT_COOLDOWN_SECONDS = float(os.getenv("LLM_CIRCUIT_COOLDOWN_SECONDS", "30"))
+LLM_HEALTHCHECK_SECONDS = float(os.getenv("LLM_HEALTHCHECK_SECONDS", "15"))
 PERSIST_DIRECTORY = os.getenv("PERSIST_DIRECTORY", "./chroma_db_rag")
 PERSIST_DIRECTORY_HISTORY = os.getenv(
     "PERSIST_DIRECTORY_HISTORY", "./chroma_db_history"
 )
+# chroma - локальные каталоги выше, pgvector - общие таблицы в Postgres (12-vector-store.sql),
+# snapshot - неизменяемые mmap-снимки в VECTOR_SNAPSHOT_DIR, общие для процессов узла
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+VECTOR_SNAPSHOT_DIR = os.getenv("VECTOR_SNAPSHOT_DIR", "./vector_snapshots")
+VECTOR_SNAPSHOT_PUBLISH_SECONDS = float(os.getenv("VECTOR_SNAPSHOT_PUBLISH_SECONDS", "30"))
+# Пороги ниже - косинусная близость эмбеддингов (vector_base.distance_to_similarity)
 SIMILARITY_THRESHOLD = 0.98
+# Бюджет текста письма в промпте; токен ~3 символа для русского текста
+NORMALIZE_MAX_TOKENS = int(os.getenv("NORMALIZE_MAX_TOKENS", "1500"))
+NORMALIZE_CHARS_PER_TOKEN = float(os.getenv("NORMALIZE_CHARS_PER_TOKEN", "3"))
+NORMALIZE_CACHE_SIZE = int(os.getenv("NORMALIZE_CACHE_SIZE", "1000"))
+# Автоотправка ответов: только при уверенности не ниже порога. У rubert-эмбеддингов
+# косинус даже несвязанных текстов высокий, поэтому порог близок к единице
+AUTO_DISPATCH_ENABLED = os.getenv("AUTO_DISPATCH_ENABLED", "0") == "1"
+AUTO_DISPATCH_MIN_CONFIDENCE = float(os.getenv("AUTO_DISPATCH_MIN_CONFIDENCE", "0.95"))
+# Разбор вложений (PDF, DOCX, XLSX) в отдельных процессах
+ATTACHMENT_WORKERS = int(os.getenv("ATTACHMENT_WORKERS", "2"))
+ATTACHMENT_TIMEOUT_SECONDS = float(os.getenv("ATTACHMENT_TIMEOUT_SECONDS", "30"))
+# Сколько обработка письма ждет разбор вложений; дальше идет без них, разбор
+# продолжается в фоне и попадет в кеш для повторов
+ATTACHMENT_DESCRIBE_WAIT_SECONDS = float(os.getenv("ATTACHMENT_DESCRIBE_WAIT_SECONDS", "10"))
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", str(30 * 1024 * 1024)))
+ATTACHMENT_TEXT_MAX_CHARS = int(os.getenv("ATTACHMENT_TEXT_MAX_CHARS", "50000"))
+# Период фоновой догрузки почты в mailbox_messages для /api/fetchMails, 0 - выключена
+MAILBOX_SYNC_SECONDS = float(os.getenv("MAILBOX_SYNC_SECONDS", "60"))
+# Ответы API крупнее порога сжимаются gzip, если клиент его принимает
+RESPONSE_GZIP_MIN_BYTES = int(os.getenv("RESPONSE_GZIP_MIN_BYTES", "16384"))
+RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", "5"))
+
+POSTGRES_DB_NAME = os.getenv("POSTGRES_DB", "postgres")
+POSTGRES_DB_USER = os.getenv("POSTGRES_USER", "postgres")
+POSTGRES_DB_PASS = os.getenv("POSTGRES_PASSWORD", "postgres")
+POSTGRES_HOSTNAME = os.getenv("POSTGRES_HOSTNAME", "postgres")
+POSTGRES_PORT = os.getenv("POSTGRES_PORT", "5432")
+# Реплики для чтения через запятую; без них чтение идет в основную БД
+POSTGRES_REPLICA_HOSTNAMES = [
+    host.strip()
+    for host in os.getenv("POSTGRES_REPLICA_HOSTNAMES", "").split(",")
+    if host.strip()
+]
+# Пулы API: запись (обращения, очередь писем), чтение, выгрузки и аналитика
+DB_WRITE_POOL_MIN = int(os.getenv("DB_WRITE_POOL_MIN", "2"))
+DB_WRITE_POOL_MAX = int(os.getenv("DB_WRITE_POOL_MAX", "10"))
+DB_READ_POOL_MIN = int(os.getenv("DB_READ_POOL_MIN", "1"))
+DB_READ_POOL_MAX = int(os.getenv("DB_READ_POOL_MAX", "10"))
+DB_EXPORT_POOL_MAX = int(os.getenv("DB_EXPORT_POOL_MAX", "2"))
+# Страницы /api/requests больше этого лимита (аналитика) читаются через пул выгрузок
+DB_EXPORT_PAGE_THRESHOLD = int(os.getenv("DB_EXPORT_PAGE_THRESHOLD", "200"))
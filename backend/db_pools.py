@@ -0,0 +1,140 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List
+
+import asyncpg
+
+from cfg import (
+    POSTGRES_DB_NAME,
+    POSTGRES_DB_PASS,
+    POSTGRES_DB_USER,
+    POSTGRES_HOSTNAME,
+    POSTGRES_PORT,
+)
+from metrics import DB_POOL_WAIT, track_db_pool
+
+
+def connect_kwargs(host: str = POSTGRES_HOSTNAME) -> Dict[str, Any]:
+    return dict(
+        user=POSTGRES_DB_USER,
+        password=POSTGRES_DB_PASS,
+        database=POSTGRES_DB_NAME,
+        host=host,
+        port=POSTGRES_PORT,
+    )
+
+
+class TimedPool:
+    """
+    Пул asyncpg с учетом ожидания свободного соединения: гистограмма
+    в Prometheus и сводка для /api/db/pools.
+    """
+
+    def __init__(self, name: str, pool: asyncpg.Pool, max_size: int):
+        self.name = name
+        self.pool = pool
+        self.max_size = max_size
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        track_db_pool(name, pool)
+
+    @classmethod
+    async def create(cls, name: str, host: str, min_size: int, max_size: int) -> "TimedPool":
+        pool = await asyncpg.create_pool(
+            **connect_kwargs(host), min_size=min_size, max_size=max_size
+        )
+        return cls(name, pool, max_size)
+
+    @asynccontextmanager
+    async def acquire(self):
+        started = time.perf_counter()
+        async with self.pool.acquire() as conn:
+            waited = time.perf_counter() - started
+            DB_POOL_WAIT.labels(self.name).observe(waited)
+            self.waits += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            yield conn
+
+    async def execute(self, query: str, *args):
+        async with self.acquire() as conn:
+            return await conn.execute(query, *args)
+
+    async def executemany(self, query: str, args):
+        async with self.acquire() as conn:
+            return await conn.executemany(query, args)
+
+    async def fetch(self, query: str, *args):
+        async with self.acquire() as conn:
+            return await conn.fetch(query, *args)
+
+    async def fetchrow(self, query: str, *args):
+        async with self.acquire() as conn:
+            return await conn.fetchrow(query, *args)
+
+    async def fetchval(self, query: str, *args):
+        async with self.acquire() as conn:
+            return await conn.fetchval(query, *args)
+
+    def get_size(self) -> int:
+        return self.pool.get_size()
+
+    def get_idle_size(self) -> int:
+        return self.pool.get_idle_size()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pool": self.name,
+            "size": self.get_size(),
+            "idle": self.get_idle_size(),
+            "max_size": self.max_size,
+            "waits": self.waits,
+            "avg_wait_ms": round(self.wait_seconds / self.waits * 1000, 2) if self.waits else 0.0,
+            "max_wait_ms": round(self.max_wait_seconds * 1000, 2),
+        }
+
+    async def close(self):
+        await self.pool.close()
+
+
+class ReplicaPools:
+    """
+    Чтение с нескольких реплик: каждое соединение берется из пула реплики,
+    у которой сейчас меньше всего занятых соединений.
+    """
+
+    def __init__(self, pools: List[TimedPool]):
+        self.pools = pools
+
+    @classmethod
+    async def create(cls, name: str, hosts: List[str], min_size: int, max_size: int) -> "ReplicaPools":
+        pools = await asyncio.gather(
+            *(
+                TimedPool.create(f"{name}:{host}" if len(hosts) > 1 else name, host, min_size, max_size)
+                for host in hosts
+            )
+        )
+        return cls(list(pools))
+
+    def _least_busy(self) -> TimedPool:
+        return min(self.pools, key=lambda p: p.get_size() - p.get_idle_size())
+
+    def acquire(self):
+        return self._least_busy().acquire()
+
+    async def fetch(self, query: str, *args):
+        return await self._least_busy().fetch(query, *args)
+
+    async def fetchrow(self, query: str, *args):
+        return await self._least_busy().fetchrow(query, *args)
+
+    async def fetchval(self, query: str, *args):
+        return await self._least_busy().fetchval(query, *args)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [pool.stats() for pool in self.pools]
+
+    async def close(self):
+        await asyncio.gather(*(pool.close() for pool in self.pools))
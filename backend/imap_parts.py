@@ -0,0 +1,196 @@
+import base64
+import binascii
+import quopri
+import re
+from typing import Any, Dict, List, Tuple
+
+_TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+_LITERAL_RE = re.compile(rb"\{(\d+)\}$")
+
+
+def _tokenize(chunk: bytes, tokens: List[Any]):
+    pos = 0
+    while pos < len(chunk):
+        match = _TOKEN_RE.match(chunk, pos)
+        if not match or match.end() == pos:
+            break
+        pos = match.end()
+        if match.group(1):
+            tokens.append("(")
+        elif match.group(2):
+            tokens.append(")")
+        elif match.group(3) is not None:
+            value = re.sub(rb"\\(.)", rb"\1", match.group(3))
+            tokens.append(("str", value))
+        else:
+            tokens.append(("atom", match.group(4)))
+
+
+def _parse(tokens: List[Any], pos: int = 0) -> Tuple[List[Any], int]:
+    items = []
+    while pos < len(tokens):
+        token = tokens[pos]
+        pos += 1
+        if token == "(":
+            sub, pos = _parse(tokens, pos)
+            items.append(sub)
+        elif token == ")":
+            return items, pos
+        elif token[0] == "atom":
+            atom = token[1].decode("ascii", errors="ignore")
+            if atom.upper() == "NIL":
+                items.append(None)
+            elif atom.isdigit():
+                items.append(int(atom))
+            else:
+                items.append(atom)
+        elif token[0] == "str":
+            items.append(token[1].decode("utf-8", errors="ignore"))
+        else:
+            # literal остается байтами: это содержимое писем и частей
+            items.append(token[1])
+    return items, pos
+
+
+def parse_fetch_response(data: list) -> Dict[str, Any]:
+    """
+    Разбирает ответ imaplib на FETCH одного письма в словарь
+    {"UID": 1, "BODYSTRUCTURE": [...], "BODY[1]": b"..."}.
+    """
+    tokens: List[Any] = []
+    for item in data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            prefix, literal = item
+            prefix = _LITERAL_RE.sub(b"", prefix.rstrip())
+            _tokenize(prefix, tokens)
+            tokens.append(("literal", literal))
+        else:
+            _tokenize(item, tokens)
+
+    parsed, _ = _parse(tokens)
+    # parsed = [seq, [KEY, value, KEY, value, ...]]
+    fields = next((x for x in parsed if isinstance(x, list)), [])
+    return {
+        str(fields[i]).upper(): fields[i + 1] for i in range(0, len(fields) - 1, 2)
+    }
+
+
+def _params(raw) -> Dict[str, str]:
+    if not isinstance(raw, list):
+        return {}
+    params = {}
+    for i in range(0, len(raw) - 1, 2):
+        value = raw[i + 1]
+        if isinstance(value, bytes):
+            value = value.decode("utf-8", errors="ignore")
+        if isinstance(value, str):
+            params[str(raw[i]).lower()] = value
+    return params
+
+
+def flatten_bodystructure(structure: list, prefix: str = "") -> List[Dict[str, Any]]:
+    """
+    Список листовых частей письма с номерами секций IMAP ("1", "2.1", ...),
+    типом, кодировкой, размером и именем файла.
+    """
+    if not structure:
+        return []
+    if isinstance(structure[0], list):
+        parts = []
+        # Дочерние части идут списками до строки с подтипом ("MIXED", "ALTERNATIVE")
+        children = []
+        for item in structure:
+            if not isinstance(item, list):
+                break
+            children.append(item)
+        for idx, child in enumerate(children, start=1):
+            section = f"{prefix}.{idx}" if prefix else str(idx)
+            parts.extend(flatten_bodystructure(child, section))
+        return parts
+
+    section = prefix or "1"
+    maintype = str(structure[0] or "").lower()
+    subtype = str(structure[1] or "").lower()
+    params = _params(structure[2])
+    encoding = str(structure[5] or "7bit").lower()
+    size = structure[6] if isinstance(structure[6], int) else 0
+
+    # Расширенные поля идут после size (+ lines для text/*, + envelope/body/lines для message/rfc822)
+    ext_start = 7
+    if maintype == "text":
+        ext_start = 8
+    elif maintype == "message" and subtype == "rfc822":
+        ext_start = 10
+    disposition_raw = structure[ext_start + 1] if len(structure) > ext_start + 1 else None
+
+    disposition = ""
+    disposition_params: Dict[str, str] = {}
+    if isinstance(disposition_raw, list) and disposition_raw:
+        disposition = str(disposition_raw[0]).lower()
+        disposition_params = _params(disposition_raw[1] if len(disposition_raw) > 1 else None)
+
+    # Имя файла может быть в RFC 2047, декодируется вызывающим кодом
+    filename = disposition_params.get("filename") or params.get("name") or ""
+    return [
+        {
+            "section": section,
+            "content_type": f"{maintype}/{subtype}",
+            "charset": params.get("charset", "utf-8"),
+            "encoding": encoding,
+            "size": size,
+            "disposition": disposition,
+            "filename": filename,
+        }
+    ]
+
+
+def is_attachment(part: Dict[str, Any]) -> bool:
+    if part["disposition"] == "attachment":
+        return True
+    return bool(part["filename"]) and not part["content_type"].startswith("text/")
+
+
+class TransferDecoder:
+    """Потоковое декодирование base64 / quoted-printable по кускам произвольной длины."""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        self._tail = b""
+
+    def feed(self, chunk: bytes) -> bytes:
+        if self.encoding == "base64":
+            data = self._tail + re.sub(rb"\s+", b"", chunk)
+            usable = len(data) - len(data) % 4
+            self._tail = data[usable:]
+            try:
+                return base64.b64decode(data[:usable])
+            except binascii.Error:
+                return b""
+        if self.encoding == "quoted-printable":
+            # Мягкий перенос "=\r\n" может разорваться между кусками: декодируем до последней строки
+            data = self._tail + chunk
+            cut = data.rfind(b"\n") + 1
+            self._tail = data[cut:]
+            return quopri.decodestring(data[:cut])
+        return chunk
+
+    def flush(self) -> bytes:
+        tail, self._tail = self._tail, b""
+        if not tail:
+            return b""
+        if self.encoding == "base64":
+            try:
+                return base64.b64decode(tail + b"=" * (-len(tail) % 4))
+            except binascii.Error:
+                return b""
+        if self.encoding == "quoted-printable":
+            return quopri.decodestring(tail)
+        return tail
+
+
+def decode_part(payload: bytes, part: Dict[str, Any]) -> str:
+    decoder = TransferDecoder(part["encoding"])
+    data = decoder.feed(payload) + decoder.flush()
+    return data.decode(part["charset"] or "utf-8", errors="ignore")
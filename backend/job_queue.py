@@ -0,0 +1,345 @@
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+import asyncpg
+
+from cfg import (
+    POSTGRES_DB_NAME,
+    POSTGRES_DB_USER,
+    POSTGRES_DB_PASS,
+    POSTGRES_HOSTNAME,
+    POSTGRES_PORT,
+)
+
+# Этапы обработки письма в порядке выполнения
+STAGE_FETCHED = "fetched"
+STAGE_EXTRACTED = "extracted"
+STAGE_ANSWERED = "answered"
+STAGE_PERSISTED = "persisted"
+
+STATUS_PENDING = "pending"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_DEAD = "dead"
+
+MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "30"))
+RETRY_MAX_SECONDS = float(os.getenv("JOB_RETRY_MAX_SECONDS", "3600"))
+LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+# За какой период считается ожидание до начала обработки в queue_stats
+WAIT_STATS_WINDOW_SECONDS = float(os.getenv("QUEUE_WAIT_STATS_WINDOW_SECONDS", "3600"))
+
+class LeaseLostError(Exception):
+    """Аренда задачи истекла, и ее забрал другой воркер."""
+
+
+def _check_owned(result: str, job_id: int):
+    # Ни одной обновленной строки: задача уже не running у этого воркера
+    if result.split()[-1] == "0":
+        raise LeaseLostError(f"Задача {job_id} уже обрабатывается другим воркером")
+
+
+# Ключ advisory lock, которым выбирается единственный сборщик почты
+FETCHER_LOCK_ID = 7301
+
+
+async def create_pool(min_size: int = 1, max_size: int = 10) -> asyncpg.Pool:
+    return await asyncpg.create_pool(
+        user=POSTGRES_DB_USER,
+        password=POSTGRES_DB_PASS,
+        database=POSTGRES_DB_NAME,
+        host=POSTGRES_HOSTNAME,
+        port=POSTGRES_PORT,
+        min_size=min_size,
+        max_size=max_size,
+    )
+
+
+def _job_from_row(row) -> Dict[str, Any]:
+    job = dict(row)
+    # asyncpg по умолчанию отдает jsonb строкой
+    for key in ("letter", "extracted"):
+        if isinstance(job.get(key), str):
+            job[key] = json.loads(job[key])
+    return job
+
+
+def retry_delay(attempts: int) -> float:
+    """Экспоненциальная задержка перед следующей попыткой."""
+    return min(RETRY_BASE_SECONDS * (2 ** max(attempts - 1, 0)), RETRY_MAX_SECONDS)
+
+
+async def enqueue_letter(conn, msg: dict, priority: int) -> bool:
+    """Ставит письмо в очередь. Повторно полученные письма игнорируются."""
+    result = await conn.execute(
+        """
+        INSERT INTO letter_jobs (message_id, priority, letter)
+        VALUES ($1, $2, $3::jsonb)
+        ON CONFLICT (message_id) DO NOTHING
+        """,
+        msg["message_id"],
+        priority,
+        json.dumps(msg, ensure_ascii=False, default=str),
+    )
+    return result.split()[-1] == "1"
+
+
+async def enqueue_letters_batch(conn, msgs: List[dict], priorities: List[int]) -> List[str]:
+    """Пачка писем одним INSERT; возвращает message_id действительно добавленных."""
+    rows = await conn.fetch(
+        """
+        INSERT INTO letter_jobs (message_id, priority, letter)
+        SELECT * FROM unnest($1::text[], $2::smallint[], $3::jsonb[])
+        ON CONFLICT (message_id) DO NOTHING
+        RETURNING message_id
+        """,
+        [msg["message_id"] for msg in msgs],
+        priorities,
+        [json.dumps(msg, ensure_ascii=False, default=str) for msg in msgs],
+    )
+    return [row["message_id"] for row in rows]
+
+
+async def known_message_ids(conn, message_ids: List[str]) -> set:
+    rows = await conn.fetch(
+        "SELECT message_id FROM letter_jobs WHERE message_id = ANY($1::text[])",
+        message_ids,
+    )
+    return {row["message_id"] for row in rows}
+
+
+async def pending_count(conn) -> int:
+    return await conn.fetchval("SELECT count(*) FROM letter_jobs WHERE status = 'pending'")
+
+
+async def claim_job(conn, worker_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Забирает самую приоритетную готовую задачу, не блокируясь на чужих.
+    Задачи с истекшей арендой (воркер упал) тоже считаются готовыми. Если у
+    такой задачи попытки исчерпаны (письмо раз за разом роняет или вешает
+    воркер и до fail_job дело не доходит), тем же запросом она переносится
+    в letter_dead_jobs, а не запускается снова.
+    """
+    row = await conn.fetchrow(
+        """
+        WITH dead AS (
+            UPDATE letter_jobs
+            SET status = 'dead',
+                last_error = 'Аренда истекла ' || attempts || ' раз: воркер не завершил обработку',
+                lease_until = NULL,
+                updated_at = now()
+            WHERE job_id IN (
+                SELECT job_id FROM letter_jobs
+                WHERE status = 'running' AND lease_until < now() AND attempts >= $3
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING *
+        ), buried AS (
+            INSERT INTO letter_dead_jobs
+            (job_id, message_id, priority, stage, letter, extracted, llm_answer, attempts, last_error, created_at)
+            SELECT job_id, message_id, priority, stage, letter, extracted, llm_answer, attempts, last_error, created_at
+            FROM dead
+            ON CONFLICT (job_id) DO NOTHING
+        )
+        UPDATE letter_jobs
+        SET status = 'running',
+            attempts = attempts + 1,
+            locked_by = $1,
+            lease_until = now() + make_interval(secs => $2),
+            started_at = COALESCE(started_at, now()),
+            updated_at = now()
+        WHERE job_id = (
+            SELECT job_id FROM letter_jobs
+            WHERE (status = 'pending' AND next_attempt_at <= now())
+               OR (status = 'running' AND lease_until < now() AND attempts < $3)
+            ORDER BY priority, job_id
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING *
+        """,
+        worker_id,
+        LEASE_SECONDS,
+        MAX_ATTEMPTS,
+    )
+    return _job_from_row(row) if row else None
+
+
+async def extend_lease(conn, job_id: int, worker_id: str) -> bool:
+    """Продлевает аренду. False - задачу уже забрал другой воркер."""
+    result = await conn.execute(
+        """
+        UPDATE letter_jobs
+        SET lease_until = now() + make_interval(secs => $3)
+        WHERE job_id = $1 AND locked_by = $2 AND status = 'running'
+        """,
+        job_id,
+        worker_id,
+        LEASE_SECONDS,
+    )
+    return result.split()[-1] == "1"
+
+
+async def checkpoint(
+    conn,
+    job_id: int,
+    worker_id: str,
+    stage: str,
+    extracted: Optional[dict] = None,
+    llm_answer: Optional[str] = None,
+    answer_confidence: Optional[float] = None,
+    answer_source: Optional[str] = None,
+):
+    """Сохраняет результат пройденного этапа. LeaseLostError - задачу забрал другой воркер."""
+    result = await conn.execute(
+        """
+        UPDATE letter_jobs
+        SET stage = $2,
+            extracted = COALESCE($3::jsonb, extracted),
+            llm_answer = COALESCE($4, llm_answer),
+            answer_confidence = COALESCE($5, answer_confidence),
+            answer_source = COALESCE($6, answer_source),
+            updated_at = now()
+        WHERE job_id = $1 AND locked_by = $7 AND status = 'running'
+        """,
+        job_id,
+        stage,
+        json.dumps(extracted, ensure_ascii=False) if extracted is not None else None,
+        llm_answer,
+        answer_confidence,
+        answer_source,
+        worker_id,
+    )
+    _check_owned(result, job_id)
+
+
+async def save_letter_files(conn, job_id: int, worker_id: str, files: list):
+    """Метаданные вложений с sha256 и path, чтобы повтор не качал их заново."""
+    result = await conn.execute(
+        """
+        UPDATE letter_jobs
+        SET letter = jsonb_set(letter, '{files}', $2::jsonb), updated_at = now()
+        WHERE job_id = $1 AND locked_by = $3 AND status = 'running'
+        """,
+        job_id,
+        json.dumps(files, ensure_ascii=False, default=str),
+        worker_id,
+    )
+    _check_owned(result, job_id)
+
+
+async def complete_job(conn, job_id: int, worker_id: str):
+    result = await conn.execute(
+        """
+        UPDATE letter_jobs
+        SET stage = $2, status = 'done', last_error = NULL, lease_until = NULL, updated_at = now()
+        WHERE job_id = $1 AND locked_by = $3 AND status = 'running'
+        """,
+        job_id,
+        STAGE_PERSISTED,
+        worker_id,
+    )
+    _check_owned(result, job_id)
+
+
+async def fail_job(conn, job: Dict[str, Any], error: str) -> bool:
+    """
+    Возвращает задачу в очередь с задержкой или, если попытки исчерпаны,
+    переносит ее в letter_dead_jobs. True - задача ушла в dead-letter.
+    Меняется только задача, которую этот воркер еще держит (job["locked_by"]),
+    иначе LeaseLostError.
+    """
+    if job["attempts"] >= MAX_ATTEMPTS:
+        # Одним запросом, чтобы работало и через пул без явной транзакции.
+        # Строка остается в letter_jobs, чтобы письмо не попало в очередь повторно
+        result = await conn.execute(
+            """
+            WITH dead AS (
+                UPDATE letter_jobs
+                SET status = 'dead', last_error = $2, lease_until = NULL, updated_at = now()
+                WHERE job_id = $1 AND locked_by = $3 AND status = 'running'
+                RETURNING *
+            )
+            INSERT INTO letter_dead_jobs
+            (job_id, message_id, priority, stage, letter, extracted, llm_answer, attempts, last_error, created_at)
+            SELECT job_id, message_id, priority, stage, letter, extracted, llm_answer, attempts, last_error, created_at
+            FROM dead
+            ON CONFLICT (job_id) DO NOTHING
+            """,
+            job["job_id"],
+            error,
+            job["locked_by"],
+        )
+        _check_owned(result, job["job_id"])
+        return True
+
+    result = await conn.execute(
+        """
+        UPDATE letter_jobs
+        SET status = 'pending',
+            last_error = $2,
+            lease_until = NULL,
+            next_attempt_at = now() + make_interval(secs => $3),
+            updated_at = now()
+        WHERE job_id = $1 AND locked_by = $4 AND status = 'running'
+        """,
+        job["job_id"],
+        error,
+        retry_delay(job["attempts"]),
+        job["locked_by"],
+    )
+    _check_owned(result, job["job_id"])
+    return False
+
+
+async def queue_stats(conn, window_seconds: float = WAIT_STATS_WINDOW_SECONDS) -> List[Dict[str, Any]]:
+    """
+    По приоритетам: глубина очереди, возраст самой старой задачи и ожидание
+    до начала обработки (среднее и максимум) у задач, взятых за window_seconds.
+    """
+    rows = await conn.fetch(
+        """
+        SELECT priority,
+               count(*) FILTER (WHERE status IN ('pending', 'running')) AS depth,
+               COALESCE(EXTRACT(EPOCH FROM max(now() - created_at)
+                   FILTER (WHERE status IN ('pending', 'running'))), 0) AS max_wait,
+               COALESCE(EXTRACT(EPOCH FROM avg(started_at - created_at)
+                   FILTER (WHERE started_at >= now() - make_interval(secs => $1))), 0) AS avg_start_wait,
+               COALESCE(EXTRACT(EPOCH FROM max(started_at - created_at)
+                   FILTER (WHERE started_at >= now() - make_interval(secs => $1))), 0) AS max_start_wait
+        FROM letter_jobs
+        WHERE status IN ('pending', 'running')
+           OR started_at >= now() - make_interval(secs => $1)
+        GROUP BY priority
+        ORDER BY priority
+        """,
+        window_seconds,
+    )
+    return [dict(row) for row in rows]
+
+
+async def try_acquire_fetcher_lock(conn) -> bool:
+    """Только один процесс в кластере может держать блокировку сборщика почты."""
+    return await conn.fetchval("SELECT pg_try_advisory_lock($1)", FETCHER_LOCK_ID)
+
+
+async def release_fetcher_lock(conn):
+    await conn.execute("SELECT pg_advisory_unlock($1)", FETCHER_LOCK_ID)
+
+
+async def heartbeat(conn, worker_id: str, hostname: str, role: str):
+    await conn.execute(
+        """
+        INSERT INTO scheduler_workers (worker_id, hostname, role)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (worker_id) DO UPDATE SET heartbeat_at = now(), role = $3
+        """,
+        worker_id,
+        hostname,
+        role,
+    )
+
+
+async def remove_worker(conn, worker_id: str):
+    await conn.execute("DELETE FROM scheduler_workers WHERE worker_id = $1", worker_id)
@@ -0,0 +1,63 @@
+import re
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+# Архив при подключении нового ящика: после всей живой почты
+PRIORITY_IMPORT = 3
+
+PRIORITY_NAMES = {
+    PRIORITY_HIGH: "high",
+    PRIORITY_NORMAL: "normal",
+    PRIORITY_LOW: "low",
+    PRIORITY_IMPORT: "import",
+}
+
+# Признаки недовольного клиента или неисправного прибора
+HIGH_PRIORITY_PATTERNS = [
+    r"не\s*работа",
+    r"сломал",
+    r"неисправ",
+    r"авари",
+    r"срочно",
+    r"жалоб",
+    r"претензи",
+    r"возмущ",
+    r"безобрази",
+    r"отказ\w*\s+(прибора|датчика|устройства)",
+    r"ошибк\w*\s+[eеEЕ]?\d{1,3}\b",
+    r"\b[eеEЕ]\d{2}\b",
+    r"не\s*включа",
+    r"не\s*показыва",
+]
+
+# Рассылки, автоответы и прочие письма, которые могут подождать
+LOW_PRIORITY_PATTERNS = [
+    r"рассылк",
+    r"unsubscribe",
+    r"отписат",
+    r"newsletter",
+    r"no-?reply",
+    r"автоответ",
+    r"auto-?reply",
+    r"акци[яи]",
+    r"вебинар",
+]
+
+_high_re = re.compile("|".join(HIGH_PRIORITY_PATTERNS), re.IGNORECASE)
+_low_re = re.compile("|".join(LOW_PRIORITY_PATTERNS), re.IGNORECASE)
+
+
+def classify_priority(msg: dict) -> int:
+    """Быстрая оценка приоритета письма по теме, тексту и отправителю (без LLM)."""
+    subject = msg.get("subject", "") or ""
+    sender = msg.get("sender_email", "") or ""
+    # Для классификации хватает начала письма, цитаты ниже обычно не важны
+    text = (msg.get("text", "") or "")[:2000]
+    haystack = f"{subject}\n{text}"
+
+    if _high_re.search(haystack):
+        return PRIORITY_HIGH
+    if _low_re.search(f"{sender}\n{haystack}"):
+        return PRIORITY_LOW
+    return PRIORITY_NORMAL
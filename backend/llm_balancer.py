@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+import httpx
+
+from metrics import LLM_OUTSTANDING
+from cfg import (
+    LLM_MAX_CONCURRENCY_PER_ENDPOINT,
+    LLM_CIRCUIT_FAILURES,
+    LLM_CIRCUIT_COOLDOWN_SECONDS,
+    LLM_HEALTHCHECK_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Вес последнего замера в скользящей средней задержки
+LATENCY_EWMA_ALPHA = 0.2
+
+
+class NoHealthyEndpointError(Exception):
+    """Все серверы LLM недоступны (circuit breaker открыт)."""
+
+
+def is_endpoint_failure(exc: BaseException) -> bool:
+    """
+    Ошибка сервера, а не запроса: нет соединения, таймаут или 5xx. Ответ 4xx
+    значит, что сервер жив, и circuit breaker он не открывает.
+    """
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, (httpx.TransportError, asyncio.TimeoutError))
+
+
+class Endpoint:
+    """Один OpenAI-совместимый сервер и его статистика."""
+
+    def __init__(self, base_url: str, max_concurrency: int):
+        self.base_url = base_url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.latency_ewma: Optional[float] = None
+        self.circuit_open_until = 0.0
+        self.half_open_probe = False
+
+    def is_available(self, now: float) -> bool:
+        if self.outstanding >= self.max_concurrency:
+            return False
+        if self.circuit_open_until > now:
+            return False
+        # После паузы пропускаем один пробный запрос (half-open)
+        if self.circuit_open_until and self.half_open_probe:
+            return False
+        return True
+
+    def score(self) -> tuple:
+        # Меньше запросов в работе, затем меньше задержка
+        return (self.outstanding, self.latency_ewma or 0.0)
+
+    def record_success(self, latency: float):
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.circuit_open_until = 0.0
+        self.half_open_probe = False
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma += LATENCY_EWMA_ALPHA * (latency - self.latency_ewma)
+
+    def record_rejected(self):
+        """Сервер ответил ошибкой запроса (4xx): он доступен, задержку не учитываем."""
+        self.requests += 1
+        self.errors += 1
+        self.mark_healthy()
+
+    def mark_healthy(self):
+        """Успешная активная проверка закрывает circuit breaker, не влияя на задержку."""
+        self.consecutive_failures = 0
+        self.circuit_open_until = 0.0
+        self.half_open_probe = False
+
+    def record_failure(self):
+        self.requests += 1
+        self.errors += 1
+        self.consecutive_failures += 1
+        self.half_open_probe = False
+        if self.consecutive_failures >= LLM_CIRCUIT_FAILURES:
+            self.circuit_open_until = time.monotonic() + LLM_CIRCUIT_COOLDOWN_SECONDS
+            logger.warning(
+                f"LLM {self.base_url}: {self.consecutive_failures} ошибок подряд, "
+                f"сервер исключен на {LLM_CIRCUIT_COOLDOWN_SECONDS} с"
+            )
+
+    def stats(self) -> Dict:
+        return {
+            "base_url": self.base_url,
+            "outstanding": self.outstanding,
+            "max_concurrency": self.max_concurrency,
+            "requests": self.requests,
+            "errors": self.errors,
+            "latency_ewma": self.latency_ewma,
+            "circuit_open": self.circuit_open_until > time.monotonic(),
+        }
+
+
+class EndpointPool:
+    """
+    Балансировка запросов между серверами LLM: выбирается сервер с наименьшим
+    числом запросов в работе, при равенстве - с меньшей задержкой.
+    Без asyncio-примитивов, чтобы пул переживал смену event loop (asyncio.run).
+    """
+
+    def __init__(
+        self,
+        base_urls: List[str],
+        max_concurrency: int = LLM_MAX_CONCURRENCY_PER_ENDPOINT,
+        request_timeout: float = 120.0,
+    ):
+        if not base_urls:
+            raise ValueError("Нужен хотя бы один адрес LLM")
+        self.endpoints = [Endpoint(url, max_concurrency) for url in base_urls]
+        # Занятый сервер освободится не позже таймаута запроса, поэтому
+        # свободного сервера ждем столько же, а не меньше
+        self.wait_timeout = request_timeout
+
+    def _pick(self) -> Optional[Endpoint]:
+        now = time.monotonic()
+        candidates = [ep for ep in self.endpoints if ep.is_available(now)]
+        if not candidates:
+            return None
+        endpoint = min(candidates, key=Endpoint.score)
+        if endpoint.circuit_open_until:
+            endpoint.half_open_probe = True
+        return endpoint
+
+    def _all_circuits_open(self) -> bool:
+        now = time.monotonic()
+        return all(ep.circuit_open_until > now for ep in self.endpoints)
+
+    @asynccontextmanager
+    async def acquire(self, wait_timeout: Optional[float] = None):
+        """Выдает сервер под один запрос и учитывает результат."""
+        if wait_timeout is None:
+            wait_timeout = self.wait_timeout
+        deadline = time.monotonic() + wait_timeout
+        endpoint = self._pick()
+        while endpoint is None:
+            if self._all_circuits_open() or time.monotonic() > deadline:
+                raise NoHealthyEndpointError("Нет доступных серверов LLM")
+            await asyncio.sleep(0.05)
+            endpoint = self._pick()
+
+        endpoint.outstanding += 1
+        LLM_OUTSTANDING.labels(endpoint.base_url).inc()
+        started = time.monotonic()
+        try:
+            yield endpoint
+        except Exception as e:
+            if is_endpoint_failure(e):
+                endpoint.record_failure()
+            else:
+                endpoint.record_rejected()
+            raise
+        else:
+            endpoint.record_success(time.monotonic() - started)
+        finally:
+            endpoint.outstanding -= 1
+            LLM_OUTSTANDING.labels(endpoint.base_url).dec()
+
+    async def check_health(self, api_key: str):
+        """Активная проверка: GET /models на каждом сервере."""
+        async with httpx.AsyncClient(timeout=httpx.Timeout(5.0)) as client:
+            for endpoint in self.endpoints:
+                try:
+                    response = await client.get(
+                        f"{endpoint.base_url}/models",
+                        headers={"Authorization": f"Bearer {api_key}"},
+                    )
+                    response.raise_for_status()
+                except Exception as e:
+                    logger.warning(f"LLM {endpoint.base_url} не отвечает: {e}")
+                    endpoint.record_failure()
+                else:
+                    endpoint.mark_healthy()
+
+    async def run_health_checks(
+        self, api_key: str, interval: float = LLM_HEALTHCHECK_SECONDS
+    ):
+        while True:
+            await self.check_health(api_key)
+            await asyncio.sleep(interval)
+
+    def stats(self) -> List[Dict]:
+        return [endpoint.stats() for endpoint in self.endpoints]
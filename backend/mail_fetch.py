@@ -2,15 +2,35 @@ import imaplib
 import email
 from email.header import decode_header
 from email.utils import parseaddr
-from bs4 import BeautifulSoup
+import hashlib
 import os
+import queue
+import re
+import tempfile
+from contextlib import contextmanager
 from dotenv import load_dotenv
+from imap_parts import (
+    TransferDecoder,
+    decode_part,
+    flatten_bodystructure,
+    is_attachment,
+    parse_fetch_response,
+)
+from metrics import observe_stage
+from text_normalize import html_to_text
+from tracing import trace_context, tracer
 
 load_dotenv()
 
-IMAP_SERVER = "imap.mail.ru"
+IMAP_SERVER = os.getenv("IMAP_SERVER", "imap.mail.ru")
+IMAP_PORT = int(os.getenv("IMAP_PORT", "993"))
+# Без SSL - только для локального тестового сервера (benchmarks/imap_server.py)
+IMAP_USE_SSL = os.getenv("IMAP_USE_SSL", "1") == "1"
 EMAIL_USER = os.getenv("IMAP_EMAIL", "")
 EMAIL_PASS = os.getenv("EXTERNAL_PASS", "")
+ATTACHMENTS_DIR = os.getenv("ATTACHMENTS_DIR", "attachments")
+# Вложения качаются кусками BODY.PEEK[n]<offset.size>, чтобы не держать их в памяти целиком
+ATTACHMENT_CHUNK_BYTES = int(os.getenv("ATTACHMENT_CHUNK_BYTES", str(1024 * 1024)))
 
 
 def decode_str(s):
@@ -53,8 +73,7 @@ def get_body(msg):
         if text_parts:
             return "\n".join(text_parts).strip()
         if html_parts:
-            soup = BeautifulSoup("\n".join(html_parts), "html.parser")
-            return soup.get_text("\n").strip()
+            return html_to_text("\n".join(html_parts))
         return ""
     else:
         payload = msg.get_payload(decode=True)
@@ -65,85 +84,359 @@ def get_body(msg):
         content = payload.decode(charset, errors="ignore").strip()
         ctype = msg.get_content_type()
         if ctype == "text/html":
-            soup = BeautifulSoup(content, "html.parser")
-            return soup.get_text("\n").strip()
+            return html_to_text(content)
         elif ctype == "text/plain":
             return content
         else:
             return content
 
 
+def store_attachment(chunks, store_dir, filename="", decoder=None) -> dict:
+    """
+    Пишет вложение в хранилище по содержимому: store_dir/ab/<sha256><ext>.
+    chunks - итератор кусков, decoder - TransferDecoder для закодированных данных.
+    Одинаковые файлы сохраняются один раз, одноименные разные не перезаписывают друг друга.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=store_dir, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                data = decoder.feed(chunk) if decoder else chunk
+                digest.update(data)
+                size += len(data)
+                f.write(data)
+            if decoder:
+                data = decoder.flush()
+                digest.update(data)
+                size += len(data)
+                f.write(data)
+
+        sha256 = digest.hexdigest()
+        ext = os.path.splitext(filename)[1].lower()
+        path = os.path.join(store_dir, sha256[:2], sha256 + ext)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return {"filename": filename, "sha256": sha256, "size": size, "path": path}
+
+
 def get_attachments(msg, save_dir=None):
+    """Вложения уже загруженного письма. Без save_dir - только метаданные, без содержимого"""
     files = []
     for part in msg.walk():
         disp = part.get("Content-Disposition", "")
         if disp and "attachment" in disp.lower():
-            filename = part.get_filename()
-            filename = decode_str(filename)
-            data = part.get_payload(decode=True)
-            if save_dir and filename:
-                path = os.path.join(save_dir, filename)
-                with open(path, "wb") as f:
-                    f.write(data)
-                files.append(path)
-            else:
-                files.append({"filename": filename, "data": data})
+            filename = decode_str(part.get_filename())
+            info = {"filename": filename, "content_type": part.get_content_type()}
+            if save_dir:
+                data = part.get_payload(decode=True) or b""
+                chunks = (
+                    data[i : i + ATTACHMENT_CHUNK_BYTES]
+                    for i in range(0, len(data), ATTACHMENT_CHUNK_BYTES)
+                )
+                info.update(store_attachment(chunks, save_dir, filename))
+            files.append(info)
     return files
 
 
-def fetch_emails(limit=None, save_attachments_dir=None):
-    mail = imaplib.IMAP4_SSL(IMAP_SERVER)
+def connect_imap():
+    if IMAP_USE_SSL:
+        mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
+    else:
+        mail = imaplib.IMAP4(IMAP_SERVER, IMAP_PORT)
     mail.login(EMAIL_USER, EMAIL_PASS)
     mail.select("INBOX")
+    return mail
+
+
+class ImapSessionPool:
+    """
+    Пул авторизованных IMAP-сессий, чтобы не логиниться на каждый запрос.
+    Потокобезопасный: сессии используются из asyncio.to_thread.
+    """
+
+    def __init__(self, size: int = 2):
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    @contextmanager
+    def session(self):
+        mail = None
+        try:
+            mail = self._idle.get_nowait()
+            # NOOP проверяет, что сервер не закрыл сессию, и подтягивает новые письма
+            mail.noop()
+        except queue.Empty:
+            mail = None
+        except Exception:
+            self._logout(mail)
+            mail = None
+
+        if mail is None:
+            mail = connect_imap()
+
+        try:
+            yield mail
+        except Exception:
+            self._logout(mail)
+            raise
+        else:
+            try:
+                self._idle.put_nowait(mail)
+            except queue.Full:
+                self._logout(mail)
+
+    @staticmethod
+    def _logout(mail):
+        if mail is None:
+            return
+        try:
+            mail.logout()
+        except Exception:
+            pass
+
+    def close(self):
+        while True:
+            try:
+                mail = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._logout(mail)
+
+
+def parse_message(raw: bytes, save_attachments_dir=None) -> dict:
+    msg = email.message_from_bytes(raw)
+    _, sender_email = parseaddr(msg.get("From", ""))
+    date_raw = msg.get("Date", "")
+    try:
+        date_formatted = email.utils.format_datetime(
+            email.utils.parsedate_to_datetime(date_raw)
+        )
+    except:
+        date_formatted = date_raw
+    subject = decode_str(msg.get("Subject"))
+    body = get_body(msg)
+    message_id = decode_str(msg.get("Message-ID", ""))
+    attachments = get_attachments(msg, save_dir=save_attachments_dir)
+    return {
+        "subject": subject,
+        "text": body,
+        "message_id": message_id,
+        "files": attachments,
+        "sender_email": sender_email,
+        "date": date_formatted,
+    }
+
+
+def _fetch_structure(mail, uid: int):
+    status, data = mail.uid("fetch", str(uid), "(UID BODYSTRUCTURE BODY.PEEK[HEADER])")
+    if status != "OK" or not data or data[0] is None:
+        return None, []
+    fields = parse_fetch_response(data)
+    header = fields.get("BODY[HEADER]") or b""
+    return header, flatten_bodystructure(fields.get("BODYSTRUCTURE") or [])
+
 
-    status, data = mail.search(None, "ALL")
+def _fetch_letter(mail, uid: int) -> dict:
+    """
+    Письмо без вложений: сначала BODYSTRUCTURE и заголовки, затем только
+    текстовые части. Вложения попадают в files метаданными для fetch_attachment.
+    Корневой спан письма начинается здесь, до забора из почты; его контекст
+    уходит с письмом в очередь (trace_context), и воркер продолжает тот же трейс.
+    """
+    with tracer.start_as_current_span("letter", attributes={"letter.uid": uid}) as span:
+        letter = _fetch_letter_parts(mail, uid)
+        if letter is not None:
+            span.set_attribute("letter.message_id", letter.get("message_id") or "")
+            letter["trace_context"] = trace_context()
+        return letter
+
+
+def _fetch_letter_parts(mail, uid: int) -> dict:
+    with observe_stage("imap_fetch"):
+        header, parts = _fetch_structure(mail, uid)
+    if header is None:
+        return None
+
+    attachments = [part for part in parts if is_attachment(part)]
+    text_parts = [
+        part
+        for part in parts
+        if not is_attachment(part) and part["content_type"] in ("text/plain", "text/html")
+    ]
+
+    payloads = {}
+    if text_parts:
+        items = " ".join(f"BODY.PEEK[{part['section']}]" for part in text_parts)
+        with observe_stage("imap_fetch"):
+            status, data = mail.uid("fetch", str(uid), f"({items})")
+        if status == "OK" and data and data[0] is not None:
+            payloads = parse_fetch_response(data)
+
+    with observe_stage("mime_parse"):
+        letter = parse_message(header)
+        plain, html = [], []
+        for part in text_parts:
+            payload = payloads.get(f"BODY[{part['section']}]")
+            if not isinstance(payload, bytes):
+                continue
+            text = decode_part(payload, part)
+            (plain if part["content_type"] == "text/plain" else html).append(text)
+
+        if plain:
+            letter["text"] = "\n".join(plain).strip()
+        elif html:
+            letter["text"] = html_to_text("\n".join(html))
+        letter["files"] = [
+            {
+                "filename": decode_str(part["filename"]),
+                "content_type": part["content_type"],
+                "size": part["size"],
+                "uid": uid,
+                "section": part["section"],
+            }
+            for part in attachments
+        ]
+    letter["uid"] = uid
+    return letter
+
+
+def get_uidvalidity(mail):
+    """UIDVALIDITY ящика INBOX: при его смене старые UID больше ничего не значат."""
+    status, data = mail.status("INBOX", "(UIDVALIDITY)")
+    if status != "OK" or not data or data[0] is None:
+        return None
+    match = re.search(rb"UIDVALIDITY (\d+)", data[0])
+    return int(match.group(1)) if match else None
+
+
+def _fetch_from_session(mail, limit=None, since_uid=None):
+    if since_uid:
+        status, data = mail.uid("search", None, f"UID {since_uid + 1}:*")
+    else:
+        status, data = mail.uid("search", None, "ALL")
     if status != "OK":
-        mail.logout()
         return []
 
-    ids = data[0].split()
+    uids = [int(uid) for uid in data[0].split()]
+    # "N:*" всегда возвращает последнее письмо, даже если его UID меньше N
+    if since_uid:
+        uids = [uid for uid in uids if uid > since_uid]
     if limit:
-        ids = ids[-limit:]
+        uids = uids[-limit:]
 
     emails = []
-    for msg_id in ids:
-        status, msg_data = mail.fetch(msg_id, "(RFC822)")
-        if status != "OK":
-            continue
-
-        raw = msg_data[0][1]
-        msg = email.message_from_bytes(raw)
-        _, sender_email = parseaddr(msg.get("From", ""))
-        date_raw = msg.get("Date", "")
-        try:
-            date_formatted = email.utils.format_datetime(
-                email.utils.parsedate_to_datetime(date_raw)
+    for uid in uids:
+        letter = _fetch_letter(mail, uid)
+        if letter is not None:
+            emails.append(letter)
+    return emails
+
+
+def _download_part(mail, uid: int, section: str, store_dir: str) -> dict:
+    _, parts = _fetch_structure(mail, uid)
+    part = next((p for p in parts if p["section"] == section), None)
+    if part is None:
+        raise FileNotFoundError(f"Письмо {uid} не содержит части {section}")
+
+    def chunks():
+        offset = 0
+        while True:
+            status, data = mail.uid(
+                "fetch",
+                str(uid),
+                f"(BODY.PEEK[{section}]<{offset}.{ATTACHMENT_CHUNK_BYTES}>)",
             )
-        except:
-            date_formatted = date_raw
-        subject = decode_str(msg.get("Subject"))
-        body = get_body(msg)
-        message_id = decode_str(msg.get("Message-ID", ""))
-        os.makedirs(save_attachments_dir, exist_ok=True)
-        attachments = get_attachments(msg, save_dir=save_attachments_dir)
-        emails.append(
-            {
-                "subject": subject,
-                "text": body,
-                "message_id": message_id,
-                "files": attachments,
-                "sender_email": sender_email,
-                "date": date_formatted,
-            }
-        )
+            if status != "OK" or not data or data[0] is None:
+                raise imaplib.IMAP4.error(f"Не удалось загрузить часть {section} письма {uid}")
+            fields = parse_fetch_response(data)
+            chunk = next(
+                (v for k, v in fields.items() if k.startswith("BODY[") and isinstance(v, bytes)),
+                b"",
+            )
+            if chunk:
+                yield chunk
+            if len(chunk) < ATTACHMENT_CHUNK_BYTES:
+                return
+            offset += len(chunk)
 
-    mail.close()
-    mail.logout()
-    return emails
+    filename = decode_str(part["filename"])
+    with observe_stage("attachment_fetch"):
+        info = store_attachment(chunks(), store_dir, filename, TransferDecoder(part["encoding"]))
+    info["content_type"] = part["content_type"]
+    return info
+
+
+def fetch_attachment(uid: int, section: str, store_dir=ATTACHMENTS_DIR, session_pool=None) -> dict:
+    """
+    Загружает одно вложение по требованию в хранилище по содержимому.
+    Возвращает {"filename", "sha256", "size", "path", "content_type"}.
+    """
+    if session_pool is not None:
+        with session_pool.session() as mail:
+            return _download_part(mail, uid, section, store_dir)
+
+    mail = connect_imap()
+    try:
+        return _download_part(mail, uid, section, store_dir)
+    finally:
+        mail.close()
+        mail.logout()
+
+
+def fetch_emails(limit=None, since_uid=None, session_pool=None):
+    """
+    Забирает письма из INBOX без содержимого вложений. С since_uid - только
+    письма новее этого UID. С session_pool соединение берется из пула и не закрывается.
+    """
+    if session_pool is not None:
+        with session_pool.session() as mail:
+            return _fetch_from_session(mail, limit, since_uid)
+
+    mail = connect_imap()
+    try:
+        return _fetch_from_session(mail, limit, since_uid)
+    finally:
+        mail.close()
+        mail.logout()
+
+
+def _fetch_mailbox_from_session(mail, limit, since_uid, uidvalidity):
+    current = get_uidvalidity(mail)
+    if since_uid and current != uidvalidity:
+        # Ящик пересоздан: since_uid относится к старой нумерации, грузим заново
+        since_uid = None
+    return current, _fetch_from_session(mail, limit if not since_uid else None, since_uid)
+
+
+def fetch_mailbox(limit=None, since_uid=None, uidvalidity=None, session_pool=None):
+    """
+    Как fetch_emails, но с проверкой UIDVALIDITY. Возвращает (uidvalidity, письма);
+    если uidvalidity ящика отличается от переданного, since_uid не используется
+    и письма берутся заново, последние limit.
+    """
+    if session_pool is not None:
+        with session_pool.session() as mail:
+            return _fetch_mailbox_from_session(mail, limit, since_uid, uidvalidity)
+
+    mail = connect_imap()
+    try:
+        return _fetch_mailbox_from_session(mail, limit, since_uid, uidvalidity)
+    finally:
+        mail.close()
+        mail.logout()
 
 
 if __name__ == "__main__":
-    msgs = fetch_emails(limit=10, save_attachments_dir="attachments")
+    msgs = fetch_emails(limit=10)
     print(msgs)
     for m in msgs:
         print("Subject:", m["subject"])
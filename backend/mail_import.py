@@ -0,0 +1,234 @@
+"""
+Импорт архива почты (.mbox и каталоги .eml) при подключении нового ящика.
+Файлы читаются потоково по одному письму, письма с уже известным Message-ID
+пропускаются, новые ставятся в letter_jobs с низшим приоритетом, пока очередь
+не превысит --max-pending. Обрабатывают их обычные воркеры scheduler,
+автоответы на импортированные письма не отправляются.
+
+    python mail_import.py archive.mbox
+    python mail_import.py /data/eml --since 2024-01-01 --save-attachments
+"""
+
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import time
+from datetime import datetime, timezone
+from email.parser import BytesHeaderParser
+from typing import Dict, Iterator, List, Optional
+
+import job_queue
+from letter_queue import PRIORITY_IMPORT
+from mail_fetch import ATTACHMENTS_DIR, decode_str, parse_message
+from utils import parse_mail_dates
+
+logger = logging.getLogger("MailImport")
+
+# Строка-разделитель писем в mbox и экранированные ">From " внутри писем (mboxrd)
+MBOX_FROM = re.compile(rb"^From ")
+MBOX_QUOTED_FROM = re.compile(rb"^>+From ")
+
+
+def iter_mbox(path: str) -> Iterator[bytes]:
+    """Письма mbox по одному, файл целиком в память не читается."""
+    lines: List[bytes] = []
+    prev_blank = True
+    with open(path, "rb") as f:
+        for line in f:
+            if prev_blank and MBOX_FROM.match(line):
+                if lines:
+                    yield b"".join(lines)
+                lines = []
+                prev_blank = False
+                continue
+            if MBOX_QUOTED_FROM.match(line):
+                line = line[1:]
+            lines.append(line)
+            prev_blank = line in (b"\n", b"\r\n")
+    if lines:
+        yield b"".join(lines)
+
+
+def iter_archive(paths: List[str], top_level: bool = True) -> Iterator[bytes]:
+    """
+    Письма из файлов .eml, mbox и каталогов с ними, в порядке имен. Явно
+    указанный файл без расширения .eml читается как mbox (Thunderbird хранит
+    папки без расширения), в каталогах берутся только .eml и .mbox.
+    """
+    for path in paths:
+        lower = path.lower()
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield from iter_archive([os.path.join(root, name)], top_level=False)
+        elif lower.endswith(".eml"):
+            with open(path, "rb") as f:
+                yield f.read()
+        elif lower.endswith(".mbox") or top_level:
+            yield from iter_mbox(path)
+
+
+def message_key(raw: bytes, header_value: Optional[str]) -> str:
+    """Message-ID письма; письмам без него - стабильный id по содержимому."""
+    message_id = decode_str(header_value).strip()
+    if message_id:
+        return message_id
+    return f"<import-{hashlib.sha256(raw).hexdigest()[:32]}@local>"
+
+
+def read_batch(messages: Iterator[bytes], size: int) -> List[Dict]:
+    """Следующие size писем с разобранными заголовками (без тел и вложений)."""
+    parser = BytesHeaderParser()
+    batch = []
+    for raw in messages:
+        headers = parser.parsebytes(raw)
+        batch.append(
+            {
+                "raw": raw,
+                "message_id": message_key(raw, headers.get("Message-ID")),
+                "date": str(headers.get("Date") or ""),
+            }
+        )
+        if len(batch) >= size:
+            break
+    return batch
+
+
+def parse_letters(items: List[Dict], save_dir: Optional[str]) -> List[Dict]:
+    letters = []
+    for item in items:
+        try:
+            letter = parse_message(item["raw"], save_attachments_dir=save_dir)
+        except Exception as e:
+            logger.error(f"Не удалось разобрать письмо {item['message_id']}: {e}")
+            continue
+        letter["message_id"] = item["message_id"]
+        letter["imported"] = True
+        letters.append(letter)
+    return letters
+
+
+class Importer:
+    def __init__(self, pool, args):
+        self.pool = pool
+        self.args = args
+        self.save_dir = ATTACHMENTS_DIR if args.save_attachments else None
+        self.seen = set()
+        self.stats = {"read": 0, "duplicates": 0, "skipped": 0, "failed": 0, "enqueued": 0}
+        self.started = time.monotonic()
+
+    def in_range(self, dt: Optional[datetime]) -> bool:
+        # Письма с неразобранной датой импортируются всегда
+        if dt is None:
+            return True
+        if self.args.since and dt < self.args.since:
+            return False
+        if self.args.until and dt >= self.args.until:
+            return False
+        return True
+
+    async def wait_for_queue(self):
+        """Ждет, пока воркеры разберут очередь, чтобы импорт не вытеснял живую почту."""
+        while True:
+            async with self.pool.acquire() as conn:
+                pending = await job_queue.pending_count(conn)
+            if pending < self.args.max_pending:
+                return
+            logger.info(f"В очереди {pending} писем, ждем {self.args.wait_seconds:g} с")
+            await asyncio.sleep(self.args.wait_seconds)
+
+    async def import_batch(self, batch: List[Dict]):
+        self.stats["read"] += len(batch)
+        dates = parse_mail_dates([item["date"] for item in batch])
+
+        fresh = []
+        for item, dt in zip(batch, dates):
+            if not self.in_range(dt):
+                self.stats["skipped"] += 1
+            elif item["message_id"] in self.seen:
+                self.stats["duplicates"] += 1
+            else:
+                self.seen.add(item["message_id"])
+                fresh.append(item)
+        if not fresh:
+            return
+
+        async with self.pool.acquire() as conn:
+            known = await job_queue.known_message_ids(conn, [item["message_id"] for item in fresh])
+        self.stats["duplicates"] += len(known)
+        fresh = [item for item in fresh if item["message_id"] not in known]
+        if not fresh:
+            return
+
+        letters = await asyncio.to_thread(parse_letters, fresh, self.save_dir)
+        self.stats["failed"] += len(fresh) - len(letters)
+        if self.args.dry_run or not letters:
+            self.stats["enqueued"] += len(letters)
+            return
+
+        await self.wait_for_queue()
+        async with self.pool.acquire() as conn:
+            added = await job_queue.enqueue_letters_batch(
+                conn, letters, [PRIORITY_IMPORT] * len(letters)
+            )
+        self.stats["duplicates"] += len(letters) - len(added)
+        self.stats["enqueued"] += len(added)
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.stats["read"] / elapsed if elapsed > 0 else 0.0
+        logger.info(
+            f"Прочитано {self.stats['read']}, в очередь {self.stats['enqueued']}, "
+            f"дубликатов {self.stats['duplicates']}, вне периода {self.stats['skipped']}, "
+            f"ошибок {self.stats['failed']}, {rate:.1f} писем/с"
+        )
+
+    async def run(self):
+        messages = iter_archive(self.args.paths)
+        try:
+            while True:
+                batch = await asyncio.to_thread(read_batch, messages, self.args.batch_size)
+                if not batch:
+                    break
+                await self.import_batch(batch)
+                self.report()
+        finally:
+            messages.close()
+        if self.args.dry_run:
+            logger.info("Пробный запуск: письма в очередь не ставились")
+
+
+def parse_day(value: str) -> datetime:
+    return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+
+
+async def run(args):
+    pool = await job_queue.create_pool(max_size=2)
+    try:
+        await Importer(pool, args).run()
+    finally:
+        await pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Импорт архива почты в очередь писем")
+    parser.add_argument("paths", nargs="+", help="файлы .mbox/.eml или каталоги с ними")
+    parser.add_argument("--since", type=parse_day, help="только письма с этой даты, ГГГГ-ММ-ДД")
+    parser.add_argument("--until", type=parse_day, help="только письма до этой даты")
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--max-pending", type=int, default=500, help="предел ожидающих задач в очереди")
+    parser.add_argument("--wait-seconds", type=float, default=10)
+    parser.add_argument("--save-attachments", action="store_true", help=f"сохранять вложения в {ATTACHMENTS_DIR}")
+    parser.add_argument("--dry-run", action="store_true", help="только подсчитать новые письма")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
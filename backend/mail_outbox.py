@@ -0,0 +1,362 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from email.utils import make_msgid
+from typing import Any, Dict, List, Optional
+
+from job_queue import retry_delay
+from mail_sending import SmtpConnectionPool, build_message
+from metrics import OUTBOX_SENT
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_SENDERS = int(os.getenv("OUTBOX_SENDERS", "2"))
+# Ограничение почтового сервера на частоту отправки
+OUTBOX_RATE_PER_MINUTE = float(os.getenv("OUTBOX_RATE_PER_MINUTE", "60"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "120"))
+# Попытки записать 'sent' после успешной отправки, прежде чем сдаться
+OUTBOX_MARK_SENT_ATTEMPTS = int(os.getenv("OUTBOX_MARK_SENT_ATTEMPTS", "5"))
+# Обращения с отправленными ответами закрываются пачками: одним UPDATE на
+# OUTBOX_CLOSE_BATCH_SIZE писем или раз в OUTBOX_CLOSE_FLUSH_SECONDS
+OUTBOX_CLOSE_BATCH_SIZE = int(os.getenv("OUTBOX_CLOSE_BATCH_SIZE", "50"))
+OUTBOX_CLOSE_FLUSH_SECONDS = float(os.getenv("OUTBOX_CLOSE_FLUSH_SECONDS", "2"))
+
+SEND_QUEUED = "queued"
+SEND_SENT = "sent"
+SEND_FAILED = "failed"
+
+
+async def enqueue_mail(conn, payload: Dict[str, Any]) -> int:
+    """
+    Ставит письмо в очередь и отмечает обращение как ожидающее отправки.
+    Вызывается в транзакции conn, чтобы оба изменения записались вместе.
+    """
+    mail_id = await conn.fetchval(
+        """
+        INSERT INTO outgoing_mail (message_id, payload)
+        VALUES ($1, $2::jsonb)
+        RETURNING mail_id
+        """,
+        payload.get("message_id"),
+        json.dumps(payload, ensure_ascii=False),
+    )
+    if payload.get("message_id"):
+        await conn.execute(
+            "UPDATE requests SET send_status = $2, send_error = NULL WHERE message_id = $1",
+            payload["message_id"],
+            SEND_QUEUED,
+        )
+    return mail_id
+
+
+async def enqueue_mails(conn, payloads: List[Dict[str, Any]]) -> List[int]:
+    """Пачка писем одной транзакцией: один INSERT и один UPDATE статусов."""
+    async with conn.transaction():
+        mail_ids = await conn.fetch(
+            """
+            INSERT INTO outgoing_mail (message_id, payload)
+            SELECT message_id, payload
+            FROM unnest($1::text[], $2::jsonb[]) AS t(message_id, payload)
+            RETURNING mail_id
+            """,
+            [payload.get("message_id") for payload in payloads],
+            [json.dumps(payload, ensure_ascii=False) for payload in payloads],
+        )
+        message_ids = [p["message_id"] for p in payloads if p.get("message_id")]
+        if message_ids:
+            await conn.execute(
+                """
+                UPDATE requests SET send_status = $2, send_error = NULL
+                WHERE message_id = ANY($1::text[])
+                """,
+                message_ids,
+                SEND_QUEUED,
+            )
+    return [row["mail_id"] for row in mail_ids]
+
+
+async def claim_mail(conn) -> Optional[Dict[str, Any]]:
+    row = await conn.fetchrow(
+        """
+        UPDATE outgoing_mail
+        SET status = 'sending',
+            attempts = attempts + 1,
+            lease_until = now() + make_interval(secs => $1)
+        WHERE mail_id = (
+            SELECT mail_id FROM outgoing_mail
+            WHERE (status = 'pending' AND next_attempt_at <= now())
+               OR (status = 'sending' AND lease_until < now())
+            ORDER BY mail_id
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING *
+        """,
+        OUTBOX_LEASE_SECONDS,
+    )
+    if not row:
+        return None
+    mail = dict(row)
+    if isinstance(mail["payload"], str):
+        mail["payload"] = json.loads(mail["payload"])
+    return mail
+
+
+async def mark_sending(conn, mail: Dict[str, Any]) -> str:
+    """
+    Фиксирует попытку до обращения к SMTP и возвращает Message-ID письма.
+    Message-ID выдается один раз, повторы отправляются с ним же.
+    """
+    return await conn.fetchval(
+        """
+        UPDATE outgoing_mail
+        SET smtp_message_id = COALESCE(smtp_message_id, $2), send_started_at = now()
+        WHERE mail_id = $1
+        RETURNING smtp_message_id
+        """,
+        mail["mail_id"],
+        make_msgid(),
+    )
+
+
+async def mark_sent(conn, mail: Dict[str, Any]):
+    """Отмечает письмо отправленным; обращение закрывает close_requests."""
+    await conn.execute(
+        """
+        UPDATE outgoing_mail
+        SET status = 'sent', sent_at = now(), last_error = NULL, lease_until = NULL
+        WHERE mail_id = $1
+        """,
+        mail["mail_id"],
+    )
+
+
+async def close_requests(conn, message_ids: List[str]):
+    """Одним UPDATE закрывает обращения, ответы на которые уже отправлены."""
+    await conn.execute(
+        """
+        UPDATE requests
+        SET send_status = 'sent', send_error = NULL, sent_at = now(),
+            task_status = 'CLOSED'::task_statuses
+        WHERE message_id = ANY($1::text[])
+        """,
+        message_ids,
+    )
+
+
+async def close_unrecorded_requests(conn) -> int:
+    """
+    Закрывает обращения, письма которых отправлены, но пачка не успела
+    записаться (API остановился до сброса). Обращения с новым письмом в
+    очереди не трогаются.
+    """
+    result = await conn.execute(
+        """
+        UPDATE requests r
+        SET send_status = 'sent', send_error = NULL, sent_at = o.sent_at,
+            task_status = 'CLOSED'::task_statuses
+        FROM outgoing_mail o
+        WHERE o.message_id = r.message_id
+          AND o.status = 'sent'
+          AND r.send_status = 'queued'
+          AND NOT EXISTS (
+              SELECT 1 FROM outgoing_mail p
+              WHERE p.message_id = r.message_id AND p.status IN ('pending', 'sending')
+          )
+        """
+    )
+    return int(result.split()[-1])
+
+
+async def mark_failed(conn, mail: Dict[str, Any], error: str) -> bool:
+    """Повтор с задержкой или окончательная ошибка. True - попытки исчерпаны."""
+    if mail["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+        await conn.execute(
+            """
+            WITH failed AS (
+                UPDATE outgoing_mail
+                SET status = 'failed', last_error = $2, lease_until = NULL, send_started_at = NULL
+                WHERE mail_id = $1
+                RETURNING message_id
+            )
+            UPDATE requests SET send_status = 'failed', send_error = $2
+            WHERE message_id = (SELECT message_id FROM failed)
+            """,
+            mail["mail_id"],
+            error,
+        )
+        return True
+
+    await conn.execute(
+        """
+        UPDATE outgoing_mail
+        SET status = 'pending',
+            last_error = $2,
+            lease_until = NULL,
+            send_started_at = NULL,
+            next_attempt_at = now() + make_interval(secs => $3)
+        WHERE mail_id = $1
+        """,
+        mail["mail_id"],
+        error,
+        retry_delay(mail["attempts"]),
+    )
+    return False
+
+
+class OutboxSender:
+    """
+    Фоновые отправители очереди outgoing_mail поверх общего пула SMTP-соединений.
+    Отправка равномерно растягивается до OUTBOX_RATE_PER_MINUTE писем в минуту.
+    Обращения отправленных писем закрываются пачками по message_id (flush).
+    """
+
+    def __init__(
+        self,
+        db_pool,
+        smtp_pool: SmtpConnectionPool,
+        senders: int = OUTBOX_SENDERS,
+        rate_per_minute: float = OUTBOX_RATE_PER_MINUTE,
+    ):
+        self.db_pool = db_pool
+        self.smtp_pool = smtp_pool
+        self.senders = senders
+        self.interval = 60.0 / rate_per_minute if rate_per_minute > 0 else 0.0
+        self._next_slot = 0.0
+        self._rate_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._sent: List[str] = []
+        self._flush_lock = asyncio.Lock()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.senders)]
+        self._tasks.append(asyncio.create_task(self.smtp_pool.keepalive()))
+        self._tasks.append(asyncio.create_task(self._flush_loop()))
+
+    async def flush(self):
+        async with self._flush_lock:
+            sent, self._sent = self._sent, []
+            if not sent:
+                return
+            try:
+                async with self.db_pool.acquire() as conn:
+                    await close_requests(conn, sent)
+            except Exception:
+                # Не теряем отправленные: закроются при следующем сбросе
+                self._sent = sent + self._sent
+                raise
+
+    async def _flush_loop(self):
+        try:
+            async with self.db_pool.acquire() as conn:
+                closed = await close_unrecorded_requests(conn)
+            if closed:
+                logger.info(f"Закрыто обращений, отправленных до перезапуска: {closed}")
+        except Exception as e:
+            logger.error(f"Ошибка закрытия обращений после перезапуска: {e}")
+        while True:
+            await asyncio.sleep(OUTBOX_CLOSE_FLUSH_SECONDS)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка закрытия обращений с отправленными ответами: {e}")
+
+    def notify(self):
+        """Новое письмо в очереди: не ждать следующего опроса."""
+        self._wakeup.set()
+
+    async def _wait_rate_slot(self):
+        async with self._rate_lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _wait_for_mail(self):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _run(self):
+        while True:
+            try:
+                async with self.db_pool.acquire() as conn:
+                    mail = await claim_mail(conn)
+                if mail is None:
+                    await self._wait_for_mail()
+                    continue
+
+                await self._wait_rate_slot()
+                await self._send(mail)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка отправителя очереди писем: {e}")
+                await asyncio.sleep(OUTBOX_POLL_SECONDS)
+
+    async def _mark_sent(self, mail: Dict[str, Any]):
+        # Письмо уже ушло: если 'sent' не записать, после аренды оно уйдет повторно
+        for attempt in range(1, OUTBOX_MARK_SENT_ATTEMPTS + 1):
+            try:
+                async with self.db_pool.acquire() as conn:
+                    await mark_sent(conn, mail)
+                break
+            except Exception as e:
+                if attempt == OUTBOX_MARK_SENT_ATTEMPTS:
+                    OUTBOX_SENT.labels("unrecorded").inc()
+                    logger.error(
+                        f"Письмо {mail['mail_id']} отправлено, но не отмечено как sent: {e}. "
+                        "Повторная отправка уйдет с тем же Message-ID"
+                    )
+                    return
+                await asyncio.sleep(retry_delay(attempt))
+
+        if mail.get("message_id"):
+            self._sent.append(mail["message_id"])
+            if len(self._sent) >= OUTBOX_CLOSE_BATCH_SIZE:
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logger.error(f"Ошибка закрытия обращений с отправленными ответами: {e}")
+
+    async def _send(self, mail: Dict[str, Any]):
+        payload = mail["payload"]
+        if mail.get("send_started_at"):
+            logger.warning(
+                f"Письмо {mail['mail_id']}: прошлая попытка прервана после начала отправки, "
+                f"возможен дубликат (Message-ID {mail.get('smtp_message_id')})"
+            )
+        try:
+            async with self.db_pool.acquire() as conn:
+                smtp_message_id = await mark_sending(conn, mail)
+            message = build_message(**payload)
+            message["Message-ID"] = smtp_message_id
+            await self.smtp_pool.send(message)
+        except Exception as e:
+            async with self.db_pool.acquire() as conn:
+                failed = await mark_failed(conn, mail, str(e))
+            OUTBOX_SENT.labels("failed" if failed else "retry").inc()
+            logger.warning(f"Письмо {mail['mail_id']} не отправлено (попытка {mail['attempts']}): {e}")
+            return
+
+        await self._mark_sent(mail)
+        OUTBOX_SENT.labels("sent").inc()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Ошибка закрытия обращений с отправленными ответами: {e}")
+        await self.smtp_pool.close()
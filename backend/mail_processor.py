@@ -63,7 +63,7 @@ async def process_letter(letter_text: str, message_id: str):
 
 
 if __name__ == "__main__":
-    msgs = fetch_emails(1, "output")
+    msgs = fetch_emails(limit=1)
     letter_text = ""
     for msg in msgs:
         letter_text += f"Почта: {msg['sender_email']}\n"
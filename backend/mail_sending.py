@@ -5,16 +5,150 @@ from email.mime.base import MIMEBase
 from email import encoders
 from email.header import Header
 from typing import List, Optional, Tuple
+import asyncio
 import os
+import time
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
 import aiosmtplib
+from metrics import observe_stage
 
 load_dotenv()
 
-SMTP_SERVER = "smtp.mail.ru"
+SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.mail.ru")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
 SMTP_USER = os.getenv("SMTP_EMAIL", "")
 SMTP_PASS = os.getenv("EXTERNAL_PASS", "")
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
+# Простаивающие соединения проверяются NOOP, чтобы сервер не закрыл их по таймауту
+SMTP_KEEPALIVE_SECONDS = float(os.getenv("SMTP_KEEPALIVE_SECONDS", "60"))
+
+
+def smtp_config() -> dict:
+    return {
+        "hostname": SMTP_SERVER,
+        "port": SMTP_PORT,
+        "use_tls": True,
+        "timeout": 30,
+        "validate_certs": True,
+    }
+
+
+def build_message(
+    to_emails: List[str],
+    subject: str,
+    body: str,
+    from_email: Optional[str] = None,
+    html_body: Optional[str] = None,
+    message_id: Optional[str] = None,
+    reply_to_thread: bool = False,
+) -> MIMEMultipart:
+    msg = MIMEMultipart("mixed")
+    msg["Subject"] = Header(subject, "utf-8")
+    msg["From"] = from_email or SMTP_USER
+    msg["To"] = ", ".join(to_emails)
+
+    if reply_to_thread and message_id:
+        msg["In-Reply-To"] = message_id
+        msg["References"] = message_id
+
+    if html_body:
+        msg_alt = MIMEMultipart("alternative")
+        msg_alt.attach(MIMEText(body, "plain", "utf-8"))
+        msg_alt.attach(MIMEText(html_body, "html", "utf-8"))
+        msg.attach(msg_alt)
+    else:
+        msg.attach(MIMEText(body, "plain", "utf-8"))
+    return msg
+
+
+class SmtpConnectionPool:
+    """
+    Долгоживущие авторизованные SMTP-соединения: TLS и LOGIN выполняются
+    один раз на соединение, а не на каждое письмо.
+    """
+
+    def __init__(self, size: int = SMTP_POOL_SIZE):
+        self.size = size
+        self._idle: List[Tuple[aiosmtplib.SMTP, float]] = []
+        self._semaphore = asyncio.Semaphore(size)
+
+    async def _connect(self) -> aiosmtplib.SMTP:
+        client = aiosmtplib.SMTP(**smtp_config())
+        await client.connect()
+        await client.login(SMTP_USER, SMTP_PASS)
+        return client
+
+    @staticmethod
+    async def _quit(client: aiosmtplib.SMTP):
+        try:
+            await client.quit()
+        except Exception:
+            client.close()
+
+    async def _take_idle(self) -> Optional[aiosmtplib.SMTP]:
+        while self._idle:
+            client, last_used = self._idle.pop()
+            if not client.is_connected:
+                continue
+            if time.monotonic() - last_used > SMTP_KEEPALIVE_SECONDS:
+                try:
+                    await client.noop()
+                except Exception:
+                    await self._quit(client)
+                    continue
+            return client
+        return None
+
+    def _release(self, client: aiosmtplib.SMTP):
+        if client.is_connected and len(self._idle) < self.size:
+            self._idle.append((client, time.monotonic()))
+        else:
+            client.close()
+
+    @asynccontextmanager
+    async def connection(self):
+        async with self._semaphore:
+            client = await self._take_idle() or await self._connect()
+            try:
+                yield client
+            except (aiosmtplib.SMTPServerDisconnected, ConnectionError):
+                client.close()
+                raise
+            except Exception:
+                # Ошибка адресата или письма, соединение остается рабочим
+                self._release(client)
+                raise
+            else:
+                self._release(client)
+
+    async def send(self, msg):
+        """Отправляет письмо; при обрыве соединения один раз переподключается."""
+        with observe_stage("smtp_send"):
+            try:
+                async with self.connection() as client:
+                    await client.send_message(msg)
+            except (aiosmtplib.SMTPServerDisconnected, ConnectionError):
+                async with self.connection() as client:
+                    await client.send_message(msg)
+
+    async def keepalive(self):
+        """Фоновая задача: NOOP по простаивающим соединениям."""
+        while True:
+            await asyncio.sleep(SMTP_KEEPALIVE_SECONDS)
+            idle, self._idle = self._idle, []
+            for client, _ in idle:
+                try:
+                    await client.noop()
+                    self._release(client)
+                except Exception:
+                    client.close()
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for client, _ in idle:
+            await self._quit(client)
 
 
 async def send_email(
@@ -25,39 +159,21 @@ async def send_email(
     html_body: Optional[str] = None,
     message_id: Optional[str] = None,
     reply_to_thread: bool = False,
+    pool: Optional[SmtpConnectionPool] = None,
 ) -> bool:
-    from_email = from_email or SMTP_USER
-
+    """Отправка одного письма. С pool соединение берется из пула."""
     try:
-        msg = MIMEMultipart("mixed")
-        msg["Subject"] = Header(subject, "utf-8")
-        msg["From"] = from_email
-        msg["To"] = ", ".join(to_emails)
-
-        if reply_to_thread and message_id:
-            msg["In-Reply-To"] = message_id
-            msg["References"] = message_id
-
-        if html_body:
-            msg_alt = MIMEMultipart("alternative")
-            msg.attach(MIMEText(body, "plain", "utf-8"))
-            msg_alt.attach(MIMEText(body, "plain", "utf-8"))
-            msg_alt.attach(MIMEText(html_body, "html", "utf-8"))
-            msg.attach(msg_alt)
-        else:
-            msg.attach(MIMEText(body, "plain", "utf-8"))
-
-        smtp_config = {
-            "hostname": SMTP_SERVER,
-            "port": 465,
-            "use_tls": True,
-            "timeout": 30,
-            "validate_certs": True,
-        }
+        msg = build_message(
+            to_emails, subject, body, from_email, html_body, message_id, reply_to_thread
+        )
+        if pool is not None:
+            await pool.send(msg)
+            return True
 
-        async with aiosmtplib.SMTP(**smtp_config) as server:
-            await server.login(SMTP_USER, SMTP_PASS)
-            await server.send_message(msg)
+        with observe_stage("smtp_send"):
+            async with aiosmtplib.SMTP(**smtp_config()) as server:
+                await server.login(SMTP_USER, SMTP_PASS)
+                await server.send_message(msg)
 
         return True
 
@@ -67,7 +183,6 @@ async def send_email(
 
 
 if __name__ == "__main__":
-    import asyncio
 
     async def test_email():
         success = await send_email(
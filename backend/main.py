@@ -1,20 +1,37 @@
 from contextlib import asynccontextmanager
-from fastapi import Depends, FastAPI, HTTPException, Query, Response, status
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from datetime import date, datetime
+import asyncio
 import csv
+import gzip
 import io
-from typing import Annotated, Optional, List, Union
-
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from mail_fetch import fetch_emails
-from mail_sending import send_email
-import asyncpg
-import bcrypt
+import json
+import logging
+from typing import Annotated, Any, Dict, Optional, List, Union
+
+from fastapi.security import (
+    HTTPAuthorizationCredentials,
+    HTTPBasic,
+    HTTPBasicCredentials,
+    HTTPBearer,
+)
+from mail_fetch import ImapSessionPool, fetch_attachment, fetch_mailbox
+from mail_outbox import OutboxSender, enqueue_mail, enqueue_mails
+from mail_sending import SmtpConnectionPool
+from request_feed import STREAM_KEEPALIVE_SECONDS, RequestFeed
+from auth import (
+    AUTH_TOKEN_TTL_SECONDS,
+    ActiveUserCache,
+    CredentialCache,
+    check_password,
+    issue_token,
+    verify_token,
+)
 from openpyxl import Workbook
+from prometheus_client import make_asgi_app
 from openpyxl.styles import Font, Alignment, PatternFill
-import os
 import uvicorn
 from pydantic_models import (
     AddNewRow,
@@ -22,14 +39,133 @@ from pydantic_models import (
     RequestResponse,
     FetchedMailsResponse,
     EmailRequest,
+    BulkEmailRequest,
+    BulkRequestUpdate,
+    LoginRequest,
+)
+from utils import dumps_json, normalize_task_status, parse_date_string
+from db_pools import ReplicaPools, TimedPool, connect_kwargs
+from metrics import observe_stage
+from opentelemetry.propagate import extract
+from tracing import current_trace_id, load_trace, setup_tracing, tracer
+from cfg import (
+    DB_EXPORT_PAGE_THRESHOLD,
+    DB_EXPORT_POOL_MAX,
+    DB_READ_POOL_MAX,
+    DB_READ_POOL_MIN,
+    DB_WRITE_POOL_MAX,
+    DB_WRITE_POOL_MIN,
+    LLM_BASE_URLS,
+    MAILBOX_SYNC_SECONDS,
+    POSTGRES_HOSTNAME,
+    POSTGRES_REPLICA_HOSTNAMES,
+    RESPONSE_GZIP_LEVEL,
+    RESPONSE_GZIP_MIN_BYTES,
+    VECTOR_BACKEND,
 )
-from utils import parse_date_string, date_to_str
 
-POSTGRES_DB_NAME = os.getenv("POSTGRES_DB", "postgres")
-POSTGRES_DB_USER = os.getenv("POSTGRES_USER", "postgres")
-POSTGRES_DB_PASS = os.getenv("POSTGRES_PASSWORD", "postgres")
-POSTGRES_HOSTNAME = os.getenv("POSTGRES_HOSTNAME", "postgres")
-POSTGRES_PORT = os.getenv("POSTGRES_PORT", "5432")
+logger = logging.getLogger(__name__)
+
+
+def build_request_filters(
+    full_name: Optional[str] = None,
+    object_name: Optional[str] = None,
+    phone: Optional[str] = None,
+    email: Optional[str] = None,
+    emotion: Optional[str] = None,
+    issue: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    task_status: Optional[str] = None,
+    device_type: Optional[str] = None,
+    factory_number: Optional[str] = None,
+):
+    """WHERE для выборки обращений и его параметры ($1..$11)"""
+    parsed_date_from = parse_date_string(date_from) if date_from else None
+    parsed_date_to = parse_date_string(date_to) if date_to else None
+
+    params = [
+        f"%{full_name}%" if full_name else None,
+        f"%{object_name}%" if object_name else None,
+        phone,
+        f"%{email}%" if email else None,
+        emotion,
+        f"%{issue}%" if issue else None,
+        parsed_date_from,
+        parsed_date_to,
+        normalize_task_status(task_status) if task_status else None,
+        device_type,
+        factory_number,
+    ]
+    # Даты сравниваются без "IS NULL OR", иначе планировщик не отсекает секции по месяцам
+    date_from_filter = "req_date >= $7::date" if parsed_date_from else "$7::date IS NULL"
+    date_to_filter = "req_date < $8::date + 1" if parsed_date_to else "$8::date IS NULL"
+    where = f"""
+        WHERE ($1::text IS NULL OR LOWER(full_name) LIKE LOWER($1))
+          AND ($2::text IS NULL OR LOWER(object_name) LIKE LOWER($2))
+          AND ($3::text IS NULL OR phone ILIKE $3)
+          AND ($4::text IS NULL OR LOWER(email) LIKE LOWER($4))
+          AND ($5::text IS NULL OR emotion = $5)
+          AND ($6::text IS NULL OR LOWER(question_summary) LIKE LOWER($6))
+          AND {date_from_filter}
+          AND {date_to_filter}
+          AND ($9::text IS NULL OR task_status = $9::task_statuses)
+          AND ($10::text IS NULL OR device_type = $10)
+          AND ($11::text IS NULL OR factory_number = $11)
+    """
+    return where, params
+
+
+# Поля RequestResponse -> выражения SQL: строки сразу приходят в форме ответа API
+RESPONSE_COLUMNS = {
+    "date": "to_char(req_date AT TIME ZONE 'UTC', 'YYYY-MM-DD')",
+    "fullName": "COALESCE(full_name, '')",
+    "object": "COALESCE(object_name, '')",
+    "phone": "COALESCE(phone, '')",
+    "email": "COALESCE(email, '')",
+    "factoryNumber": "COALESCE(factory_number, '')",
+    "deviceType": "COALESCE(device_type, '')",
+    "emotion": "emotion",
+    "issue": "COALESCE(question_summary, '')",
+    "llm_answer": "COALESCE(llm_answer, '')",
+    "message_id": "COALESCE(message_id, '')",
+    "id": "request_id",
+    "task_status": "COALESCE(task_status::text, 'OPEN')",
+    "send_status": "send_status",
+}
+
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """fields=id,date,fullName -> список полей; id нужен клиенту всегда"""
+    if not fields:
+        return None
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in RESPONSE_COLUMNS]
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Неизвестные поля: {', '.join(unknown)}"
+        )
+    if "id" not in names:
+        names.insert(0, "id")
+    return names
+
+
+def select_columns(fields: Optional[List[str]] = None) -> str:
+    return ", ".join(
+        f'{RESPONSE_COLUMNS[name]} AS "{name}"' for name in fields or RESPONSE_COLUMNS
+    )
+
+
+async def json_response(request: Request, data: Any) -> Response:
+    """JSON без повторной валидации через response_model, крупные ответы в gzip"""
+    body = dumps_json(data)
+    headers = {}
+    if len(body) >= RESPONSE_GZIP_MIN_BYTES and "gzip" in request.headers.get(
+        "accept-encoding", ""
+    ):
+        body = await asyncio.to_thread(gzip.compress, body, RESPONSE_GZIP_LEVEL)
+        headers = {"Content-Encoding": "gzip", "Vary": "Accept-Encoding"}
+    return Response(body, media_type="application/json", headers=headers)
 
 
 async def get_filtered_requests(
@@ -45,92 +181,95 @@ async def get_filtered_requests(
     task_status: Optional[str],
     limit: Optional[int] = None,
     offset: Optional[int] = None,
-) -> List[RequestResponse]:
-    """Возвращает отфильтрованные запросы из БД"""
+    device_type: Optional[str] = None,
+    factory_number: Optional[str] = None,
+    ids: Optional[List[int]] = None,
+    fields: Optional[List[str]] = None,
+    include_archive: bool = False,
+) -> List[Dict[str, Any]]:
+    """Возвращает отфильтрованные запросы из БД словарями с ключами RequestResponse"""
     if not db_pool:
         raise HTTPException(status_code=503, detail="DB not ready")
 
-    parsed_date_from = parse_date_string(date_from) if date_from else None
-    parsed_date_to = parse_date_string(date_to) if date_to else None
-
-    params = [
-        f"%{full_name}%" if full_name else None,
-        f"%{object_name}%" if object_name else None,
+    where, params = build_request_filters(
+        full_name,
+        object_name,
         phone,
-        f"%{email}%" if email else None,
+        email,
         emotion,
-        f"%{issue}%" if issue else None,
-        parsed_date_from,
-        parsed_date_to,
-        task_status.upper() if task_status else None,
-    ]
+        issue,
+        date_from,
+        date_to,
+        task_status,
+        device_type,
+        factory_number,
+    )
 
     async with db_pool.acquire() as conn:
-        base_query = """
-            SELECT * FROM requests
-            WHERE ($1::text IS NULL OR LOWER(full_name) LIKE LOWER($1))
-              AND ($2::text IS NULL OR LOWER(object_name) LIKE LOWER($2))
-              AND ($3::text IS NULL OR phone ILIKE $3)
-              AND ($4::text IS NULL OR LOWER(email) LIKE LOWER($4))
-              AND ($5::text IS NULL OR emotion = $5)
-              AND ($6::text IS NULL OR LOWER(question_summary) LIKE LOWER($6))
-              AND ($7::date IS NULL OR req_date >= $7)
-              AND ($8::date IS NULL OR req_date <= $8)
-              AND ($9::text IS NULL OR task_status = $9::task_statuses)
-        """
+        table = "requests_all" if include_archive else "requests"
+        base_query = f"SELECT {select_columns(fields)} FROM {table}" + where
+        if ids:
+            # Дочитывание изменений из /api/stream
+            params.append(ids)
+            base_query += f" AND request_id = ANY(${len(params)}::int[])"
 
         if limit is not None and offset is not None:
-            base_query += " ORDER BY request_id ASC LIMIT $10 OFFSET $11"
+            base_query += f" ORDER BY request_id ASC LIMIT ${len(params) + 1} OFFSET ${len(params) + 2}"
             params.extend([limit, offset])
         else:
             base_query += " ORDER BY request_id ASC"
         rows = await conn.fetch(base_query, *params)
 
-        result = []
-        for row in rows:
-            print(row["llm_answer"])
-            result.append(
-                RequestResponse(
-                    id=row["request_id"],
-                    date=date_to_str(row["req_date"]),
-                    fullName=row["full_name"] or "",
-                    object=row["object_name"] or "",
-                    phone=row["phone"] or "",
-                    email=row["email"] or "",
-                    factoryNumber=row["factory_number"] or "",
-                    deviceType=row["device_type"] or "",
-                    emotion=row["emotion"],
-                    issue=row["question_summary"] or "",
-                    llm_answer=row["llm_answer"] or "",
-                    task_status=row["task_status"] or "OPEN",
-                    message_id=row["message_id"] or "",
-                )
-            )
-        return result
+    return [dict(row) for row in rows]
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     try:
-        pool = await asyncpg.create_pool(
-            user=POSTGRES_DB_USER,
-            password=POSTGRES_DB_PASS,
-            database=POSTGRES_DB_NAME,
-            host=POSTGRES_HOSTNAME,
-            port=POSTGRES_PORT,
-            min_size=2,
-            max_size=10,
+        # Запись и все, что должно видеть свежие данные, идет в основную БД
+        pool = await TimedPool.create(
+            "api_write", POSTGRES_HOSTNAME, DB_WRITE_POOL_MIN, DB_WRITE_POOL_MAX
         )
         app.state.db_pool = pool
+        app.state.read_pool = await ReplicaPools.create(
+            "api_read",
+            POSTGRES_REPLICA_HOSTNAMES or [POSTGRES_HOSTNAME],
+            DB_READ_POOL_MIN,
+            DB_READ_POOL_MAX,
+        )
+        # Выгрузки ограничены своим пулом и не отнимают соединения у записи
+        app.state.export_pool = await ReplicaPools.create(
+            "api_export",
+            POSTGRES_REPLICA_HOSTNAMES or [POSTGRES_HOSTNAME],
+            1,
+            DB_EXPORT_POOL_MAX,
+        )
+        app.state.imap_pool = ImapSessionPool(size=2)
+        app.state.mailbox_sync_lock = asyncio.Lock()
+        app.state.outbox = OutboxSender(pool, SmtpConnectionPool())
+        app.state.outbox.start()
+        app.state.feed = RequestFeed(connect_kwargs())
+        app.state.feed.start()
+        app.state.mailbox_sync_task = (
+            asyncio.create_task(run_mailbox_sync(pool)) if MAILBOX_SYNC_SECONDS > 0 else None
+        )
 
     except Exception as e:
         raise e
 
     yield
 
+    if app.state.mailbox_sync_task:
+        app.state.mailbox_sync_task.cancel()
+    await app.state.feed.stop()
+    await app.state.outbox.stop()
+    app.state.imap_pool.close()
+    await app.state.export_pool.close()
+    await app.state.read_pool.close()
     await app.state.db_pool.close()
 
 
+setup_tracing("api")
 app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
@@ -141,9 +280,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.mount("/metrics", make_asgi_app())
+
 
 @app.get("/api/requests", response_model=List[RequestResponse])
 async def get_requests(
+    request: Request,
     page: int = Query(1, ge=1),
     limit: int = Query(10, ge=1, le=1000),
     full_name: Optional[str] = Query(None),
@@ -155,12 +297,23 @@ async def get_requests(
     date_from: Optional[str] = Query(None),
     date_to: Optional[str] = Query(None),
     task_status: Optional[str] = Query(None),
+    device_type: Optional[str] = Query(None),
+    factory_number: Optional[str] = Query(None),
+    ids: Optional[List[int]] = Query(None),
+    fields: Optional[str] = Query(None, description="Поля ответа через запятую"),
 ):
     """Получить список запросов с фильтрами и пагинацией"""
     offset = (page - 1) * limit
+    if ids:
+        # Дочитывание после уведомления: реплика может еще не получить изменение
+        db_pool = app.state.db_pool
+    elif limit > DB_EXPORT_PAGE_THRESHOLD:
+        db_pool = app.state.export_pool
+    else:
+        db_pool = app.state.read_pool
 
     result = await get_filtered_requests(
-        db_pool=app.state.db_pool,
+        db_pool=db_pool,
         full_name=full_name,
         object_name=object_name,
         phone=phone,
@@ -172,12 +325,95 @@ async def get_requests(
         task_status=task_status,
         limit=limit,
         offset=offset,
+        device_type=device_type,
+        factory_number=factory_number,
+        ids=ids,
+        fields=parse_fields(fields),
+    )
+    return await json_response(request, result)
+
+
+FACET_COLUMNS = ["device_type", "object_name", "emotion", "task_status"]
+
+
+@app.get("/api/requests/facets")
+async def get_request_facets(
+    full_name: Optional[str] = Query(None),
+    object_name: Optional[str] = Query(None),
+    phone: Optional[str] = Query(None),
+    email: Optional[str] = Query(None),
+    emotion: Optional[str] = Query(None),
+    issue: Optional[str] = Query(None),
+    date_from: Optional[str] = Query(None),
+    date_to: Optional[str] = Query(None),
+    task_status: Optional[str] = Query(None),
+    device_type: Optional[str] = Query(None),
+    factory_number: Optional[str] = Query(None),
+):
+    """
+    Значения и количество обращений по прибору, объекту, эмоции и статусу.
+    Без фильтров берется из материализованного представления request_facets
+    (scheduler пересчитывает его раз в FACETS_REFRESH_SECONDS, счетчики могут
+    отставать), с фильтрами считается одним проходом GROUPING SETS.
+    """
+    db_pool = app.state.read_pool
+    if not db_pool:
+        raise HTTPException(status_code=503, detail="DB not ready")
+
+    where, params = build_request_filters(
+        full_name,
+        object_name,
+        phone,
+        email,
+        emotion,
+        issue,
+        date_from,
+        date_to,
+        task_status,
+        device_type,
+        factory_number,
     )
-    return result
+    facets = {column: [] for column in FACET_COLUMNS}
+
+    async with db_pool.acquire() as conn:
+        if all(param is None for param in params):
+            rows = await conn.fetch(
+                """
+                SELECT facet, value, count FROM request_facets
+                WHERE count > 0
+                ORDER BY facet, count DESC, value
+                """
+            )
+        else:
+            rows = await conn.fetch(
+                f"""
+                SELECT facet, value, count FROM (
+                    SELECT
+                        CASE
+                            WHEN GROUPING(device_type) = 0 THEN 'device_type'
+                            WHEN GROUPING(object_name) = 0 THEN 'object_name'
+                            WHEN GROUPING(emotion) = 0 THEN 'emotion'
+                            ELSE 'task_status'
+                        END AS facet,
+                        COALESCE(device_type, object_name, emotion, task_status::text) AS value,
+                        count(*) AS count
+                    FROM requests
+                    {where}
+                    GROUP BY GROUPING SETS ((device_type), (object_name), (emotion), (task_status))
+                ) f
+                WHERE value IS NOT NULL
+                ORDER BY facet, count DESC, value
+                """,
+                *params,
+            )
+
+    for row in rows:
+        facets[row["facet"]].append({"value": row["value"], "count": row["count"]})
+    return facets
 
 
 @app.post("/api/requests", response_model=AddNewRow)
-async def create_request(request_data: RequestCreate):
+async def create_request(request_data: RequestCreate, request: Request):
     db_pool = app.state.db_pool
     if not db_pool:
         raise HTTPException(status_code=503, detail="DB not ready")
@@ -185,85 +421,490 @@ async def create_request(request_data: RequestCreate):
     raw_date = request_data.date
     parsed_date = parse_date_string(raw_date)
 
-    async with db_pool.acquire() as conn:
+    # Продолжаем трейс письма, начатый в scheduler (заголовок traceparent)
+    with tracer.start_as_current_span(
+        "create_request", context=extract(request.headers)
+    ):
+        return await insert_request(db_pool, request_data, parsed_date)
+
+
+async def insert_request(db_pool, request_data: RequestCreate, parsed_date):
+    """
+    Вставляет обращение. Повторная вставка того же письма (воркер упал после
+    POST, но до завершения задачи) возвращает 409 с id уже созданного обращения.
+    """
+    message_id = request_data.message_id or ""
+    async with db_pool.acquire() as conn, conn.transaction():
+        if message_id:
+            claimed = await conn.fetchval(
+                """
+                INSERT INTO request_message_ids (message_id) VALUES ($1)
+                ON CONFLICT (message_id) DO NOTHING
+                RETURNING true
+                """,
+                message_id,
+            )
+            if not claimed:
+                existing_id = await conn.fetchval(
+                    "SELECT request_id FROM request_message_ids WHERE message_id = $1",
+                    message_id,
+                )
+                return JSONResponse(
+                    status_code=status.HTTP_409_CONFLICT,
+                    content={"id": existing_id, "detail": "Обращение по письму уже создано"},
+                )
+
         query = """
             INSERT INTO requests
-            (req_date, full_name, object_name, phone, email, factory_number, device_type, emotion, question_summary, llm_answer, task_status, message_id)
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)
+            (req_date, full_name, object_name, phone, email, factory_number, device_type, emotion, question_summary, llm_answer, task_status, message_id, trace_id)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13)
             RETURNING request_id
         """
-        row = await conn.fetchrow(
-            query,
-            parsed_date,
-            request_data.fullName,
-            request_data.object,
-            request_data.phone,
-            request_data.email,
-            request_data.factoryNumber,
-            request_data.deviceType,
-            request_data.emotion,
-            request_data.issue,
-            request_data.llm_answer,
-            request_data.task_status or "OPEN",
-            request_data.message_id or "",
-        )
+        with observe_stage("db_insert"):
+            row = await conn.fetchrow(
+                query,
+                parsed_date,
+                request_data.fullName,
+                request_data.object,
+                request_data.phone,
+                request_data.email,
+                request_data.factoryNumber,
+                request_data.deviceType,
+                request_data.emotion,
+                request_data.issue,
+                request_data.llm_answer,
+                request_data.task_status or "OPEN",
+                message_id,
+                current_trace_id(),
+            )
+        if message_id:
+            await conn.execute(
+                "UPDATE request_message_ids SET request_id = $2 WHERE message_id = $1",
+                message_id,
+                row["request_id"],
+            )
 
         return AddNewRow(id=row["request_id"])
 
 
-@app.get("/api/fetchMails", response_model=List[FetchedMailsResponse])
-async def get_mails():
-    msgs = fetch_emails(limit=10, save_attachments_dir="attachments")
-    return msgs
+# Поля BulkRequestUpdate -> колонки requests
+BULK_UPDATE_COLUMNS = {
+    "fullName": "full_name",
+    "object": "object_name",
+    "phone": "phone",
+    "email": "email",
+    "factoryNumber": "factory_number",
+    "deviceType": "device_type",
+    "emotion": "emotion",
+    "issue": "question_summary",
+    "llm_answer": "llm_answer",
+}
 
 
-@app.post("/api/sendMail")
-async def send_mail_endpoint(request: EmailRequest):
-    success = await send_email(
-        to_emails=request.to_emails,
-        subject=request.subject,
-        body=request.body,
-        html_body=request.html_body,
-        from_email=request.from_email,
-        message_id=request.message_id,
-        reply_to_thread=True,
+@app.patch("/api/requests/bulk")
+async def bulk_update_requests(update: BulkRequestUpdate):
+    """Меняет статус и поля сразу у многих обращений в одной транзакции"""
+    db_pool = app.state.db_pool
+    if not db_pool:
+        raise HTTPException(status_code=503, detail="DB not ready")
+
+    assignments = []
+    params: list = [update.ids]
+    for field, column in BULK_UPDATE_COLUMNS.items():
+        value = getattr(update, field)
+        if value is not None:
+            params.append(value)
+            assignments.append(f"{column} = ${len(params)}")
+    if update.task_status is not None:
+        params.append(update.task_status)
+        assignments.append(f"task_status = ${len(params)}::task_statuses")
+    if not assignments:
+        raise HTTPException(status_code=400, detail="Нет полей для изменения")
+
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            rows = await conn.fetch(
+                f"""
+                UPDATE requests SET {", ".join(assignments)}
+                WHERE request_id = ANY($1::int[])
+                RETURNING request_id
+                """,
+                *params,
+            )
+
+    updated = [row["request_id"] for row in rows]
+    return {
+        "updated": len(updated),
+        "ids": updated,
+        "missing": sorted(set(update.ids) - set(updated)),
+    }
+
+
+@app.get("/api/requests/{request_id}/trace")
+async def get_request_trace(request_id: int):
+    """Спаны обработки письма: от забора из почты до записи в БД"""
+    db_pool = app.state.read_pool
+    if not db_pool:
+        raise HTTPException(status_code=503, detail="DB not ready")
+
+    async with db_pool.acquire() as conn:
+        trace_id = await conn.fetchval(
+            "SELECT trace_id FROM requests WHERE request_id = $1", request_id
+        )
+    if not trace_id:
+        raise HTTPException(status_code=404, detail="Трейс для обращения не найден")
+
+    return {"trace_id": trace_id, "spans": await asyncio.to_thread(load_trace, trace_id)}
+
+
+# Ближайшие соседи письма обращения в vector_history (12-vector-store.sql).
+# <-> дает L2-расстояние, его квадрат переводится в косинусную близость
+# как в vector_base.distance_to_similarity: 1 - d^2 / 2
+SIMILAR_REQUESTS_SQL = """
+    WITH target AS (
+        SELECT h.embedding, h.message_id
+        FROM requests r
+        JOIN vector_history h ON h.message_id = r.message_id
+        WHERE r.request_id = $1
+        LIMIT 1
+    )
+    SELECT
+        r.request_id AS id,
+        to_char(r.req_date AT TIME ZONE 'UTC', 'YYYY-MM-DD') AS date,
+        r.device_type,
+        r.question_summary,
+        r.llm_answer,
+        r.task_status,
+        nearest.similarity
+    FROM target
+    CROSS JOIN LATERAL (
+        SELECT h.message_id, 1 - (h.embedding <-> target.embedding) ^ 2 / 2 AS similarity
+        FROM vector_history h
+        WHERE h.message_id IS DISTINCT FROM target.message_id
+        ORDER BY h.embedding <-> target.embedding
+        LIMIT $2
+    ) AS nearest
+    JOIN requests r ON r.message_id = nearest.message_id
+    ORDER BY nearest.similarity DESC
+"""
+
+
+@app.get("/api/requests/{request_id}/similar")
+async def get_similar_requests(request_id: int, limit: int = Query(5, ge=1, le=50)):
+    """Похожие обращения по истории ответов одним запросом к БД (VECTOR_BACKEND=pgvector)"""
+    if VECTOR_BACKEND != "pgvector":
+        raise HTTPException(
+            status_code=404, detail="Поиск похожих обращений доступен с VECTOR_BACKEND=pgvector"
+        )
+    db_pool = app.state.read_pool
+    if not db_pool:
+        raise HTTPException(status_code=503, detail="DB not ready")
+
+    rows = await db_pool.fetch(SIMILAR_REQUESTS_SQL, request_id, limit)
+    return [dict(row) for row in rows]
+
+
+def create_llm_pipeline():
+    from model_requester import LLMPipeline
+
+    return LLMPipeline(base_urls=LLM_BASE_URLS)
+
+
+llm_pipeline_lock = asyncio.Lock()
+
+
+async def get_llm_pipeline():
+    """
+    LLMPipeline создается лениво и в потоке: импорт загружает модель
+    эмбеддингов, это секунды, на которые нельзя останавливать event loop.
+    """
+    llm = getattr(app.state, "llm", None)
+    if llm is None:
+        async with llm_pipeline_lock:
+            llm = getattr(app.state, "llm", None)
+            if llm is None:
+                llm = await asyncio.to_thread(create_llm_pipeline)
+                app.state.llm = llm
+    return llm
+
+
+@app.get("/api/llm/endpoints")
+async def get_llm_endpoints():
+    """Задержка, ошибки и загрузка по каждому серверу LLM"""
+    llm = getattr(app.state, "llm", None)
+    if llm is None:
+        return []
+    return llm.endpoints.stats()
+
+
+@app.get("/api/db/pools")
+async def get_db_pools():
+    """Занятость пулов БД и ожидание свободного соединения"""
+    return [
+        app.state.db_pool.stats(),
+        *app.state.read_pool.stats(),
+        *app.state.export_pool.stats(),
+    ]
+
+
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    message = f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    if event:
+        message = f"event: {event}\n{message}"
+    return message
+
+
+@app.get("/api/stream")
+async def stream_requests(request: Request):
+    """
+    Server-Sent Events об изменениях обращений: {"op": "insert"|"update", "ids": [...]}.
+    После "reset" клиенту нужно перечитать текущую страницу целиком.
+    """
+    feed = app.state.feed
+    queue = feed.subscribe()
+
+    async def generate_events():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # Комментарий держит соединение через прокси
+                    yield ": keepalive\n\n"
+                    continue
+                yield sse_event(event, event=event["op"])
+        finally:
+            feed.unsubscribe(queue)
+
+    return StreamingResponse(
+        generate_events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
+
+@app.post("/api/requests/{request_id}/regenerate")
+async def regenerate_answer(request_id: int):
+    """Перегенерирует llm_answer и отдает токены через Server-Sent Events"""
     db_pool = app.state.db_pool
+    if not db_pool:
+        raise HTTPException(status_code=503, detail="DB not ready")
 
-    if success:
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow(
+            "SELECT device_type, question_summary, message_id FROM requests WHERE request_id = $1",
+            request_id,
+        )
+    if not row:
+        raise HTTPException(status_code=404, detail="Обращение не найдено")
+
+    query = row["question_summary"] or ""
+    if row["device_type"]:
+        query = f"Прибор: {row['device_type']}\n{query}"
+    llm = await get_llm_pipeline()
+    # Модуль уже загружен get_llm_pipeline
+    from model_requester import NoContextError
+
+    async def generate_tokens():
+        answer = ""
+        # В БД пишется только полностью полученный ответ; при ошибке
+        # клиент получает событие error, а сохраненный ответ не меняется
         try:
-            async with db_pool.acquire() as conn:
-                result = await conn.execute(
-                    """
-                    UPDATE requests 
-                    SET task_status = 'CLOSED'::task_statuses 
-                    WHERE message_id = $1
-                    """,
-                    request.message_id,
-                )
+            async for token in llm.stream_rag(query, message_id=row["message_id"]):
+                answer += token
+                yield sse_event({"token": token})
+        except NoContextError as e:
+            yield sse_event({"detail": str(e)}, event="error")
+            return
+        except Exception as e:
+            yield sse_event({"detail": f"Ошибка при обращении к нейросети: {e}"}, event="error")
+            return
+
+        async with db_pool.acquire() as conn:
+            await conn.execute(
+                "UPDATE requests SET llm_answer = $1 WHERE request_id = $2",
+                answer,
+                request_id,
+            )
+        yield sse_event({"id": request_id, "llm_answer": answer}, event="done")
 
-                rows_affected = result.split()[-1]
+    return StreamingResponse(
+        generate_tokens(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-                if int(rows_affected) == 0:
-                    import logging
 
-                    logging.warning(
-                        f"Письмо отправлено, но запись с message_id {request.message_id} не найдена в БД для обновления статуса."
+MAILBOX = "INBOX"
+
+
+async def sync_mailbox(db_pool) -> int:
+    """
+    Догружает в mailbox_messages письма новее последнего сохраненного UID.
+    IMAP и разбор писем выполняются в потоке, чтобы не блокировать event loop.
+    Если у ящика сменился UIDVALIDITY, старая копия удаляется: ее UID
+    относятся к прежней нумерации.
+    """
+    async with app.state.mailbox_sync_lock:
+        async with db_pool.acquire() as conn:
+            uidvalidity = await conn.fetchval(
+                "SELECT uidvalidity FROM mailbox_state WHERE mailbox = $1", MAILBOX
+            )
+            last_uid = await conn.fetchval("SELECT max(uid) FROM mailbox_messages")
+
+        current, msgs = await asyncio.to_thread(
+            fetch_mailbox,
+            limit=10,
+            since_uid=last_uid,
+            uidvalidity=uidvalidity,
+            session_pool=app.state.imap_pool,
+        )
+
+        async with db_pool.acquire() as conn, conn.transaction():
+            if current != uidvalidity:
+                if uidvalidity is not None:
+                    logger.warning(
+                        f"UIDVALIDITY ящика {MAILBOX} сменился ({uidvalidity} -> {current}), "
+                        "локальная копия загружается заново"
                     )
+                await conn.execute("DELETE FROM mailbox_messages")
+            await conn.execute(
+                """
+                INSERT INTO mailbox_state (mailbox, uidvalidity) VALUES ($1, $2)
+                ON CONFLICT (mailbox) DO UPDATE
+                SET uidvalidity = EXCLUDED.uidvalidity, synced_at = now()
+                """,
+                MAILBOX,
+                current,
+            )
+            if not msgs:
+                return 0
+            await conn.executemany(
+                """
+                INSERT INTO mailbox_messages (uid, message_id, letter)
+                VALUES ($1, $2, $3::jsonb)
+                ON CONFLICT (uid) DO NOTHING
+                """,
+                [
+                    (
+                        msg["uid"],
+                        msg["message_id"],
+                        json.dumps(msg, ensure_ascii=False, default=str),
+                    )
+                    for msg in msgs
+                ],
+            )
+        return len(msgs)
 
+
+async def run_mailbox_sync(db_pool):
+    """Фоновая догрузка почты: запросы /api/fetchMails не ждут IMAP."""
+    while True:
+        try:
+            await sync_mailbox(db_pool)
         except Exception as e:
-            import logging
+            logger.warning(f"Не удалось синхронизировать почтовый ящик: {e}")
+        await asyncio.sleep(MAILBOX_SYNC_SECONDS)
 
-            logging.error(f"Ошибка при обновлении статуса задачи в БД: {e}")
 
-        return {
-            "status": "success",
-            "message": f"Email отправлен на {len(request.to_emails)} адресов, статус задачи обновлен на CLOSED",
-            "recipients": request.to_emails,
-        }
-    else:
-        raise HTTPException(status_code=500, detail="Ошибка отправки email")
+@app.get("/api/fetchMails", response_model=List[FetchedMailsResponse])
+async def get_mails(
+    page: int = Query(1, ge=1),
+    limit: int = Query(10, ge=1, le=100),
+    refresh: bool = Query(False),
+):
+    """
+    Письма из локальной копии ящика, новые сначала. Копию обновляет фоновая
+    синхронизация, refresh - дополнительно догрузить новые из IMAP сейчас.
+    """
+    db_pool = app.state.db_pool
+    if not db_pool:
+        raise HTTPException(status_code=503, detail="DB not ready")
+
+    if refresh:
+        await sync_mailbox(db_pool)
+
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT letter FROM mailbox_messages ORDER BY uid DESC LIMIT $1 OFFSET $2",
+            limit,
+            (page - 1) * limit,
+        )
+    return [json.loads(row["letter"]) for row in rows]
+
+
+@app.get("/api/mails/{uid}/attachments/{section}")
+async def get_mail_attachment(uid: int, section: str):
+    """Вложение письма, загружается из IMAP при первом обращении"""
+    try:
+        info = await asyncio.to_thread(
+            fetch_attachment, uid, section, session_pool=app.state.imap_pool
+        )
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"IMAP error: {e}")
+
+    return FileResponse(
+        info["path"],
+        media_type=info["content_type"],
+        filename=info["filename"] or info["sha256"],
+    )
+
+
+def outgoing_payload(request: EmailRequest) -> dict:
+    return {
+        "to_emails": request.to_emails,
+        "subject": request.subject,
+        "body": request.body,
+        "html_body": request.html_body,
+        "from_email": request.from_email,
+        "message_id": request.message_id,
+        "reply_to_thread": True,
+    }
+
+
+@app.post("/api/sendMail", status_code=status.HTTP_202_ACCEPTED)
+async def send_mail_endpoint(request: EmailRequest):
+    """
+    Ставит письмо в очередь отправки. Статус отправки пишется в send_status
+    обращения, после успешной отправки обращение закрывается.
+    """
+    db_pool = app.state.db_pool
+    if not db_pool:
+        raise HTTPException(status_code=503, detail="DB not ready")
+
+    async with db_pool.acquire() as conn, conn.transaction():
+        mail_id = await enqueue_mail(conn, outgoing_payload(request))
+    app.state.outbox.notify()
+
+    return {
+        "status": "queued",
+        "mail_id": mail_id,
+        "message": f"Письмо на {len(request.to_emails)} адресов поставлено в очередь отправки",
+        "recipients": request.to_emails,
+    }
+
+
+@app.post("/api/sendMail/bulk", status_code=status.HTTP_202_ACCEPTED)
+async def send_mail_bulk(request: BulkEmailRequest):
+    """
+    Пачка ответов одним запросом: письма ставятся в очередь одной транзакцией
+    и уходят через общие SMTP-сессии отправителей очереди.
+    """
+    db_pool = app.state.db_pool
+    if not db_pool:
+        raise HTTPException(status_code=503, detail="DB not ready")
+
+    async with db_pool.acquire() as conn:
+        mail_ids = await enqueue_mails(conn, [outgoing_payload(item) for item in request.items])
+    app.state.outbox.notify()
+
+    return {
+        "status": "queued",
+        "mail_ids": mail_ids,
+        "message": f"{len(mail_ids)} писем поставлено в очередь отправки",
+    }
 
 
 @app.get("/api/getCsv")
@@ -277,57 +918,63 @@ async def get_table_csv(
     date_from: Optional[str] = Query(None),
     date_to: Optional[str] = Query(None),
     task_status: Optional[str] = Query(None),
+    device_type: Optional[str] = Query(None),
+    factory_number: Optional[str] = Query(None),
+    include_archive: bool = Query(False, description="Вместе с архивом закрытых обращений"),
 ):
     """Экспорт отфильтрованных запросов в CSV"""
-    db_pool = app.state.db_pool
+    db_pool = app.state.export_pool
     if not db_pool:
         raise HTTPException(status_code=503, detail="DB not ready")
 
     async def generate_csv():
-        async with db_pool.acquire() as conn:
-            headers = list(RequestResponse.model_fields.keys())
+        # Соединение берется на каждую пачку, чтобы не держать два из пула выгрузок
+        headers = list(RequestResponse.model_fields.keys())
+
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(headers)
+        yield output.getvalue()
+
+        batch_size = 5000
+        offset = 0
+
+        while True:
+            batch = await get_filtered_requests(
+                db_pool=db_pool,
+                full_name=full_name,
+                object_name=object_name,
+                phone=phone,
+                email=email,
+                emotion=emotion,
+                issue=issue,
+                date_from=date_from,
+                date_to=date_to,
+                task_status=task_status,
+                limit=batch_size,
+                offset=offset,
+                device_type=device_type,
+                factory_number=factory_number,
+                include_archive=include_archive,
+            )
+
+            if not batch:
+                break
+
+            csv_rows = []
+            for row in batch:
+                row_dict = row.dict() if hasattr(row, "dict") else dict(row)
+                csv_row = [str(row_dict.get(h, "")) for h in headers]
+                csv_rows.append(csv_row)
 
             output = io.StringIO()
             writer = csv.writer(output)
-            writer.writerow(headers)
+            writer.writerows(csv_rows)
             yield output.getvalue()
 
-            batch_size = 5000
-            offset = 0
-
-            while True:
-                batch = await get_filtered_requests(
-                    db_pool=db_pool,
-                    full_name=full_name,
-                    object_name=object_name,
-                    phone=phone,
-                    email=email,
-                    emotion=emotion,
-                    issue=issue,
-                    date_from=date_from,
-                    date_to=date_to,
-                    task_status=task_status,
-                    limit=batch_size,
-                    offset=offset,
-                )
-
-                if not batch:
-                    break
+            output.close()
 
-                csv_rows = []
-                for row in batch:
-                    row_dict = row.dict() if hasattr(row, "dict") else dict(row)
-                    csv_row = [str(row_dict.get(h, "")) for h in headers]
-                    csv_rows.append(csv_row)
-
-                output = io.StringIO()
-                writer = csv.writer(output)
-                writer.writerows(csv_rows)
-                yield output.getvalue()
-
-                output.close()
-
-                offset += batch_size
+            offset += batch_size
 
     filename = f"requests_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
 
@@ -352,9 +999,12 @@ async def get_table_excel(
     date_from: Optional[str] = Query(None),
     date_to: Optional[str] = Query(None),
     task_status: Optional[str] = Query(None),
+    device_type: Optional[str] = Query(None),
+    factory_number: Optional[str] = Query(None),
+    include_archive: bool = Query(False, description="Вместе с архивом закрытых обращений"),
 ):
     """Экспорт отфильтрованных запросов в Excel"""
-    db_pool = app.state.db_pool
+    db_pool = app.state.export_pool
     if not db_pool:
         raise HTTPException(status_code=503, detail="DB not ready")
 
@@ -393,6 +1043,9 @@ async def get_table_excel(
             task_status=task_status,
             limit=batch_size,
             offset=offset,
+            device_type=device_type,
+            factory_number=factory_number,
+            include_archive=include_archive,
         )
 
         if not batch:
@@ -446,7 +1099,10 @@ async def get_table_excel(
     )
 
 
-security = HTTPBasic()
+security = HTTPBasic(auto_error=False)
+bearer = HTTPBearer(auto_error=False)
+credential_cache = CredentialCache()
+active_users = ActiveUserCache()
 
 
 async def get_db_pool():
@@ -456,42 +1112,79 @@ async def get_db_pool():
     return app.state.db_pool
 
 
-async def get_current_username(
-    credentials: Annotated[HTTPBasicCredentials, Depends(security)],
-    db_pool=Depends(get_db_pool),
-):
-    """Проверяет пользователя в PostgreSQL"""
+def unauthorized() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Неверный логин или пароль",
+        headers={"WWW-Authenticate": "Basic"},
+    )
+
+
+async def verify_credentials(db_pool, login: str, password: str) -> str:
+    """Проверяет пользователя в PostgreSQL; успешные проверки кешируются"""
+    if credential_cache.check(login, password):
+        return login
 
     async with db_pool.acquire() as conn:
         row = await conn.fetchrow(
             "SELECT id, login, password_hash FROM users WHERE login = $1 AND is_active = true",
-            credentials.username,
+            login,
         )
 
-        if not row:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Неверный логин или пароль",
-                headers={"WWW-Authenticate": "Basic"},
-            )
+    if not row or not await check_password(password, row["password_hash"]):
+        credential_cache.discard(login)
+        raise unauthorized()
 
-        print("Пользователь найден")
+    credential_cache.add(login, password)
+    return row["login"]
 
-        current_password_bytes = credentials.password.encode("utf8")
-        stored_password_bytes = row["password_hash"].encode("utf8")
 
-        is_correct_password = bcrypt.checkpw(
-            current_password_bytes, stored_password_bytes
+async def is_user_active(db_pool, login: str) -> bool:
+    """Отзыв токенов отключенных пользователей; результат кешируется в active_users"""
+    if active_users.check(login):
+        return True
+    async with db_pool.acquire() as conn:
+        active = await conn.fetchval(
+            "SELECT true FROM users WHERE login = $1 AND is_active = true", login
         )
+    if not active:
+        active_users.discard(login)
+        return False
+    active_users.add(login)
+    return True
+
 
-        if not is_correct_password:
+async def get_current_username(
+    token: Annotated[Optional[HTTPAuthorizationCredentials], Depends(bearer)],
+    credentials: Annotated[Optional[HTTPBasicCredentials], Depends(security)],
+    db_pool=Depends(get_db_pool),
+):
+    """Bearer-токен из /api/login проверяется по подписи, Basic - по БД"""
+    if token is not None:
+        login = verify_token(token.credentials)
+        if login is None or not await is_user_active(db_pool, login):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Неверный логин или пароль",
-                headers={"WWW-Authenticate": "Basic"},
+                detail="Сессия истекла, войдите снова",
+                headers={"WWW-Authenticate": "Bearer"},
             )
-
-        return row["login"]
+        return login
+
+    if credentials is None:
+        raise unauthorized()
+    return await verify_credentials(db_pool, credentials.username, credentials.password)
+
+
+@app.post("/api/login")
+async def login(request: LoginRequest, db_pool=Depends(get_db_pool)):
+    """Выдает подписанный токен сессии для заголовка Authorization: Bearer"""
+    username = await verify_credentials(db_pool, request.login, request.password)
+    return {
+        "access_token": issue_token(username),
+        "token_type": "bearer",
+        "expires_in": AUTH_TOKEN_TTL_SECONDS,
+        "username": username,
+    }
 
 
 @app.get("/users/me")
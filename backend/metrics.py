@@ -0,0 +1,133 @@
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from tracing import tracer
+
+# Этапы: imap_fetch, mime_parse, attachment_fetch, attachment_text, normalize, embedding, history_lookup, retrieval,
+# db_insert, smtp_send
+STAGE_SECONDS = Histogram(
+    "mail_pipeline_stage_seconds",
+    "Длительность этапов обработки письма",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+LLM_SECONDS = Histogram(
+    "mail_pipeline_llm_seconds",
+    "Длительность запроса к LLM",
+    ["call", "endpoint"],
+    buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300),
+)
+LLM_TOKENS = Counter(
+    "mail_pipeline_llm_tokens_total",
+    "Токены в запросах к LLM",
+    ["call", "kind"],
+)
+LLM_ERRORS = Counter(
+    "mail_pipeline_llm_errors_total",
+    "Ошибки запросов к LLM",
+    ["call", "endpoint"],
+)
+LLM_OUTSTANDING = Gauge(
+    "mail_pipeline_llm_outstanding",
+    "Запросы к LLM в работе",
+    ["endpoint"],
+)
+
+NORMALIZE_CHARS = Counter(
+    "mail_pipeline_normalize_chars_total",
+    "Символы текста писем до и после нормализации",
+    ["kind"],
+)
+
+ATTACHMENT_RESULTS = Counter(
+    "mail_pipeline_attachment_results_total",
+    "Разбор вложений: cached, extracted, skipped, timeout, error",
+    ["result"],
+)
+
+OUTBOX_SENT = Counter(
+    "mail_pipeline_outbox_total",
+    "Исходящие письма: sent, retry, failed, unrecorded (отправлено, но статус не записан)",
+    ["result"],
+)
+
+AUTO_DISPATCH = Counter(
+    "mail_pipeline_auto_dispatch_total",
+    "Автоответы: queued - в очереди outgoing_mail, failed - не поставлены",
+    ["result"],
+)
+
+HISTORY_CACHE = Counter(
+    "mail_pipeline_history_cache_total",
+    "Поиск готового ответа в истории писем",
+    ["result"],
+)
+DUPLICATE_LETTERS = Counter(
+    "mail_pipeline_duplicate_letters_total",
+    "Повторно полученные письма, уже стоящие в очереди",
+)
+JOB_FAILURES = Counter(
+    "mail_pipeline_job_failures_total",
+    "Ошибки обработки писем",
+    ["stage", "outcome"],
+)
+LETTERS_PROCESSED = Counter(
+    "mail_pipeline_letters_processed_total",
+    "Успешно обработанные письма",
+)
+
+QUEUE_DEPTH = Gauge(
+    "mail_pipeline_queue_depth",
+    "Письма в очереди по приоритетам",
+    ["priority"],
+)
+QUEUE_MAX_WAIT = Gauge(
+    "mail_pipeline_queue_max_wait_seconds",
+    "Возраст самого старого письма в очереди",
+    ["priority"],
+)
+QUEUE_START_WAIT = Gauge(
+    "mail_pipeline_queue_start_wait_seconds",
+    "Ожидание письма до начала обработки за последний час: avg и max",
+    ["priority", "stat"],
+)
+
+DB_POOL_SIZE = Gauge("mail_pipeline_db_pool_size", "Соединения в пуле БД", ["pool"])
+DB_POOL_IDLE = Gauge(
+    "mail_pipeline_db_pool_idle", "Свободные соединения в пуле БД", ["pool"]
+)
+DB_POOL_WAIT = Histogram(
+    "mail_pipeline_db_pool_wait_seconds",
+    "Ожидание свободного соединения в пуле БД",
+    ["pool"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+
+@contextmanager
+def observe_stage(stage: str):
+    """Замеряет этап в гистограмму и пишет его дочерним спаном текущего трейса."""
+    started = time.perf_counter()
+    with tracer.start_as_current_span(stage):
+        try:
+            yield
+        finally:
+            STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+
+def record_llm_usage(call: str, data: dict):
+    """Учитывает usage из ответа OpenAI-совместимого сервера, если он есть."""
+    usage = data.get("usage") or {}
+    if usage.get("prompt_tokens"):
+        LLM_TOKENS.labels(call, "prompt").inc(usage["prompt_tokens"])
+    if usage.get("completion_tokens"):
+        LLM_TOKENS.labels(call, "completion").inc(usage["completion_tokens"])
+
+
+def track_db_pool(name: str, pool):
+    """Значения снимаются с пула asyncpg в момент сбора метрик."""
+    DB_POOL_SIZE.labels(name).set_function(pool.get_size)
+    DB_POOL_IDLE.labels(name).set_function(pool.get_idle_size)
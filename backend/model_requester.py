@@ -1,26 +1,50 @@
 import json
 import asyncio
-from typing import Optional, Dict, Any
+import threading
+import time
+from typing import Optional, Dict, Any, AsyncIterator, List, Tuple
 from vector_base import (
     get_rag_index,
     get_history_index,
-    find_similar_letter,
+    distance_to_similarity,
+    find_similar_letter_scored,
     save_letter_to_history,
 )
 import httpx
 from cfg import *
+from llm_balancer import EndpointPool
+from tracing import tracer
+from metrics import (
+    HISTORY_CACHE,
+    LLM_ERRORS,
+    LLM_SECONDS,
+    observe_stage,
+    record_llm_usage,
+)
+
+HISTORY_ANSWER_PREFIX = "[Ответ из истории похожих писем]\n\n"
+NO_CONTEXT_ANSWER = "Информация по вашему запросу не найдена в инструкциях."
+
+
+class NoContextError(LookupError):
+    """В инструкциях не нашлось фрагментов для ответа."""
 
 
 class LLMPipeline:
     def __init__(
         self,
         base_url: str = LLM_BASE_URL,
+        base_urls: Optional[List[str]] = None,
         api_key: str = LLM_API_KEY,
         model: str = LLM_MODEL,
         timeout: float = 120.0,
         examples_path: str = "./examples.json",
+        rag_db=None,
+        history_db=None,
     ):
         self.base_url = base_url
+        # Запросы распределяются между всеми серверами из base_urls
+        self.endpoints = EndpointPool(base_urls or [base_url], request_timeout=timeout)
         self.api_key = api_key
         self.model = model
         self.timeout = httpx.Timeout(timeout)
@@ -30,19 +54,26 @@ class LLMPipeline:
             "Ты отвечаешь ТОЛЬКО JSON словарем, без MARKDOWN, комментариев и других вещей. "
         )
 
-        self._rag_db = None
-        self._history_db = None
+        # Индексы можно передать готовыми, чтобы несколько пайплайнов делили их
+        self._rag_db = rag_db
+        self._history_db = history_db
+        # Индексы открываются в потоках asyncio.to_thread, создаем их один раз
+        self._index_lock = threading.Lock()
 
     @property
     def rag_db(self):
         if self._rag_db is None:
-            self._rag_db = get_rag_index()
+            with self._index_lock:
+                if self._rag_db is None:
+                    self._rag_db = get_rag_index()
         return self._rag_db
 
     @property
     def history_db(self):
         if self._history_db is None:
-            self._history_db = get_history_index()
+            with self._index_lock:
+                if self._history_db is None:
+                    self._history_db = get_history_index()
         return self._history_db
 
     def _load_examples(self) -> str:
@@ -83,11 +114,6 @@ class LLMPipeline:
         example_block = self._load_examples()
         user_prompt = f"Извлеки данные из письма:\n{letter_text}"
 
-        url = f"{self.base_url}/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-        }
         payload = {
             "model": self.model,
             "messages": [
@@ -97,33 +123,84 @@ class LLMPipeline:
             "temperature": 0.2,
         }
 
-        async with httpx.AsyncClient(timeout=self.timeout) as client:
-            try:
-                response = await client.post(url, json=payload, headers=headers)
-                response.raise_for_status()
-                data = response.json()
-                content = data["choices"][0]["message"]["content"].strip()
-                return json.loads(content)
-            except Exception as e:
-                print(f"Ошибка извлечения данных: {e}")
-                return None
-
-    async def ask_rag(self, query: str, message_id: str = "unknown") -> str:
-        """
-        Главная логика ответа:
-        1. Проверяем историю (есть ли похожее письмо?). Если да -> возвращаем готовый ответ.
-        2. Если нет -> делаем RAG поиск по инструкциям -> генерируем ответ через LLM -> сохраняем в историю.
-        """
-
-        existing_answer = find_similar_letter(self.history_db, query)
-        if existing_answer:
-            return f"[Ответ из истории похожих писем]\n\n{existing_answer}"
-
-        url = f"{self.base_url}/chat/completions"
-        headers = {
+        try:
+            data = await self._chat("extract", payload)
+            content = data["choices"][0]["message"]["content"].strip()
+            return json.loads(content)
+        except Exception as e:
+            print(f"Ошибка извлечения данных: {e}")
+            return None
+
+    def _headers(self) -> Dict[str, str]:
+        return {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
         }
+
+    async def _chat(
+        self,
+        call: str,
+        payload: Dict[str, Any],
+        timeout: Optional[httpx.Timeout] = None,
+    ) -> Dict[str, Any]:
+        """POST /chat/completions на наименее загруженный сервер."""
+        async with self.endpoints.acquire() as endpoint:
+            with tracer.start_as_current_span(f"llm.{call}") as span:
+                span.set_attribute("llm.endpoint", endpoint.base_url)
+                started = time.perf_counter()
+                try:
+                    async with httpx.AsyncClient(
+                        timeout=timeout or self.timeout
+                    ) as client:
+                        response = await client.post(
+                            f"{endpoint.base_url}/chat/completions",
+                            json=payload,
+                            headers=self._headers(),
+                        )
+                        response.raise_for_status()
+                        data = response.json()
+                except Exception:
+                    LLM_ERRORS.labels(call, endpoint.base_url).inc()
+                    raise
+                LLM_SECONDS.labels(call, endpoint.base_url).observe(
+                    time.perf_counter() - started
+                )
+                record_llm_usage(call, data)
+                usage = data.get("usage") or {}
+                span.set_attribute("llm.prompt_tokens", usage.get("prompt_tokens", 0))
+                span.set_attribute(
+                    "llm.completion_tokens", usage.get("completion_tokens", 0)
+                )
+                return data
+
+    async def _find_in_history(self, query: str) -> Tuple[Optional[str], float]:
+        # Эмбеддинг и поиск по индексу блокирующие - выполняем вне event loop
+        with observe_stage("history_lookup"):
+            existing_answer, similarity = await asyncio.to_thread(
+                lambda: find_similar_letter_scored(self.history_db, query)
+            )
+        HISTORY_CACHE.labels("hit" if existing_answer else "miss").inc()
+        return existing_answer, similarity
+
+    async def _save_to_history(self, query: str, answer: str, message_id: str):
+        await asyncio.to_thread(
+            lambda: save_letter_to_history(self.history_db, query, answer, message_id)
+        )
+
+    async def _retrieve(self, query: str, top_k: int):
+        return await asyncio.to_thread(
+            lambda: self.rag_db.similarity_search_with_score(query, k=top_k)
+        )
+
+    async def rewrite_query_for_rag(self, user_query: str) -> str:
+        """Перефразирует письмо в короткий поисковый запрос по инструкциям."""
+        system_prompt = (
+            "Ты - помощник по поиску в технической документации. "
+            "Сформулируй по письму клиента короткий поисковый запрос: прибор, проблема, код ошибки. "
+            "Отвечай ТОЛЬКО текстом запроса."
+        )
+        user_prompt = f"Письмо клиента:\n{user_query}\n\nПоисковый запрос:"
+
         payload = {
             "model": self.model,
             "messages": [
@@ -134,44 +211,50 @@ class LLMPipeline:
             "max_tokens": 256,
         }
 
-        async with httpx.AsyncClient(timeout=httpx.Timeout(30.0)) as client:
-            try:
-                response = await client.post(url, json=payload, headers=headers)
-                response.raise_for_status()
-                data = response.json()
-                rewritten_query = data["choices"][0]["message"]["content"].strip()
-
-                if not rewritten_query:
-                    return user_query
-                return rewritten_query
+        try:
+            data = await self._chat(
+                "rewrite_query", payload, timeout=httpx.Timeout(30.0)
+            )
+            rewritten_query = data["choices"][0]["message"]["content"].strip()
 
-            except Exception as e:
-                print(f"Ошибка при перефразировании запроса: {e}. Используем оригинал.")
+            if not rewritten_query:
                 return user_query
+            return rewritten_query
 
-    async def ask_rag(self, query: str, top_k: int = 3) -> str:
+        except Exception as e:
+            print(f"Ошибка при перефразировании запроса: {e}. Используем оригинал.")
+            return user_query
 
+    async def _build_rag_payload(
+        self, query: str, top_k: int = 3
+    ) -> Tuple[Optional[Dict[str, Any]], List[str], float]:
+        """
+        Ищет контекст в инструкциях и собирает запрос к LLM. Третье значение -
+        близость лучшего фрагмента, по ней оценивается уверенность в ответе.
+        """
         optimized_query = await self.rewrite_query_for_rag(query)
 
-        results = self._vector_db.similarity_search(optimized_query, k=top_k)
+        with observe_stage("retrieval"):
+            scored = await self._retrieve(optimized_query, top_k)
 
-        if not results:
-            results = self._vector_db.similarity_search(query, k=top_k)
+            if not scored:
+                scored = await self._retrieve(query, top_k)
 
-        print("Найдено документов:", len(results))
+        print("Найдено документов:", len(scored))
 
-        if not results:
-            return "Информация по вашему запросу не найдена в инструкциях."
+        if not scored:
+            return None, [], 0.0
 
-        context_text = ""
-        sources = set()
-        if results:
-            for i, doc in enumerate(results):
-                context_text += f"[Источник: {doc.metadata.get('source', 'Unknown')}]\n{doc.page_content}\n\n"
-                sources.add(doc.metadata.get("source", "Unknown"))
+        results = [doc for doc, _ in scored]
+        confidence = max(distance_to_similarity(score) for _, score in scored)
 
-        if not context_text:
-            return "Информация по вашему запросу не найдена ни в истории, ни в инструкциях."
+        context_text = ""
+        sources = []
+        for doc in results:
+            source = doc.metadata.get("source", "Unknown")
+            context_text += f"[Источник: {source}]\n{doc.page_content}\n\n"
+            if source not in sources:
+                sources.append(source)
 
         system_prompt = (
             "Ты - технический помощник. Твоя задача отвечать на вопросы ТОЛЬКО на основе предоставленного контекста из инструкций.\n"
@@ -194,25 +277,131 @@ class LLMPipeline:
             "temperature": 0.3,
             "max_tokens": 256,
         }
-        url = f"{self.base_url}/chat/completions"
+        return payload, sources, confidence
 
-        async with httpx.AsyncClient(timeout=httpx.Timeout(self.timeout)) as client:
-            try:
-                resp = await client.post(
-                    url,
-                    json=payload,
-                    headers={"Authorization": f"Bearer {LLM_API_KEY}"},
-                )
-                resp.raise_for_status()
-                generated_answer = resp.json()["choices"][0]["message"]["content"]
+    async def answer_with_confidence(
+        self,
+        query: str,
+        message_id: str = "unknown",
+        top_k: int = 3,
+        raise_errors: bool = False,
+        use_history: bool = True,
+    ) -> Dict[str, Any]:
+        """
+        Главная логика ответа:
+        1. Проверяем историю (есть ли похожее письмо?). Если да -> возвращаем готовый ответ.
+        2. Если нет -> делаем RAG поиск по инструкциям -> генерируем ответ через LLM -> сохраняем в историю.
+        Возвращает {"answer", "confidence", "source"}, source - history, rag или none.
+        С raise_errors=True ошибка LLM пробрасывается, чтобы задачу можно было повторить.
+        use_history=False - ответ заново по инструкциям, без поиска и записи в историю
+        (повторная обработка, где в истории уже лежит старый ответ на это же письмо).
+        """
 
-                final_answer = (
-                    f"{generated_answer}\n\nИспользованные файлы: {', '.join(sources)}"
-                )
+        existing_answer, similarity = (
+            await self._find_in_history(query) if use_history else (None, 0.0)
+        )
+        if existing_answer:
+            return {
+                "answer": f"{HISTORY_ANSWER_PREFIX}{existing_answer}",
+                "confidence": similarity,
+                "source": "history",
+            }
+
+        payload, sources, confidence = await self._build_rag_payload(query, top_k=top_k)
+        if payload is None:
+            return {
+                "answer": NO_CONTEXT_ANSWER,
+                "confidence": 0.0,
+                "source": "none",
+            }
+
+        try:
+            data = await self._chat("answer", payload)
+            generated_answer = data["choices"][0]["message"]["content"]
 
-                save_letter_to_history(self.history_db, query, final_answer, message_id)
+            final_answer = (
+                f"{generated_answer}\n\nИспользованные файлы: {', '.join(sources)}"
+            )
+
+            if use_history:
+                await self._save_to_history(query, final_answer, message_id)
+
+            return {"answer": final_answer, "confidence": confidence, "source": "rag"}
+
+        except Exception as e:
+            if raise_errors:
+                raise
+            return {
+                "answer": f"Ошибка при обращении к нейросети: {e}",
+                "confidence": 0.0,
+                "source": "none",
+            }
+
+    async def ask_rag(
+        self,
+        query: str,
+        message_id: str = "unknown",
+        top_k: int = 3,
+        raise_errors: bool = False,
+    ) -> str:
+        result = await self.answer_with_confidence(query, message_id, top_k, raise_errors)
+        return result["answer"]
+
+    async def stream_rag(
+        self, query: str, message_id: str = "unknown", top_k: int = 3
+    ) -> AsyncIterator[str]:
+        """
+        То же, что ask_rag, но отдает ответ по токенам (stream=True).
+        Ответ из истории отдается одним куском. Ошибки не превращаются в текст
+        ответа: без контекста - NoContextError, ошибка LLM пробрасывается.
+        """
+
+        existing_answer, _ = await self._find_in_history(query)
+        if existing_answer:
+            yield f"{HISTORY_ANSWER_PREFIX}{existing_answer}"
+            return
+
+        payload, sources, _ = await self._build_rag_payload(query, top_k=top_k)
+        if payload is None:
+            raise NoContextError(NO_CONTEXT_ANSWER)
+
+        payload["stream"] = True
+        generated_answer = ""
+        started = time.perf_counter()
+
+        try:
+            async with self.endpoints.acquire() as endpoint, httpx.AsyncClient(
+                timeout=self.timeout
+            ) as client:
+                async with client.stream(
+                    "POST",
+                    f"{endpoint.base_url}/chat/completions",
+                    json=payload,
+                    headers=self._headers(),
+                ) as resp:
+                    resp.raise_for_status()
+                    async for line in resp.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:") :].strip()
+                        if data == "[DONE]":
+                            break
+                        choices = json.loads(data).get("choices") or []
+                        if not choices:
+                            continue
+                        token = (choices[0].get("delta") or {}).get("content")
+                        if token:
+                            generated_answer += token
+                            yield token
+        except Exception:
+            LLM_ERRORS.labels("answer_stream", "").inc()
+            raise
+        LLM_SECONDS.labels("answer_stream", endpoint.base_url).observe(
+            time.perf_counter() - started
+        )
 
-                return final_answer
+        sources_text = f"\n\nИспользованные файлы: {', '.join(sources)}"
+        yield sources_text
 
-            except Exception as e:
-                return f"Ошибка при обращении к нейросети: {e}"
+        final_answer = f"{generated_answer}{sources_text}"
+        await self._save_to_history(query, final_answer, message_id)
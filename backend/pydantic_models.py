@@ -1,6 +1,8 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from datetime import date
-from typing import Optional, List, Union, Dict
+from typing import Literal, Optional, List, Union, Dict
+
+from utils import normalize_task_status
 
 
 class FetchedMailsResponse(BaseModel):
@@ -11,7 +13,7 @@ class FetchedMailsResponse(BaseModel):
 
 
 class EmailRequest(BaseModel):
-    to_emails: List[str] = Field(..., min_items=1, max_items=50)
+    to_emails: List[str] = Field(..., min_length=1, max_length=50)
     subject: str = Field(..., max_length=200)
     body: str = Field(..., min_length=1, max_length=5000)
     html_body: Optional[str] = Field(None, max_length=10000)
@@ -19,6 +21,10 @@ class EmailRequest(BaseModel):
     message_id: Optional[str] = Field(None)
 
 
+class BulkEmailRequest(BaseModel):
+    items: List[EmailRequest] = Field(..., min_length=1, max_length=200)
+
+
 class RequestBase(BaseModel):
     date: str
     fullName: str
@@ -51,7 +57,31 @@ class RequestCreate(BaseModel):
 class RequestResponse(RequestBase):
     id: int
     task_status: str
+    send_status: Optional[str] = None
 
 
 class AddNewRow(BaseModel):
     id: int
+
+
+class BulkRequestUpdate(BaseModel):
+    """Одинаковые изменения для всех обращений из ids; None - поле не меняется"""
+
+    ids: List[int] = Field(..., min_length=1, max_length=1000)
+    task_status: Optional[Literal["OPEN", "IN_PROGRESS", "CLOSED"]] = None
+    fullName: Optional[str] = None
+    object: Optional[str] = None
+    phone: Optional[str] = None
+    email: Optional[str] = None
+    factoryNumber: Optional[str] = None
+    deviceType: Optional[str] = None
+    emotion: Optional[str] = None
+    issue: Optional[str] = None
+    llm_answer: Optional[str] = None
+
+    _normalize_task_status = field_validator("task_status", mode="before")(normalize_task_status)
+
+
+class LoginRequest(BaseModel):
+    login: str = Field(..., min_length=1, max_length=50)
+    password: str = Field(..., min_length=1, max_length=200)
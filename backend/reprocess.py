@@ -0,0 +1,371 @@
+"""
+Повторная обработка сохраненных обращений после смены промпта извлечения или модели.
+Письма берутся из letter_jobs или mailbox_messages, результат пишется в requests
+пачками, прогресс сохраняется в reprocess_runs - прерванный запуск продолжается.
+
+    python reprocess.py --mode extract --concurrency 8
+    python reprocess.py --mode answer --dry-run --limit 20
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+import job_queue
+from cfg import LLM_BASE_URLS, LLM_MAX_CONCURRENCY_PER_ENDPOINT, LLM_MODEL
+from model_requester import LLMPipeline
+from scheduler import build_letter_text, get_attachment_processor
+from text_normalize import normalize_letter
+from utils import parse_date_string
+
+logger = logging.getLogger("Reprocess")
+
+# Поля extract_data -> колонки requests
+EXTRACTED_COLUMNS = {
+    "full_name": "full_name",
+    "object": "object_name",
+    "phone": "phone",
+    "email": "email",
+    "factory_number": "factory_number",
+    "device_type": "device_type",
+    "emotional_tone": "emotion",
+    "issue_summary": "question_summary",
+}
+MODE_COLUMNS = {
+    "extract": list(EXTRACTED_COLUMNS.values()),
+    "answer": ["llm_answer"],
+    "both": list(EXTRACTED_COLUMNS.values()) + ["llm_answer"],
+}
+PAGE_SIZE = 500
+DIFF_MAX_CHARS = 80
+
+SELECT_ROWS = """
+    SELECT r.request_id, r.message_id, {columns},
+           COALESCE(j.letter, m.letter) AS letter
+    FROM requests r
+    LEFT JOIN letter_jobs j ON j.message_id = r.message_id
+    LEFT JOIN LATERAL (
+        SELECT letter FROM mailbox_messages mm
+        WHERE mm.message_id = r.message_id AND j.letter IS NULL
+        LIMIT 1
+    ) m ON true
+    WHERE r.request_id > $1
+      AND ($2::date IS NULL OR r.req_date >= $2)
+      AND ($3::date IS NULL OR r.req_date < $3::date + 1)
+      AND ($4::text IS NULL OR r.task_status = $4::task_statuses)
+      AND ($5::bool OR r.send_status IS DISTINCT FROM 'sent')
+      AND ($6::int[] IS NULL OR r.request_id = ANY($6))
+    ORDER BY r.request_id
+"""
+
+
+def short(value: Any) -> str:
+    text = str(value or "").replace("\n", " ")
+    return text if len(text) <= DIFF_MAX_CHARS else text[: DIFF_MAX_CHARS - 1] + "…"
+
+
+class Reprocessor:
+    """
+    Читает обращения по возрастанию request_id, прогоняет их через LLM в
+    concurrency параллельных задачах и пишет результаты пачками. Точка
+    продолжения - наибольший id, до которого все обращения уже записаны.
+    """
+
+    def __init__(self, pool, llm: LLMPipeline, args):
+        self.pool = pool
+        self.llm = llm
+        self.args = args
+        self.columns = MODE_COLUMNS[args.mode]
+        self.cursor = 0
+        self.last_dispatched = 0
+        self.in_flight = set()
+        self.results: List[Dict[str, Any]] = []
+        self.failed_ids: List[int] = []
+        # --retry-failed: успешно повторенные id убираются из failed_ids при записи
+        self.retried_ids: List[int] = []
+        self.processed = 0
+        self._flushed_processed = 0
+        self.changed = 0
+        self.failed = 0
+        self.remaining = 0
+        self.started = time.monotonic()
+        self._flush_lock = asyncio.Lock()
+
+    def _filters(self, ids: Optional[List[int]] = None) -> list:
+        args = self.args
+        return [
+            parse_date_string(args.date_from) if args.date_from else None,
+            parse_date_string(args.date_to) if args.date_to else None,
+            args.status,
+            args.include_sent or args.mode == "extract",
+            ids,
+        ]
+
+    async def load_checkpoint(self) -> Optional[List[int]]:
+        """Точка продолжения; для --retry-failed - список ранее упавших id."""
+        async with self.pool.acquire() as conn:
+            if self.args.dry_run:
+                # Пробный запуск ничего не пишет, в том числе в reprocess_runs
+                run = await conn.fetchrow(
+                    "SELECT * FROM reprocess_runs WHERE run_name = $1", self.args.run_name
+                )
+                if run is None or self.args.restart:
+                    run = {"last_request_id": 0, "failed_ids": []}
+            else:
+                if self.args.restart:
+                    await conn.execute(
+                        "DELETE FROM reprocess_runs WHERE run_name = $1", self.args.run_name
+                    )
+                run = await conn.fetchrow(
+                    """
+                    INSERT INTO reprocess_runs (run_name, mode) VALUES ($1, $2)
+                    ON CONFLICT (run_name) DO UPDATE SET updated_at = now(), finished_at = NULL
+                    RETURNING *
+                    """,
+                    self.args.run_name,
+                    self.args.mode,
+                )
+            retry_ids = None
+            if self.args.retry_failed:
+                # failed_ids не очищаются: id уходит из списка вместе с записью результата
+                retry_ids = list(run["failed_ids"])
+            else:
+                self.cursor = run["last_request_id"]
+            self.remaining = await conn.fetchval(
+                f"SELECT count(*) FROM ({SELECT_ROWS.format(columns='r.request_id AS id')}) AS rows",
+                self.cursor,
+                *self._filters(retry_ids),
+            )
+        if self.args.limit:
+            self.remaining = min(self.remaining, self.args.limit)
+        self.last_dispatched = self.cursor
+        return retry_ids
+
+    async def rows(self, retry_ids: Optional[List[int]]):
+        """Постраничное чтение по request_id без OFFSET."""
+        query = SELECT_ROWS.format(columns=", ".join(f"r.{c}" for c in self.columns))
+        query += " LIMIT $7"
+        cursor, left = self.cursor, self.args.limit or None
+        while left is None or left > 0:
+            page = PAGE_SIZE if left is None else min(PAGE_SIZE, left)
+            async with self.pool.acquire() as conn:
+                batch = await conn.fetch(query, cursor, *self._filters(retry_ids), page)
+            if not batch:
+                return
+            for row in batch:
+                yield dict(row)
+            cursor = batch[-1]["request_id"]
+            if left is not None:
+                left -= len(batch)
+
+    async def handle(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        letter = row["letter"]
+        if isinstance(letter, str):
+            letter = json.loads(letter)
+        if not letter:
+            raise ValueError("исходное письмо не сохранено")
+
+        message_id = row["message_id"]
+        normalized = normalize_letter(letter.get("text", ""), message_id)
+        values: Dict[str, Any] = {}
+
+        if self.args.mode in ("extract", "both"):
+            letter_text = build_letter_text(
+                letter, "\n\n".join(filter(None, [normalized["body"], normalized["signature"]]))
+            )
+            if self.args.attachments:
+                letter_text += await get_attachment_processor().describe(letter.get("files"))
+            extracted = await self.llm.extract_data(letter_text)
+            if not extracted:
+                raise ValueError("не удалось извлечь данные")
+            for key, column in EXTRACTED_COLUMNS.items():
+                values[column] = str(extracted.get(key) or "")
+
+        if self.args.mode in ("answer", "both"):
+            rag_query = f"Тема: {letter.get('subject', '')}\n\n{normalized['body']}"
+            result = await self.llm.answer_with_confidence(
+                rag_query, message_id=message_id, raise_errors=True, use_history=False
+            )
+            values["llm_answer"] = result["answer"]
+
+        return values
+
+    async def worker(self, queue: asyncio.Queue):
+        while True:
+            row = await queue.get()
+            if row is None:
+                return
+            request_id = row["request_id"]
+            # При отмене письмо остается в in_flight и обработается при продолжении
+            try:
+                values = await self.handle(row)
+            except Exception as e:
+                logger.warning(f"Обращение {request_id} не обработано: {e}")
+                self.failed_ids.append(request_id)
+                self.failed += 1
+            else:
+                diff = {c: (row[c], v) for c, v in values.items() if row[c] != v}
+                if diff:
+                    self.results.append({"request_id": request_id, "values": values, "diff": diff})
+                if self.args.retry_failed:
+                    self.retried_ids.append(request_id)
+            self.in_flight.discard(request_id)
+            self.processed += 1
+            if len(self.results) >= self.args.batch_size:
+                await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            # Снимок буфера и точки продолжения без await между ними
+            results, self.results = self.results, []
+            failed_ids, self.failed_ids = self.failed_ids, []
+            retried_ids, self.retried_ids = self.retried_ids, []
+            watermark = min(self.in_flight) - 1 if self.in_flight else self.last_dispatched
+            self.changed += len(results)
+
+            if self.args.dry_run:
+                for result in results:
+                    for column, (old, new) in result["diff"].items():
+                        print(f"#{result['request_id']} {column}: {short(old)!r} -> {short(new)!r}")
+                return
+
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    if results:
+                        await self._write(conn, results)
+                    await conn.execute(
+                        """
+                        UPDATE reprocess_runs
+                        SET last_request_id = GREATEST(last_request_id, $2),
+                            processed = processed + $3,
+                            changed = changed + $4,
+                            failed = failed + $5,
+                            failed_ids = ARRAY(
+                                SELECT DISTINCT id FROM unnest(failed_ids || $6::int[]) AS id
+                                WHERE id <> ALL($7::int[])
+                                ORDER BY id
+                            ),
+                            updated_at = now()
+                        WHERE run_name = $1
+                        """,
+                        self.args.run_name,
+                        0 if self.args.retry_failed else watermark,
+                        self.processed - self._flushed_processed,
+                        len(results),
+                        len(failed_ids),
+                        failed_ids,
+                        retried_ids,
+                    )
+            self._flushed_processed = self.processed
+
+    async def _write(self, conn, results: List[Dict[str, Any]]):
+        """Одним UPDATE по unnest на всю пачку."""
+        columns = self.columns
+        arrays = [[r["request_id"] for r in results]]
+        arrays += [[r["values"][c] for r in results] for c in columns]
+        placeholders = ", ".join(
+            ["$1::int[]"] + [f"${i + 2}::text[]" for i in range(len(columns))]
+        )
+        await conn.execute(
+            f"""
+            UPDATE requests r
+            SET {", ".join(f"{c} = u.{c}" for c in columns)}
+            FROM unnest({placeholders}) AS u(request_id, {", ".join(columns)})
+            WHERE r.request_id = u.request_id
+            """,
+            *arrays,
+        )
+
+    async def report_loop(self):
+        while True:
+            await asyncio.sleep(self.args.report_seconds)
+            self.report()
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.processed / elapsed if elapsed else 0.0
+        left = max(self.remaining - self.processed, 0)
+        eta = f"{left / rate / 60:.0f} мин" if rate else "-"
+        logger.info(
+            f"Обработано {self.processed}/{self.remaining}, изменено {self.changed + len(self.results)}, "
+            f"ошибок {self.failed}, {rate * 60:.1f} писем/мин, осталось ~{eta}"
+        )
+
+    async def run(self):
+        retry_ids = await self.load_checkpoint()
+        logger.info(
+            f"Запуск {self.args.run_name}: с request_id > {self.cursor}, к обработке {self.remaining}, "
+            f"параллельно {self.args.concurrency}{', без записи' if self.args.dry_run else ''}"
+        )
+
+        queue = asyncio.Queue(maxsize=self.args.concurrency * 2)
+        workers = [asyncio.create_task(self.worker(queue)) for _ in range(self.args.concurrency)]
+        reporter = asyncio.create_task(self.report_loop())
+        try:
+            async for row in self.rows(retry_ids):
+                self.in_flight.add(row["request_id"])
+                self.last_dispatched = row["request_id"]
+                await queue.put(row)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers + [reporter]:
+                task.cancel()
+            await asyncio.gather(*workers, reporter, return_exceptions=True)
+            # Прерванный запуск сохраняет все, что успел обработать
+            await self.flush()
+            self.report()
+
+        if not self.args.dry_run:
+            await self.pool.execute(
+                "UPDATE reprocess_runs SET finished_at = now() WHERE run_name = $1",
+                self.args.run_name,
+            )
+
+
+async def run(args):
+    pool = await job_queue.create_pool(max_size=4)
+    llm = LLMPipeline(base_urls=LLM_BASE_URLS, model=args.model)
+    try:
+        await Reprocessor(pool, llm, args).run()
+    finally:
+        await pool.close()
+        if args.attachments:
+            get_attachment_processor().close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Повторная обработка обращений")
+    parser.add_argument("--mode", choices=list(MODE_COLUMNS), default="extract")
+    parser.add_argument("--model", default=LLM_MODEL)
+    parser.add_argument("--run-name", help="имя запуска для продолжения, по умолчанию режим:модель")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=len(LLM_BASE_URLS) * LLM_MAX_CONCURRENCY_PER_ENDPOINT,
+        help="одновременных писем, по умолчанию по числу слотов серверов LLM",
+    )
+    parser.add_argument("--batch-size", type=int, default=100, help="изменений на одну запись в БД")
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--date-from")
+    parser.add_argument("--date-to")
+    parser.add_argument("--status", choices=["OPEN", "IN_PROGRESS", "CLOSED"])
+    parser.add_argument("--include-sent", action="store_true", help="перезаписывать уже отправленные ответы")
+    parser.add_argument("--attachments", action="store_true", help="учитывать вложения при извлечении")
+    parser.add_argument("--dry-run", action="store_true", help="только показать изменения")
+    parser.add_argument("--restart", action="store_true", help="начать запуск заново")
+    parser.add_argument("--retry-failed", action="store_true", help="повторить упавшие обращения запуска")
+    parser.add_argument("--report-seconds", type=float, default=30)
+    args = parser.parse_args()
+    args.run_name = args.run_name or f"{args.mode}:{args.model}"
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
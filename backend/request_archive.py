@@ -0,0 +1,58 @@
+import logging
+import os
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# Закрытые обращения старше стольких месяцев уходят в requests_archive
+ARCHIVE_AFTER_MONTHS = int(os.getenv("ARCHIVE_AFTER_MONTHS", "6"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+ARCHIVE_INTERVAL_HOURS = float(os.getenv("ARCHIVE_INTERVAL_HOURS", "24"))
+PARTITIONS_AHEAD_MONTHS = int(os.getenv("PARTITIONS_AHEAD_MONTHS", "3"))
+
+
+def archive_cutoff(months: int = ARCHIVE_AFTER_MONTHS) -> datetime:
+    """Начало месяца, от которого обращения еще считаются рабочими."""
+    now = datetime.now(timezone.utc)
+    month = now.year * 12 + now.month - 1 - months
+    return datetime(month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+async def ensure_partitions(conn, months_ahead: int = PARTITIONS_AHEAD_MONTHS):
+    await conn.execute("SELECT ensure_request_partitions($1)", months_ahead)
+
+
+async def archive_closed(pool, cutoff: datetime, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """
+    Переносит закрытые обращения до cutoff в архив пачками: каждая пачка
+    в своей транзакции, чтобы не держать долгих блокировок на горячей таблице.
+    """
+    total = 0
+    while True:
+        async with pool.acquire() as conn:
+            moved = await conn.fetchval(
+                "SELECT archive_closed_requests($1, $2)", cutoff, batch_size
+            )
+        total += moved
+        if moved < batch_size:
+            return total
+
+
+async def run_archive(pool, months: int = ARCHIVE_AFTER_MONTHS) -> dict:
+    cutoff = archive_cutoff(months)
+    async with pool.acquire() as conn:
+        await ensure_partitions(conn)
+
+    archived = await archive_closed(pool, cutoff)
+
+    async with pool.acquire() as conn:
+        dropped = [
+            row[0]
+            for row in await conn.fetch(
+                "SELECT drop_empty_request_partitions($1)", cutoff
+            )
+        ]
+    logger.info(
+        f"Архивация до {cutoff:%Y-%m-%d}: перенесено {archived}, удалены секции {dropped or '-'}"
+    )
+    return {"cutoff": cutoff, "archived": archived, "dropped_partitions": dropped}
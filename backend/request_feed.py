@@ -0,0 +1,94 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Dict, Set
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+# Канал pg_notify из триггеров 09-request-notify.sql
+REQUESTS_CHANNEL = "requests_changed"
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "100"))
+STREAM_KEEPALIVE_SECONDS = float(os.getenv("STREAM_KEEPALIVE_SECONDS", "15"))
+STREAM_RECONNECT_SECONDS = float(os.getenv("STREAM_RECONNECT_SECONDS", "5"))
+
+# Событие для отставших клиентов: очередь переполнилась, нужно перечитать страницу
+RESET_EVENT = {"op": "reset", "ids": []}
+
+
+class RequestFeed:
+    """
+    Раздает изменения таблицы requests подключенным клиентам /api/stream.
+    Слушает LISTEN на отдельном соединении, поэтому события от любой реплики
+    API и от scheduler доходят до всех клиентов. В событии только id обращений,
+    клиент дочитывает строки через /api/requests?ids=...
+    """
+
+    def __init__(self, connect_kwargs: Dict[str, Any], queue_size: int = STREAM_QUEUE_SIZE):
+        self.connect_kwargs = connect_kwargs
+        self.queue_size = queue_size
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._conn = None
+        self._lost = asyncio.Event()
+        self._task = None
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    def publish(self, event: Dict[str, Any]):
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Медленный клиент не тормозит остальных: сбрасываем его очередь
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(RESET_EVENT)
+
+    def _on_notify(self, conn, pid, channel, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            logger.warning(f"Некорректное уведомление {channel}: {payload[:100]}")
+            return
+        self.publish(event)
+
+    def _on_terminate(self, conn):
+        self._lost.set()
+
+    async def _listen(self):
+        while True:
+            try:
+                self._conn = await asyncpg.connect(**self.connect_kwargs)
+                self._conn.add_termination_listener(self._on_terminate)
+                await self._conn.add_listener(REQUESTS_CHANNEL, self._on_notify)
+                self._lost.clear()
+                # Пока соединения не было, события могли потеряться
+                self.publish(RESET_EVENT)
+                await self._lost.wait()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка подписки на {REQUESTS_CHANNEL}: {e}")
+            finally:
+                if self._conn is not None and not self._conn.is_closed():
+                    await self._conn.close()
+                self._conn = None
+            await asyncio.sleep(STREAM_RECONNECT_SECONDS)
+
+    def start(self):
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._subscribers.clear()
@@ -1,6 +1,8 @@
+import argparse
 import os
 import logging
 import signal
+import socket
 import sys
 import time
 from datetime import datetime
@@ -10,96 +12,517 @@ from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 
 import asyncio
+import job_queue
+from attachment_text import AttachmentProcessor
+from auto_dispatch import AutoDispatcher
+from cfg import (
+    ATTACHMENT_DESCRIBE_WAIT_SECONDS,
+    AUTO_DISPATCH_ENABLED,
+    LLM_BASE_URLS,
+    LLM_API_KEY,
+    LLM_MAX_CONCURRENCY_PER_ENDPOINT,
+    VECTOR_BACKEND,
+    VECTOR_SNAPSHOT_DIR,
+    VECTOR_SNAPSHOT_PUBLISH_SECONDS,
+)
+from job_queue import STAGE_FETCHED, STAGE_EXTRACTED, STAGE_ANSWERED
+from letter_queue import classify_priority, PRIORITY_NAMES
 from mail_fetch import fetch_emails
+from metrics import (
+    DUPLICATE_LETTERS,
+    JOB_FAILURES,
+    LETTERS_PROCESSED,
+    QUEUE_DEPTH,
+    QUEUE_MAX_WAIT,
+    QUEUE_START_WAIT,
+    track_db_pool,
+)
+from prometheus_client import start_http_server
+from opentelemetry import trace
+from opentelemetry.propagate import extract, inject
+from opentelemetry.trace import Status, StatusCode
+from tracing import setup_tracing, tracer
 from model_requester import LLMPipeline
 from pydantic_models import RequestCreate
+from request_archive import ARCHIVE_INTERVAL_HOURS, run_archive
+from text_normalize import normalize_letter
 from utils import parse_date_string
 import httpx
 
 API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost:8000")
-ATTACHMENTS_DIR = os.getenv("ATTACHMENTS_DIR", "attachments")
 CHECK_INTERVAL_MINUTES = int(os.getenv("CHECK_INTERVAL_MINUTES", "1"))
+# all - сборщик и обработчик в одном процессе,
+# coordinator - только сборщик почты, worker - только обработка очереди
+SCHEDULER_ROLE = os.getenv("SCHEDULER_ROLE", "all")
+# По умолчанию столько слотов, сколько запросов принимают все серверы инференса
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "0")) or (
+    len(LLM_BASE_URLS) * LLM_MAX_CONCURRENCY_PER_ENDPOINT
+)
+WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", "5"))
+HEARTBEAT_SECONDS = float(os.getenv("HEARTBEAT_SECONDS", "30"))
+# Период пересчета request_facets (счетчики фильтров без условий), 0 - не пересчитывать
+FACETS_REFRESH_SECONDS = float(os.getenv("FACETS_REFRESH_SECONDS", "60"))
+# У каждого процесса на узле свой порт метрик; 0 - не поднимать HTTP-сервер
+METRICS_PORT = int(os.getenv("SCHEDULER_METRICS_PORT", "9101"))
+
+HOSTNAME = socket.gethostname()
+WORKER_ID = f"{HOSTNAME}:{os.getpid()}"
 
 shutdown_event = Event()
 logger = logging.getLogger("Scheduler")
+_llm = None
+_attachments = None
 
 
-def process_single_letter(msg: dict):
-    message_id = msg.get("message_id", "")
-    if not message_id:
-        logger.warning("Письмо без ID, пропускаем.")
-        return
+class LetterProcessingError(Exception):
+    """Этап обработки письма не удался, задачу нужно повторить."""
 
-    try:
-        letter_text = f"От: {msg.get('sender_email', 'Unknown')}\n"
-        letter_text += f"Тема: {msg.get('subject', '')}\n"
-        letter_text += f"Дата: {msg.get('date', '')}\n\n"
-        letter_text += msg.get("text", "")
 
-        llm = LLMPipeline()
+def build_letter_text(msg: dict, body: str = None) -> str:
+    letter_text = f"От: {msg.get('sender_email', 'Unknown')}\n"
+    letter_text += f"Тема: {msg.get('subject', '')}\n"
+    letter_text += f"Дата: {msg.get('date', '')}\n\n"
+    letter_text += msg.get("text", "") if body is None else body
+    return letter_text
+
 
-        extracted_data = asyncio.run(llm.extract_data(letter_text))
+async def process_job(
+    pool, llm: LLMPipeline, job: dict, dispatcher: AutoDispatcher = None
+):
+    """Выполняет этапы обработки письма, начиная с последнего сохраненного."""
+    message_id = job["message_id"]
+    normalized = normalize_letter(job["letter"].get("text", ""), message_id)
+    # Подпись нужна только для извлечения контактов, в RAG-запрос она не идет
+    letter_text = build_letter_text(
+        job["letter"], "\n\n".join(filter(None, [normalized["body"], normalized["signature"]]))
+    )
+    rag_query = f"Тема: {job['letter'].get('subject', '')}\n\n{normalized['body']}"
+    extracted_data = job["extracted"]
+    llm_answer = job["llm_answer"]
+    confidence = job.get("answer_confidence")
+    answer_source = job.get("answer_source")
+
+    if job["stage"] == STAGE_FETCHED:
+        # Номера и коды ошибок из вложений нужны только для извлечения данных
+        attachments_note = await describe_attachments(pool, job)
+        extracted_data = await llm.extract_data(letter_text + attachments_note)
         if not extracted_data:
-            logger.warning(f"Не удалось извлечь данные для {message_id}")
+            raise LetterProcessingError(f"Не удалось извлечь данные для {message_id}")
+        await job_queue.checkpoint(
+            pool, job["job_id"], WORKER_ID, STAGE_EXTRACTED, extracted=extracted_data
+        )
+        job["stage"] = STAGE_EXTRACTED
+
+    if job["stage"] == STAGE_EXTRACTED:
+        result = await llm.answer_with_confidence(
+            rag_query, message_id=message_id, raise_errors=True
+        )
+        llm_answer = result["answer"]
+        confidence, answer_source = result["confidence"], result["source"]
+        await job_queue.checkpoint(
+            pool,
+            job["job_id"],
+            WORKER_ID,
+            STAGE_ANSWERED,
+            llm_answer=llm_answer,
+            answer_confidence=confidence,
+            answer_source=answer_source,
+        )
+        job["stage"] = STAGE_ANSWERED
+
+    payload = RequestCreate(
+        date=extracted_data.get("date", ""),
+        fullName=extracted_data.get("full_name", ""),
+        object=extracted_data.get("object", ""),
+        phone=extracted_data.get("phone", ""),
+        email=extracted_data.get("email", ""),
+        factoryNumber=extracted_data.get("factory_number", ""),
+        deviceType=extracted_data.get("device_type", ""),
+        emotion=extracted_data.get("emotional_tone", ""),
+        issue=extracted_data.get("issue_summary", ""),
+        llm_answer=llm_answer or "",
+        message_id=message_id,
+        task_status="OPEN",
+    )
+
+    # Контекст трейса передается в API, чтобы вставка в БД попала в тот же трейс
+    headers = {}
+    inject(headers)
+    async with httpx.AsyncClient(timeout=120.0) as client:
+        url = f"{API_BASE_URL}/api/requests"
+        response = await client.post(url, json=payload.model_dump(), headers=headers)
+
+    if response.status_code not in [200, 201, 409]:
+        raise LetterProcessingError(
+            f"Ошибка API: {response.status_code} - {response.text}"
+        )
+
+    await job_queue.complete_job(pool, job["job_id"], WORKER_ID)
+    LETTERS_PROCESSED.inc()
+
+    # 409 - обращение уже создано прошлой попыткой (request_message_ids),
+    # автоответ тогда же попал в очередь outgoing_mail.
+    # На импортированные из архива письма автоответ не отправляется.
+    if (
+        dispatcher is not None
+        and response.status_code != 409
+        and not job["letter"].get("imported")
+    ):
+        recipient = job["letter"].get("sender_email") or payload.email
+        if recipient and dispatcher.qualifies(confidence, answer_source, payload.emotion):
+            await dispatcher.dispatch(
+                message_id, recipient, job["letter"].get("subject", ""), llm_answer
+            )
+    logger.info(f"Письмо {message_id} успешно обработано и сохранено.")
+
+
+async def describe_attachments(pool, job: dict) -> str:
+    """
+    Данные из вложений с ограниченным ожиданием: медленный разбор не держит
+    письмо, а докачанные хеши вложений сохраняются в задаче для повторов.
+    """
+    files = job["letter"].get("files") or []
+    if not files:
+        return ""
+    known = [file.get("sha256") for file in files if isinstance(file, dict)]
+    task = asyncio.ensure_future(get_attachment_processor().describe(files))
+    try:
+        note = await asyncio.wait_for(
+            asyncio.shield(task), timeout=ATTACHMENT_DESCRIBE_WAIT_SECONDS
+        )
+    except asyncio.TimeoutError:
+        logger.warning(
+            f"Вложения письма {job['message_id']} не разобраны за "
+            f"{ATTACHMENT_DESCRIBE_WAIT_SECONDS:g} с, извлекаем данные без них"
+        )
+        return ""
+    if [file.get("sha256") for file in files if isinstance(file, dict)] != known:
+        await job_queue.save_letter_files(pool, job["job_id"], WORKER_ID, files)
+    return note
+
+
+async def enqueue_letters(conn, msgs: list):
+    for msg in msgs:
+        if not msg.get("message_id"):
+            logger.warning("Письмо без ID, пропускаем.")
+            continue
+        priority = classify_priority(msg)
+        if await job_queue.enqueue_letter(conn, msg, priority):
+            logger.info(
+                f"Письмо {msg['message_id']} в очереди, приоритет: {PRIORITY_NAMES[priority]}"
+            )
+        else:
+            DUPLICATE_LETTERS.inc()
+
+
+def get_llm() -> LLMPipeline:
+    """Один пайплайн на процесс: индексы загружаются один раз, а запросы
+    распределяются между серверами инференса внутри LLMPipeline."""
+    global _llm
+    if _llm is None:
+        _llm = LLMPipeline(base_urls=LLM_BASE_URLS)
+    return _llm
+
+
+def get_attachment_processor() -> AttachmentProcessor:
+    global _attachments
+    if _attachments is None:
+        _attachments = AttachmentProcessor()
+    return _attachments
+
+
+async def keep_lease(pool, job_id: int):
+    while True:
+        await asyncio.sleep(job_queue.LEASE_SECONDS / 3)
+        if not await job_queue.extend_lease(pool, job_id, WORKER_ID):
+            logger.warning(f"Аренда задачи {job_id} потеряна")
             return
 
-        llm_answer = asyncio.run(llm.ask_rag(letter_text, message_id=message_id))
-
-        payload = RequestCreate(
-            date=extracted_data.get("date", ""),
-            fullName=extracted_data.get("full_name", ""),
-            object=extracted_data.get("object", ""),
-            phone=extracted_data.get("phone", ""),
-            email=extracted_data.get("email", ""),
-            factoryNumber=extracted_data.get("factory_number", ""),
-            deviceType=extracted_data.get("device_type", ""),
-            emotion=extracted_data.get("emotional_tone", ""),
-            issue=extracted_data.get("issue_summary", ""),
-            llm_answer=llm_answer or "",
-            message_id=message_id,
-            task_status="OPEN",
+
+async def run_job(
+    pool, llm: LLMPipeline, job: dict, dispatcher: AutoDispatcher = None
+):
+    lease_task = asyncio.create_task(keep_lease(pool, job["job_id"]))
+    # Продолжение трейса письма, начатого при заборе из почты (mail_fetch);
+    # этапы обработки становятся дочерними спанами
+    span = tracer.start_span(
+        "letter.process",
+        context=extract(job["letter"].get("trace_context") or {}),
+        attributes={
+            "letter.message_id": job["message_id"],
+            "letter.job_id": job["job_id"],
+            "letter.attempt": job["attempts"],
+            "letter.start_stage": job["stage"],
+        },
+    )
+    try:
+        with trace.use_span(span, end_on_exit=False):
+            await process_job(pool, llm, job, dispatcher)
+    except job_queue.LeaseLostError as e:
+        # Задачей уже владеет другой воркер, ее состояние не трогаем
+        span.set_status(Status(StatusCode.ERROR, str(e)))
+        logger.warning(f"Письмо {job['message_id']}: {e}")
+        JOB_FAILURES.labels(job["stage"], "lease_lost").inc()
+    except Exception as e:
+        span.record_exception(e)
+        span.set_status(Status(StatusCode.ERROR, str(e)))
+        logger.error(
+            f"Ошибка обработки {job['message_id']} на этапе {job['stage']}: {e}",
+            exc_info=True,
         )
+        try:
+            is_dead = await job_queue.fail_job(pool, job, str(e))
+        except job_queue.LeaseLostError as lost:
+            logger.warning(f"Письмо {job['message_id']}: {lost}")
+            JOB_FAILURES.labels(job["stage"], "lease_lost").inc()
+            return
+        JOB_FAILURES.labels(job["stage"], "dead" if is_dead else "retry").inc()
+        if is_dead:
+            logger.error(
+                f"Письмо {job['message_id']} перемещено в letter_dead_jobs после {job['attempts']} попыток"
+            )
+    finally:
+        span.end()
+        lease_task.cancel()
+
+
+async def worker_slot(
+    pool, llm: LLMPipeline, wait_for_jobs: bool, dispatcher: AutoDispatcher = None
+):
+    """
+    Забирает задачи из очереди по одной. Без wait_for_jobs завершается,
+    когда готовых задач не осталось.
+    """
+    while not shutdown_event.is_set():
+        job = await job_queue.claim_job(pool, WORKER_ID)
+        if job is None:
+            if not wait_for_jobs:
+                return
+            await asyncio.sleep(WORKER_POLL_SECONDS)
+            continue
+        await run_job(pool, llm, job, dispatcher)
 
-        with httpx.Client(timeout=120.0) as client:
-            url = f"{API_BASE_URL}/api/requests"
-            response = client.post(url, json=payload.model_dump())
 
-            if response.status_code in [200, 201, 409]:
-                logger.info(f"Письмо {message_id} успешно обработано и сохранено.")
+async def drain_queue(pool, wait_for_jobs: bool = False):
+    llm = get_llm()
+    dispatcher = AutoDispatcher(pool) if AUTO_DISPATCH_ENABLED else None
+    await asyncio.gather(
+        *(
+            worker_slot(pool, llm, wait_for_jobs, dispatcher)
+            for _ in range(WORKER_CONCURRENCY)
+        )
+    )
+
+
+async def get_queue_stats(conn) -> dict:
+    keys = ("max_wait", "avg_start_wait", "max_start_wait")
+    stats = {
+        name: {"depth": 0, **{key: 0.0 for key in keys}} for name in PRIORITY_NAMES.values()
+    }
+    for row in await job_queue.queue_stats(conn):
+        name = PRIORITY_NAMES.get(row["priority"], str(row["priority"]))
+        stats[name] = {"depth": row["depth"], **{key: float(row[key]) for key in keys}}
+
+    for name, values in stats.items():
+        QUEUE_DEPTH.labels(name).set(values["depth"])
+        QUEUE_MAX_WAIT.labels(name).set(values["max_wait"])
+        QUEUE_START_WAIT.labels(name, "avg").set(values["avg_start_wait"])
+        QUEUE_START_WAIT.labels(name, "max").set(values["max_start_wait"])
+    return stats
+
+
+async def fetch_and_enqueue(pool):
+    """Забирает почту, только если этот процесс выбран сборщиком."""
+    async with pool.acquire() as conn:
+        if not await job_queue.try_acquire_fetcher_lock(conn):
+            logger.info("Почту забирает другой процесс, пропускаем.")
+            return
+        try:
+            await job_queue.heartbeat(conn, WORKER_ID, HOSTNAME, "coordinator")
+            msgs = fetch_emails(limit=10)
+            if msgs:
+                await enqueue_letters(conn, msgs)
             else:
-                logger.error(f"Ошибка API: {response.status_code} - {response.text}")
+                logger.info("Новых писем нет.")
+        finally:
+            await job_queue.release_fetcher_lock(conn)
 
-    except Exception as e:
-        logger.error(f"Критическая ошибка обработки {message_id}: {e}", exc_info=True)
+
+async def run_mail_fetch_job(process_queue: bool):
+    pool = await job_queue.create_pool(max_size=WORKER_CONCURRENCY + 2)
+    track_db_pool("scheduler", pool)
+    try:
+        await fetch_and_enqueue(pool)
+        if process_queue:
+            await drain_queue(pool)
+        logger.info(f"Статистика очереди: {await get_queue_stats(pool)}")
+        if process_queue:
+            logger.info(f"Серверы LLM: {get_llm().endpoints.stats()}")
+    finally:
+        await pool.close()
 
 
-def mail_fetch_job():
+def mail_fetch_job(process_queue: bool = True):
     if shutdown_event.is_set():
         return
     logger.info("--- Запуск проверки почты ---")
     try:
-        msgs = fetch_emails(limit=10, save_attachments_dir=ATTACHMENTS_DIR)
-        if not msgs:
-            logger.info("Новых писем нет.")
-            return
-
-        for msg in msgs:
-            if shutdown_event.is_set():
-                break
-            process_single_letter(msg)
+        asyncio.run(run_mail_fetch_job(process_queue))
     except Exception as e:
         logger.error(f"Ошибка в задаче: {e}", exc_info=True)
 
 
+async def run_archive_job():
+    pool = await job_queue.create_pool(max_size=2)
+    try:
+        await run_archive(pool)
+    finally:
+        await pool.close()
+
+
+def archive_job():
+    """Секции requests на месяцы вперед и перенос старых закрытых обращений в архив."""
+    if shutdown_event.is_set():
+        return
+    try:
+        asyncio.run(run_archive_job())
+    except Exception as e:
+        logger.error(f"Ошибка архивации обращений: {e}", exc_info=True)
+
+
+async def run_facets_refresh_job():
+    pool = await job_queue.create_pool(max_size=1)
+    try:
+        # CONCURRENTLY не блокирует чтение фасетов во время пересчета
+        await pool.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY request_facets")
+    finally:
+        await pool.close()
+
+
+def facets_refresh_job():
+    """Пересчет счетчиков фасетов вне пути записи обращений (17-request-facets-view.sql)."""
+    if shutdown_event.is_set():
+        return
+    try:
+        asyncio.run(run_facets_refresh_job())
+    except Exception as e:
+        logger.error(f"Ошибка пересчета фасетов: {e}", exc_info=True)
+
+
+def history_snapshot_job():
+    """Единственный писатель снимка истории: публикует записи воркеров из spool."""
+    if shutdown_event.is_set():
+        return
+    from vector_snapshot import HISTORY_SNAPSHOT, publish_spool
+
+    try:
+        added = publish_spool(VECTOR_SNAPSHOT_DIR, HISTORY_SNAPSHOT)
+        if added:
+            logger.info(f"Снимок истории обновлен, новых записей: {added}")
+    except Exception as e:
+        logger.error(f"Ошибка публикации снимка истории: {e}", exc_info=True)
+
+
+async def heartbeat_loop(pool):
+    while not shutdown_event.is_set():
+        try:
+            await job_queue.heartbeat(pool, WORKER_ID, HOSTNAME, "worker")
+            await get_queue_stats(pool)
+        except Exception as e:
+            logger.error(f"Ошибка heartbeat: {e}")
+        await asyncio.sleep(HEARTBEAT_SECONDS)
+
+
+async def run_worker():
+    """Постоянно работающий обработчик очереди (режим worker)."""
+    # Каждому слоту соединение под задачу и еще одно под продление аренды
+    pool = await job_queue.create_pool(max_size=WORKER_CONCURRENCY * 2 + 1)
+    track_db_pool("scheduler", pool)
+    heartbeat_task = asyncio.create_task(heartbeat_loop(pool))
+    health_task = asyncio.create_task(
+        get_llm().endpoints.run_health_checks(LLM_API_KEY)
+    )
+    logger.info(
+        f"Воркер {WORKER_ID} запущен, слотов: {WORKER_CONCURRENCY}, серверов LLM: {len(LLM_BASE_URLS)}"
+    )
+    try:
+        await drain_queue(pool, wait_for_jobs=True)
+    finally:
+        heartbeat_task.cancel()
+        health_task.cancel()
+        await job_queue.remove_worker(pool, WORKER_ID)
+        await pool.close()
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Сборщик и обработчик писем")
+    parser.add_argument(
+        "--role",
+        choices=["all", "coordinator", "worker"],
+        default=SCHEDULER_ROLE,
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=METRICS_PORT,
+        help="порт метрик Prometheus, 0 - отключить",
+    )
+    args = parser.parse_args()
+
+    # Экспорт метрик для Prometheus и трейсов
+    if args.metrics_port:
+        try:
+            start_http_server(args.metrics_port)
+        except OSError as e:
+            # Второй процесс на том же порту работает дальше, только без метрик
+            logger.warning(f"Метрики на порту {args.metrics_port} не подняты: {e}")
+    setup_tracing(f"scheduler-{args.role}")
+
+    if args.role == "worker":
+
+        def handle_worker_signal(sig, frame):
+            shutdown_event.set()
+
+        signal.signal(signal.SIGINT, handle_worker_signal)
+        signal.signal(signal.SIGTERM, handle_worker_signal)
+        asyncio.run(run_worker())
+        get_attachment_processor().close()
+        print("Worker stopped")
+        return
+
     scheduler = BlockingScheduler()
     scheduler.add_job(
         mail_fetch_job,
+        kwargs={"process_queue": args.role == "all"},
         trigger=IntervalTrigger(minutes=CHECK_INTERVAL_MINUTES),
         id="mail_fetch_job",
         replace_existing=True,
         misfire_grace_time=60,
     )
+    scheduler.add_job(
+        archive_job,
+        trigger=IntervalTrigger(hours=ARCHIVE_INTERVAL_HOURS),
+        id="archive_job",
+        replace_existing=True,
+        next_run_time=datetime.now(),
+        misfire_grace_time=3600,
+    )
+    if FACETS_REFRESH_SECONDS > 0:
+        scheduler.add_job(
+            facets_refresh_job,
+            trigger=IntervalTrigger(seconds=FACETS_REFRESH_SECONDS),
+            id="facets_refresh_job",
+            replace_existing=True,
+            misfire_grace_time=60,
+        )
+    if VECTOR_BACKEND == "snapshot":
+        scheduler.add_job(
+            history_snapshot_job,
+            trigger=IntervalTrigger(seconds=VECTOR_SNAPSHOT_PUBLISH_SECONDS),
+            id="history_snapshot_job",
+            replace_existing=True,
+            misfire_grace_time=60,
+        )
 
     def handle_signal(sig, frame):
         shutdown_event.set()
@@ -114,6 +537,7 @@ def main():
     except (KeyboardInterrupt, SystemExit):
         pass
     finally:
+        get_attachment_processor().close()
         print("Scheduler stopped")
 
 
@@ -1,7 +1,7 @@
 import os
-from vector_base import get_history_index, embeddings
+from vector_base import get_history_index, index_size, embeddings
 from langchain_core.documents import Document
-from cfg import PERSIST_DIRECTORY_HISTORY
+from cfg import PERSIST_DIRECTORY_HISTORY, VECTOR_BACKEND
 
 
 SEED_DATA = [
@@ -24,7 +24,8 @@ SEED_DATA = [
 
 
 def main():
-    print(f"Подключение к базе истории: {PERSIST_DIRECTORY_HISTORY}...")
+    location = "Postgres" if VECTOR_BACKEND == "pgvector" else PERSIST_DIRECTORY_HISTORY
+    print(f"Подключение к базе истории: {location}...")
 
     db = get_history_index()
 
@@ -52,7 +53,7 @@ def main():
     if hasattr(db, "persist"):
         db.persist()
 
-    count = db._collection.count()
+    count = index_size(db)
     print(f"\Всего записей в базе истории: {count}")
 
 
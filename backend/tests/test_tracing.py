@@ -0,0 +1,46 @@
+import json
+
+import tracing
+
+# Строка в том виде, в каком ее пишет ConsoleSpanExporter из setup_tracing
+EXPORTER_LINE = json.dumps(
+    {
+        "name": "letter.process",
+        "context": {
+            "trace_id": "0x5b8aa5a2d2c872e8321cf37308d69df2",
+            "span_id": "0x051581bf3cb55c13",
+            "trace_state": "[]",
+        },
+        "kind": "SpanKind.INTERNAL",
+        "parent_id": "0x5fb397be34d26b51",
+        "start_time": "2024-05-01T10:00:00.123456Z",
+        "end_time": "2024-05-01T10:00:01.623456Z",
+        "status": {"status_code": "UNSET"},
+        "attributes": {"letter.message_id": "<1@example.com>"},
+        "events": [],
+        "links": [],
+        "resource": {
+            "attributes": {"service.name": "scheduler"},
+            "schema_url": "",
+        },
+    }
+)
+
+
+def test_parse_span_time_accepts_z_suffix():
+    parsed = tracing.parse_span_time("2024-05-01T10:00:00.123456Z")
+    assert parsed.utcoffset().total_seconds() == 0
+    assert parsed.microsecond == 123456
+
+
+def test_load_trace_reads_exporter_line(tmp_path, monkeypatch):
+    trace_file = tmp_path / "traces.jsonl"
+    trace_file.write_text(EXPORTER_LINE + "\n{broken\n", encoding="utf-8")
+    monkeypatch.setattr(tracing, "TRACE_FILE", str(trace_file))
+
+    spans = tracing.load_trace("5b8aa5a2d2c872e8321cf37308d69df2")
+
+    assert len(spans) == 1
+    assert spans[0]["name"] == "letter.process"
+    assert spans[0]["service"] == "scheduler"
+    assert spans[0]["duration_ms"] == 1500.0
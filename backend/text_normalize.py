@@ -0,0 +1,146 @@
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict
+
+from cfg import NORMALIZE_CACHE_SIZE, NORMALIZE_CHARS_PER_TOKEN, NORMALIZE_MAX_TOKENS
+from metrics import NORMALIZE_CHARS, observe_stage
+
+try:
+    # selectolax в разы быстрее BeautifulSoup на больших HTML-письмах
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
+
+# Начало цитаты предыдущей переписки: все ниже отбрасывается
+QUOTE_START_PATTERNS = [
+    r"^-{2,}\s*(original message|исходное сообщение|пересылаемое сообщение|forwarded message)\s*-{2,}",
+    r"^.{0,200}(wrote|пишет|написал|написала)\s*:\s*$",
+    # mail.ru/Яндекс: "13.03.2026, 10:00, "Иванов" <ivanov@mail.ru>:"
+    r"^.{0,200}<[^>\s]+@[^>\s]+>\s*:\s*$",
+    r"^_{10,}\s*$",
+]
+# Шапка Outlook: "От: ..." и следом "Отправлено: ..." / "Sent: ..."
+OUTLOOK_HEADER_RE = re.compile(r"^(from|от)\s*:\s.+\n(sent|отправлено|date|дата)\s*:", re.I | re.M)
+
+SIGNATURE_START_PATTERNS = [
+    r"^--\s*$",
+    r"^(с уважением|с наилучшими пожеланиями|всего доброго|best regards|kind regards|regards)\b.{0,40}$",
+]
+MOBILE_FOOTER_RE = re.compile(r"^(отправлено|sent)\s+(с|из|from)\s.{0,60}$", re.I | re.M)
+# Устойчивые фразы юридических дисклеймеров, а не любое упоминание конфиденциальности
+DISCLAIMER_PATTERNS = [
+    r"(это|данное|настоящее) (сообщение|письмо|электронное письмо)[^.]{0,80}(содержит|содержат|может содержать|могут содержать|является) конфиденциальн",
+    r"информаци[яи],? (содержащ[а-я]+ся )?в (этом|данном|настоящем) (сообщении|письме)[^.]{0,80}конфиденциальн",
+    r"если вы (получили (это|данное) (сообщение|письмо) по ошибке|не являетесь (его |надлежащим )?адресатом)",
+    r"не является (публичной )?офертой",
+    r"this (e-?mail|message|communication)[^.]{0,80}(is|may be|contains|may contain) (strictly )?(confidential|privileged)",
+    r"intended (solely |only )?for the (use of the )?(named |intended )?(addressee|recipient)",
+    r"if you (have received this (e-?mail|message) in error|are not the intended recipient)",
+    r"^disclaimer\s*:",
+]
+# В подписи обычно ФИО, должность и телефон - для извлечения данных хватает нескольких строк
+SIGNATURE_MAX_LINES = 6
+
+_quote_re = re.compile("|".join(QUOTE_START_PATTERNS), re.I | re.M)
+_signature_re = re.compile("|".join(SIGNATURE_START_PATTERNS), re.I | re.M)
+_disclaimer_re = re.compile("|".join(DISCLAIMER_PATTERNS), re.I | re.M)
+
+_cache: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def html_to_text(html: str) -> str:
+    """Текст HTML-письма без стилей, скриптов и процитированных blockquote."""
+    if not html:
+        return ""
+    if HTMLParser is not None:
+        tree = HTMLParser(html)
+        for node in tree.css("script, style, head, blockquote"):
+            node.decompose()
+        root = tree.body or tree.root
+        text = root.text(separator="\n") if root else ""
+    else:
+        from bs4 import BeautifulSoup
+
+        soup = BeautifulSoup(html, "html.parser")
+        for node in soup(["script", "style", "head", "blockquote"]):
+            node.decompose()
+        text = soup.get_text("\n")
+    return collapse_whitespace(text)
+
+
+def collapse_whitespace(text: str) -> str:
+    lines = [re.sub(r"[ \t\xa0]+", " ", line).strip() for line in text.splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def strip_quoted(text: str) -> str:
+    """Отрезает процитированную историю переписки и строки с '>'."""
+    cut = len(text)
+    for match in (_quote_re.search(text), OUTLOOK_HEADER_RE.search(text)):
+        if match and match.start() > 0:
+            cut = min(cut, match.start())
+    text = text[:cut]
+    return "\n".join(line for line in text.splitlines() if not line.lstrip().startswith(">"))
+
+
+def strip_disclaimer(text: str) -> str:
+    """
+    Убирает дисклеймеры в конце письма (в том числе после подписи). Абзацы
+    в середине письма не трогаются, даже если в них есть похожие слова.
+    """
+    paragraphs = re.split(r"\n\s*\n", text)
+    while len(paragraphs) > 1 and _disclaimer_re.search(paragraphs[-1]):
+        paragraphs.pop()
+    return "\n\n".join(paragraphs)
+
+
+def split_signature(text: str):
+    """Возвращает (текст, подпись) без мобильных приписок и юридических дисклеймеров."""
+    text = strip_disclaimer(MOBILE_FOOTER_RE.sub("", text).strip())
+
+    match = _signature_re.search(text)
+    if not match or match.start() == 0:
+        return text.strip(), ""
+    signature_lines = [
+        line for line in text[match.start() :].splitlines()[1:] if line.strip()
+    ]
+    signature = "\n".join(signature_lines[:SIGNATURE_MAX_LINES])
+    return text[: match.start()].strip(), signature.strip()
+
+
+def truncate_to_budget(text: str, max_tokens: int = NORMALIZE_MAX_TOKENS) -> str:
+    """Обрезает текст по приблизительному числу токенов, по границе слова."""
+    limit = int(max_tokens * NORMALIZE_CHARS_PER_TOKEN)
+    if len(text) <= limit:
+        return text
+    cut = text.rfind(" ", 0, limit)
+    return text[: cut if cut > limit // 2 else limit].rstrip() + "\n[...]"
+
+
+def normalize_letter(text: str, message_id: str = None) -> Dict[str, str]:
+    """
+    Готовит текст письма для LLM: без цитат, подписи и дисклеймеров, в пределах
+    бюджета токенов. Результат {"body", "signature"} кешируется по message_id.
+    """
+    if message_id:
+        with _cache_lock:
+            cached = _cache.get(message_id)
+            if cached is not None:
+                _cache.move_to_end(message_id)
+                return cached
+
+    with observe_stage("normalize"):
+        body, signature = split_signature(strip_quoted(collapse_whitespace(text or "")))
+        result = {"body": truncate_to_budget(body), "signature": signature}
+
+    NORMALIZE_CHARS.labels("raw").inc(len(text or ""))
+    NORMALIZE_CHARS.labels("normalized").inc(len(result["body"]) + len(signature))
+
+    if message_id:
+        with _cache_lock:
+            _cache[message_id] = result
+            while len(_cache) > NORMALIZE_CACHE_SIZE:
+                _cache.popitem(last=False)
+    return result
@@ -0,0 +1,106 @@
+import json
+import os
+from datetime import datetime
+from typing import Dict, List
+
+from opentelemetry import trace
+from opentelemetry.propagate import inject
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+# file - JSON-строки в TRACE_FILE, otlp - коллектор по OTLP/HTTP, none - выключено
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "file")
+# Общий файл для API и всех процессов scheduler: путь не зависит от рабочего
+# каталога, на нескольких узлах TRACE_FILE должен указывать на общий том
+TRACE_FILE = os.getenv(
+    "TRACE_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "traces.jsonl")
+)
+OTLP_ENDPOINT = os.getenv("OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+
+tracer = trace.get_tracer("mail_pipeline")
+
+
+def setup_tracing(service_name: str):
+    """Настраивает экспорт спанов для процесса (API или scheduler)."""
+    if TRACE_EXPORTER == "none":
+        return
+
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+
+    if TRACE_EXPORTER == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+            OTLPSpanExporter,
+        )
+
+        exporter = OTLPSpanExporter(endpoint=OTLP_ENDPOINT)
+    else:
+        exporter = ConsoleSpanExporter(
+            out=open(TRACE_FILE, "a", encoding="utf-8"),
+            formatter=lambda span: span.to_json(indent=None) + "\n",
+        )
+
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+
+
+def current_trace_id() -> str:
+    span_context = trace.get_current_span().get_span_context()
+    if not span_context.is_valid:
+        return ""
+    return format(span_context.trace_id, "032x")
+
+
+def trace_context() -> Dict[str, str]:
+    """Контекст текущего спана (traceparent), чтобы продолжить трейс в другом процессе."""
+    carrier: Dict[str, str] = {}
+    inject(carrier)
+    return carrier
+
+
+def parse_span_time(value: str) -> datetime:
+    """
+    Время спана из ConsoleSpanExporter ("2024-05-01T10:00:00.123456Z").
+    fromisoformat в Python 3.10 (образ backend) не понимает суффикс Z.
+    """
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    return datetime.fromisoformat(value)
+
+
+def load_trace(trace_id: str) -> List[Dict]:
+    """
+    Читает спаны одного трейса из TRACE_FILE, упорядоченные по началу.
+    Файл может быть большим - в API вызывается через asyncio.to_thread.
+    """
+    if not trace_id or not os.path.exists(TRACE_FILE):
+        return []
+
+    spans = []
+    with open(TRACE_FILE, encoding="utf-8") as f:
+        for line in f:
+            if trace_id not in line:
+                continue
+            try:
+                span = json.loads(line)
+            except ValueError:
+                # Строку в этот момент дописывает другой процесс
+                continue
+            if span["context"]["trace_id"].removeprefix("0x") != trace_id:
+                continue
+            started = parse_span_time(span["start_time"])
+            finished = parse_span_time(span["end_time"])
+            spans.append(
+                {
+                    "name": span["name"],
+                    "span_id": span["context"]["span_id"],
+                    "parent_id": span.get("parent_id"),
+                    "service": span["resource"]["attributes"].get("service.name"),
+                    "start_time": span["start_time"],
+                    "end_time": span["end_time"],
+                    "duration_ms": (finished - started).total_seconds() * 1000,
+                    "status": span["status"]["status_code"],
+                    "attributes": span.get("attributes", {}),
+                }
+            )
+    return sorted(spans, key=lambda s: s["start_time"])
@@ -1,5 +1,13 @@
-from datetime import date, datetime
-from typing import Optional, Union
+import email.utils
+import json
+from datetime import date, datetime, timezone
+from typing import Any, Dict, List, Optional, Union
+
+try:
+    # orjson сериализует страницу обращений в разы быстрее json
+    import orjson
+except ImportError:
+    orjson = None
 
 
 def parse_date_string(date_str: str) -> date:
@@ -26,8 +34,6 @@ def parse_date_string(date_str: str) -> date:
             continue
 
     try:
-        import email.utils
-
         dt = email.utils.parsedate_to_datetime(date_str)
         return dt.date()
     except:
@@ -44,3 +50,33 @@ def date_to_str(date_obj: Optional[Union[date, datetime, str]]) -> str:
     if isinstance(date_obj, (date, datetime)):
         return date_obj.strftime("%Y-%m-%d")
     return str(date_obj)
+
+
+def normalize_task_status(value: Any) -> Any:
+    """Статус в написании enum task_statuses: прежнее 'IN PROGRESS' -> 'IN_PROGRESS'."""
+    if isinstance(value, str):
+        return value.strip().upper().replace(" ", "_")
+    return value
+
+
+def dumps_json(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf8")
+
+
+def parse_mail_dates(values: List[str]) -> List[Optional[datetime]]:
+    """
+    Заголовки Date пачкой писем: каждое уникальное значение разбирается один раз
+    сразу как RFC 2822, без перебора форматов. Неразобранные даты - None.
+    """
+    parsed: Dict[str, Optional[datetime]] = {}
+    for value in set(values):
+        try:
+            dt = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError, IndexError):
+            dt = None
+        if dt is not None and dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        parsed[value] = dt
+    return [parsed[value] for value in values]
@@ -1,7 +1,7 @@
 import os
 import glob
 import logging
-from typing import List, Optional, Tuple
+from typing import Callable, List, Optional, Tuple
 
 logging.getLogger("sentence_transformers").setLevel(logging.WARNING)
 logging.basicConfig(
@@ -13,19 +13,35 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_chroma import Chroma
 from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
 
+from metrics import observe_stage
 from cfg import (
     EMBEDDING_MODEL,
     PERSIST_DIRECTORY,
     PDF_FOLDER,
     PERSIST_DIRECTORY_HISTORY,
     SIMILARITY_THRESHOLD,
+    VECTOR_BACKEND,
+    VECTOR_SNAPSHOT_DIR,
 )
 
 logger = logging.getLogger(__name__)
 
 
-embeddings = HuggingFaceEmbeddings(
+class TimedEmbeddings(HuggingFaceEmbeddings):
+    """HuggingFaceEmbeddings с замером времени для метрик."""
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with observe_stage("embedding"):
+            return super().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with observe_stage("embedding"):
+            return super().embed_query(text)
+
+
+embeddings = TimedEmbeddings(
     model_name=EMBEDDING_MODEL,
     model_kwargs={"device": "cpu"},
     encode_kwargs={"normalize_embeddings": True},
@@ -36,7 +52,20 @@ text_splitter = RecursiveCharacterTextSplitter(
 )
 
 
-def get_rag_index() -> Chroma:
+def _pg_index(table: str):
+    # psycopg нужен только этому бэкенду
+    from vector_pg import PgVectorStore
+
+    return PgVectorStore(table, embeddings)
+
+
+def index_size(db: VectorStore) -> int:
+    if isinstance(db, Chroma):
+        return db._collection.count()
+    return db.count()
+
+
+def chroma_rag_index() -> Chroma:
     if os.path.exists(PERSIST_DIRECTORY) and os.path.isdir(PERSIST_DIRECTORY):
         vectorstore = Chroma(
             persist_directory=PERSIST_DIRECTORY, embedding_function=embeddings
@@ -58,7 +87,7 @@ def get_rag_index() -> Chroma:
         return vectorstore
 
 
-def get_history_index() -> Chroma:
+def chroma_history_index() -> Chroma:
     if os.path.exists(PERSIST_DIRECTORY_HISTORY) and os.path.isdir(
         PERSIST_DIRECTORY_HISTORY
     ):
@@ -76,27 +105,96 @@ def get_history_index() -> Chroma:
         return vectorstore
 
 
-def find_similar_letter(db: Chroma, text: str) -> Optional[str]:
+def _snapshot_index(name: str, build_from: Callable[[], Chroma], writable: bool = False):
+    # numpy и mmap-снимки нужны только этому бэкенду
+    from vector_snapshot import SnapshotIndex, compile_from_chroma, ensure_snapshot, spool_dir
+
+    # Первый процесс собирает снимок из Chroma, остальные сразу открывают готовый
+    ensure_snapshot(
+        VECTOR_SNAPSHOT_DIR,
+        name,
+        lambda: compile_from_chroma(VECTOR_SNAPSHOT_DIR, name, build_from()),
+    )
+    return SnapshotIndex(
+        VECTOR_SNAPSHOT_DIR,
+        name,
+        embeddings,
+        spool_dir=spool_dir(VECTOR_SNAPSHOT_DIR, name) if writable else None,
+    )
+
+
+def get_rag_index() -> VectorStore:
+    if VECTOR_BACKEND == "pgvector":
+        from vector_pg import RAG_TABLE
+
+        vectorstore = _pg_index(RAG_TABLE)
+        added = vectorstore.fill_if_empty(lambda: load_and_split_pdfs(PDF_FOLDER))
+        if added:
+            logger.info(f"RAG индекс создан. Чанков: {added}")
+        else:
+            logger.info(f"RAG индекс загружен. Чанков: {vectorstore.count()}")
+        return vectorstore
+
+    if VECTOR_BACKEND == "snapshot":
+        vectorstore = _snapshot_index("rag", chroma_rag_index)
+        logger.info(f"RAG снимок открыт. Чанков: {vectorstore.count()}")
+        return vectorstore
+
+    return chroma_rag_index()
+
+
+def get_history_index() -> VectorStore:
+    if VECTOR_BACKEND == "pgvector":
+        from vector_pg import HISTORY_TABLE
+
+        vectorstore = _pg_index(HISTORY_TABLE)
+        logger.info(f"History индекс загружен. Записей: {vectorstore.count()}")
+        return vectorstore
+
+    if VECTOR_BACKEND == "snapshot":
+        # Записи уходят в очередь писателя и видны после публикации снимка
+        vectorstore = _snapshot_index("history", chroma_history_index, writable=True)
+        logger.info(f"History снимок открыт. Записей: {vectorstore.count()}")
+        return vectorstore
+
+    return chroma_history_index()
+
+
+def distance_to_similarity(score: float) -> float:
+    """
+    Квадрат L2-расстояния между нормированными эмбеддингами -> косинусная
+    близость: ||a - b||^2 = 2 - 2cos. Chroma по умолчанию возвращает именно
+    квадрат расстояния, pgvector и снимки возвращают те же единицы.
+    """
+    return 1 - score / 2
+
+
+def find_similar_letter_scored(db: VectorStore, text: str) -> Tuple[Optional[str], float]:
+    """Готовый ответ из истории (если похожесть выше порога) и сама похожесть."""
     results = db.similarity_search_with_score(text, k=1)
 
     if not results:
-        return None
+        return None, 0.0
 
     doc, score = results[0]
 
-    similarity = 1 - (score**2) / 2
+    similarity = distance_to_similarity(score)
 
     logger.debug(f"схожесть={similarity:.4f}, порог={SIMILARITY_THRESHOLD}")
 
     if similarity >= SIMILARITY_THRESHOLD:
         answer = doc.metadata.get("llm_answer")
         if answer:
-            return answer
+            return answer, similarity
 
-    return None
+    return None, similarity
 
 
-def save_letter_to_history(db: Chroma, question: str, answer: str, message_id: str):
+def find_similar_letter(db: VectorStore, text: str) -> Optional[str]:
+    return find_similar_letter_scored(db, text)[0]
+
+
+def save_letter_to_history(db: VectorStore, question: str, answer: str, message_id: str):
     doc = Document(
         page_content=question,
         metadata={
@@ -125,12 +223,18 @@ def load_and_split_pdfs(folder_path: str) -> List[Document]:
     return text_splitter.split_documents(all_docs)
 
 
-def get_or_create_index() -> Chroma:
+def get_or_create_index() -> VectorStore:
 
     return get_rag_index()
 
 
-def create_vector_store(documents: List[Document]) -> Chroma:
+def create_vector_store(documents: List[Document]) -> VectorStore:
+    if VECTOR_BACKEND == "pgvector":
+        from vector_pg import RAG_TABLE
+
+        vectorstore = _pg_index(RAG_TABLE)
+        vectorstore.add_documents(documents)
+        return vectorstore
     return Chroma.from_documents(
         documents=documents, embedding=embeddings, persist_directory=PERSIST_DIRECTORY
     )
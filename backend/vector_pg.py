@@ -0,0 +1,187 @@
+"""
+Векторный индекс в Postgres (pgvector) для VECTOR_BACKEND=pgvector. В отличие от
+каталога Chroma индекс общий для всех воркеров и узлов, а история ответов
+соединяется с requests прямо в SQL. Таблицы и HNSW-индексы - 12-vector-store.sql.
+"""
+
+import json
+import logging
+import os
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from psycopg import sql
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import ConnectionPool
+
+from cfg import (
+    POSTGRES_DB_NAME,
+    POSTGRES_DB_PASS,
+    POSTGRES_DB_USER,
+    POSTGRES_HOSTNAME,
+    POSTGRES_PORT,
+)
+
+logger = logging.getLogger(__name__)
+
+RAG_TABLE = "vector_rag"
+HISTORY_TABLE = "vector_history"
+
+PGVECTOR_POOL_MAX = int(os.getenv("PGVECTOR_POOL_MAX", "4"))
+# Сколько кандидатов просматривает HNSW при поиске: больше - точнее и медленнее
+PGVECTOR_EF_SEARCH = int(os.getenv("PGVECTOR_EF_SEARCH", "64"))
+# Документов на один вызов модели эмбеддингов и один INSERT
+PGVECTOR_INSERT_BATCH = int(os.getenv("PGVECTOR_INSERT_BATCH", "256"))
+
+_pool: Optional[ConnectionPool] = None
+
+
+def _configure(conn):
+    conn.execute(sql.SQL("SET hnsw.ef_search = {}").format(sql.Literal(PGVECTOR_EF_SEARCH)))
+
+
+def get_pool() -> ConnectionPool:
+    """Один пул на процесс для обоих индексов."""
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool(
+            make_conninfo(
+                user=POSTGRES_DB_USER,
+                password=POSTGRES_DB_PASS,
+                dbname=POSTGRES_DB_NAME,
+                host=POSTGRES_HOSTNAME,
+                port=POSTGRES_PORT,
+            ),
+            min_size=1,
+            max_size=PGVECTOR_POOL_MAX,
+            kwargs={"autocommit": True},
+            configure=_configure,
+            open=True,
+        )
+    return _pool
+
+
+def to_vector(values: List[float]) -> str:
+    """Текстовый литерал типа vector: [0.1,0.2,...]"""
+    return "[" + ",".join(f"{value:.7g}" for value in values) + "]"
+
+
+class PgVectorStore(VectorStore):
+    """
+    Индекс в таблице table с той же семантикой, что и Chroma в vector_base:
+    similarity_search_with_score возвращает квадрат L2-расстояния между
+    нормированными эмбеддингами, близость из него считает distance_to_similarity.
+    """
+
+    def __init__(self, table: str, embedding: Embeddings, pool: Optional[ConnectionPool] = None):
+        self.table = table
+        self._embedding = embedding
+        self.pool = pool or get_pool()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def add_texts(
+        self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any
+    ) -> List[str]:
+        texts = list(texts)
+        metadatas = list(metadatas) if metadatas else [{} for _ in texts]
+        ids = []
+        for start in range(0, len(texts), PGVECTOR_INSERT_BATCH):
+            batch = texts[start : start + PGVECTOR_INSERT_BATCH]
+            vectors = self._embedding.embed_documents(batch)
+            ids.extend(
+                self.add_embeddings(
+                    batch, vectors, metadatas[start : start + PGVECTOR_INSERT_BATCH]
+                )
+            )
+        return ids
+
+    def add_embeddings(
+        self, texts: List[str], vectors: List[List[float]], metadatas: List[dict]
+    ) -> List[str]:
+        """Пачка готовых эмбеддингов одним INSERT."""
+        query = sql.SQL(
+            """
+            INSERT INTO {} (content, metadata, embedding)
+            SELECT * FROM unnest(%s::text[], %s::jsonb[], %s::vector[])
+            RETURNING doc_id
+            """
+        ).format(sql.Identifier(self.table))
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                query,
+                (
+                    texts,
+                    [json.dumps(metadata, ensure_ascii=False, default=str) for metadata in metadatas],
+                    [to_vector(vector) for vector in vectors],
+                ),
+            ).fetchall()
+        return [str(row[0]) for row in rows]
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: List[float], k: int = 4
+    ) -> List[Tuple[Document, float]]:
+        query = sql.SQL(
+            """
+            SELECT content, metadata, (embedding <-> %s::vector) ^ 2 AS distance
+            FROM {}
+            ORDER BY embedding <-> %s::vector
+            LIMIT %s
+            """
+        ).format(sql.Identifier(self.table))
+        vector = to_vector(embedding)
+        with self.pool.connection() as conn:
+            rows = conn.execute(query, (vector, vector, k)).fetchall()
+        return [
+            (Document(page_content=content, metadata=metadata or {}), float(distance))
+            for content, metadata, distance in rows
+        ]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self._embedding.embed_query(query), k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def count(self) -> int:
+        with self.pool.connection() as conn:
+            return conn.execute(
+                sql.SQL("SELECT count(*) FROM {}").format(sql.Identifier(self.table))
+            ).fetchone()[0]
+
+    def fill_if_empty(self, load_documents: Callable[[], List[Document]]) -> int:
+        """
+        Наполняет пустой индекс под advisory lock: при одновременном старте
+        воркеров индекс строит один, остальные дожидаются его. Возвращает
+        число добавленных документов.
+        """
+        with self.pool.connection() as conn:
+            conn.execute("SELECT pg_advisory_lock(hashtext(%s))", (self.table,))
+            try:
+                if self.count():
+                    return 0
+                docs = load_documents()
+                if docs:
+                    self.add_documents(docs)
+                return len(docs)
+            finally:
+                conn.execute("SELECT pg_advisory_unlock(hashtext(%s))", (self.table,))
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        table: str = RAG_TABLE,
+        **kwargs: Any,
+    ) -> "PgVectorStore":
+        store = cls(table, embedding)
+        store.add_texts(texts, metadatas)
+        return store
@@ -0,0 +1,456 @@
+"""
+Неизменяемые снимки векторных индексов для VECTOR_BACKEND=snapshot: векторы
+одним непрерывным массивом float32 и фрагменты в JSON Lines, открываются через
+mmap. Все процессы узла делят одни страницы в page cache, а новый воркер
+открывает индекс за миллисекунды без загрузки Chroma.
+
+    <VECTOR_SNAPSHOT_DIR>/<name>/CURRENT           - имя текущей версии
+    <VECTOR_SNAPSHOT_DIR>/<name>/<version>/vectors.f32
+    <VECTOR_SNAPSHOT_DIR>/<name>/<version>/offsets.u64
+    <VECTOR_SNAPSHOT_DIR>/<name>/<version>/chunks.jsonl
+    <VECTOR_SNAPSHOT_DIR>/<name>/<version>/meta.json
+
+Воркеры не пишут в снимок истории: новые записи с уже посчитанными эмбеддингами
+складываются в <name>.spool, а единственный писатель (координатор scheduler)
+публикует их новой версией снимка.
+
+    python vector_snapshot.py compile rag
+    python vector_snapshot.py compile history
+"""
+
+import argparse
+import fcntl
+import json
+import logging
+import mmap
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from cfg import EMBEDDING_MODEL, VECTOR_SNAPSHOT_DIR
+
+logger = logging.getLogger(__name__)
+
+RAG_SNAPSHOT = "rag"
+HISTORY_SNAPSHOT = "history"
+
+# Сколько последних версий хранить всегда; более старые удаляются, как только
+# их не держит открытыми ни один читатель
+VECTOR_SNAPSHOT_KEEP = int(os.getenv("VECTOR_SNAPSHOT_KEEP", "2"))
+COPY_CHUNK_ROWS = 65536
+
+
+@contextmanager
+def snapshot_lock(root: str, name: str):
+    """Блокировка писателя снимка name на этом узле."""
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, f".{name}.lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def current_version(root: str, name: str) -> Optional[str]:
+    try:
+        with open(os.path.join(root, name, "CURRENT"), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _remove_version(path: str) -> bool:
+    """
+    Удаляет версию, если ее не держит ни один читатель: Snapshot держит
+    разделяемый flock на meta.json версии, пока открыт. False - версия занята.
+    """
+    try:
+        f = open(os.path.join(path, "meta.json"), "rb")
+    except FileNotFoundError:
+        # Версия, недописанная из-за сбоя писателя, читателей у нее нет
+        shutil.rmtree(path, ignore_errors=True)
+        return True
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        shutil.rmtree(path, ignore_errors=True)
+    return True
+
+
+def _publish(root: str, name: str, version: str):
+    """Атомарно переключает CURRENT на версию и удаляет старые свободные версии."""
+    base = os.path.join(root, name)
+    tmp_path = os.path.join(base, f"CURRENT.{os.getpid()}")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp_path, os.path.join(base, "CURRENT"))
+
+    # Занятые читателями версии удалит одна из следующих публикаций
+    versions = sorted(
+        entry for entry in os.listdir(base) if os.path.isdir(os.path.join(base, entry))
+    )
+    for old in versions[:-VECTOR_SNAPSHOT_KEEP]:
+        if old != version and not _remove_version(os.path.join(base, old)):
+            logger.info(f"Версия {old} снимка {name} еще открыта читателями")
+
+
+def write_snapshot(
+    root: str,
+    name: str,
+    vector_blocks: Iterable[np.ndarray],
+    records: Iterable[Dict[str, Any]],
+    base: Optional["Snapshot"] = None,
+) -> str:
+    """
+    Пишет новую версию снимка: векторы base (если есть), затем vector_blocks;
+    records - {"content", "metadata"} в том же порядке. Возвращает версию.
+    """
+    # Имена версий упорядочены по времени создания
+    version = str(time.time_ns())
+    path = os.path.join(root, name, version)
+    os.makedirs(path)
+
+    dim = base.dim if base is not None else 0
+    count = 0
+    with open(os.path.join(path, "vectors.f32"), "wb") as f:
+        if base is not None:
+            for start in range(0, base.count, COPY_CHUNK_ROWS):
+                f.write(np.ascontiguousarray(base.vectors[start : start + COPY_CHUNK_ROWS]).tobytes())
+            count = base.count
+        for block in vector_blocks:
+            block = np.asarray(block, dtype=np.float32)
+            if not len(block):
+                continue
+            if dim and block.shape[1] != dim:
+                raise ValueError(f"Размерность {block.shape[1]} не совпадает со снимком ({dim})")
+            dim = block.shape[1]
+            f.write(block.tobytes())
+            count += len(block)
+
+    offsets = [0]
+    with open(os.path.join(path, "chunks.jsonl"), "wb") as f:
+        if base is not None:
+            f.write(base.chunks[: base.chunks_size])
+            offsets = [int(offset) for offset in base.offsets]
+        for record in records:
+            line = json.dumps(record, ensure_ascii=False, default=str).encode("utf8") + b"\n"
+            f.write(line)
+            offsets.append(offsets[-1] + len(line))
+    if len(offsets) - 1 != count:
+        raise ValueError(f"Векторов {count}, а фрагментов {len(offsets) - 1}")
+    np.asarray(offsets, dtype=np.uint64).tofile(os.path.join(path, "offsets.u64"))
+
+    with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(
+            {"count": count, "dim": dim, "model": EMBEDDING_MODEL, "created_at": time.time()}, f
+        )
+    _publish(root, name, version)
+    logger.info(f"Снимок {name} версии {version}: {count} векторов")
+    return version
+
+
+class Snapshot:
+    """
+    Одна открытая через mmap версия снимка. Пока снимок открыт, на meta.json
+    версии держится разделяемый flock, и писатель ее не удаляет; close()
+    освобождает файлы и блокировку.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self.chunks = b""
+        self._lock_file = open(os.path.join(path, "meta.json"), "rb")
+        try:
+            self._open()
+        except BaseException:
+            self.close()
+            raise
+
+    def _open(self):
+        path = self.path
+        fcntl.flock(self._lock_file, fcntl.LOCK_SH)
+        # Писатель успел удалить версию, пока ждали блокировку
+        if os.fstat(self._lock_file.fileno()).st_nlink == 0:
+            raise FileNotFoundError(f"Версия {path} удалена")
+        meta = json.load(self._lock_file)
+        self.count = meta["count"]
+        self.dim = meta["dim"]
+        if meta.get("model") != EMBEDDING_MODEL:
+            logger.warning(f"Снимок {path} собран моделью {meta.get('model')}, а не {EMBEDDING_MODEL}")
+
+        if self.count:
+            self.vectors = np.memmap(
+                os.path.join(path, "vectors.f32"), dtype=np.float32, mode="r", shape=(self.count, self.dim)
+            )
+        else:
+            self.vectors = np.empty((0, self.dim), dtype=np.float32)
+        self.offsets = np.fromfile(os.path.join(path, "offsets.u64"), dtype=np.uint64)
+        self.chunks_size = int(self.offsets[-1])
+        self._file = open(os.path.join(path, "chunks.jsonl"), "rb")
+        self.chunks = (
+            mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.chunks_size else b""
+        )
+
+    def close(self):
+        if isinstance(self.chunks, mmap.mmap):
+            self.chunks.close()
+        self.chunks = b""
+        # Отображение векторов закрывается вместе с последней ссылкой на memmap
+        self.vectors = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def record(self, i: int) -> Dict[str, Any]:
+        return json.loads(self.chunks[int(self.offsets[i]) : int(self.offsets[i + 1])])
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[int, float]]:
+        """
+        Индексы k ближайших и квадраты L2-расстояний, как у Chroma и pgvector:
+        для нормированных эмбеддингов ||a - b||^2 = 2 - 2cos.
+        """
+        if not self.count:
+            return []
+        k = min(k, self.count)
+        scores = self.vectors @ query
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), max(0.0, 2.0 - 2.0 * float(scores[i]))) for i in top]
+
+
+class SnapshotIndex(VectorStore):
+    """
+    Индекс поверх последней версии снимка с той же семантикой оценок, что у
+    Chroma в vector_base. Новая версия подхватывается при следующем поиске.
+    С spool_dir добавление пишет записи в очередь писателя, без него индекс
+    только для чтения. Прежняя версия закрывается, когда ее не использует ни
+    один поиск.
+    """
+
+    def __init__(self, root: str, name: str, embedding: Embeddings, spool_dir: Optional[str] = None):
+        self.root = root
+        self.name = name
+        self._embedding = embedding
+        self.spool_dir = spool_dir
+        self._version = None
+        self._snapshot: Optional[Snapshot] = None
+        # Поиски, идущие по каждой открытой версии (поиск бывает из потоков)
+        self._users: Dict[Snapshot, int] = {}
+        self._lock = threading.Lock()
+        with self._lock:
+            self._refresh()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def _refresh(self) -> Snapshot:
+        """Открывает текущую версию, если она сменилась. Вызывается под self._lock."""
+        while True:
+            version = current_version(self.root, self.name)
+            if version is None:
+                raise FileNotFoundError(
+                    f"Нет снимка {self.name} в {self.root}: python vector_snapshot.py compile {self.name}"
+                )
+            if version == self._version:
+                return self._snapshot
+            try:
+                snapshot = Snapshot(os.path.join(self.root, self.name, version))
+            except FileNotFoundError:
+                # Версию удалили между чтением CURRENT и открытием: есть новее
+                continue
+            previous = self._snapshot
+            self._snapshot, self._version = snapshot, version
+            if previous is not None and not self._users.get(previous):
+                previous.close()
+            return snapshot
+
+    @contextmanager
+    def _current(self):
+        with self._lock:
+            snapshot = self._refresh()
+            self._users[snapshot] = self._users.get(snapshot, 0) + 1
+        try:
+            yield snapshot
+        finally:
+            with self._lock:
+                self._users[snapshot] -= 1
+                if not self._users[snapshot]:
+                    del self._users[snapshot]
+                    if snapshot is not self._snapshot:
+                        snapshot.close()
+
+    def count(self) -> int:
+        with self._current() as snapshot:
+            return snapshot.count
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: List[float], k: int = 4
+    ) -> List[Tuple[Document, float]]:
+        results = []
+        with self._current() as snapshot:
+            for i, distance in snapshot.search(np.asarray(embedding, dtype=np.float32), k):
+                record = snapshot.record(i)
+                results.append(
+                    (Document(page_content=record["content"], metadata=record["metadata"]), distance)
+                )
+        return results
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self._embedding.embed_query(query), k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def add_texts(
+        self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any
+    ) -> List[str]:
+        if self.spool_dir is None:
+            raise PermissionError(f"Снимок {self.name} только для чтения")
+        texts = list(texts)
+        metadatas = list(metadatas) if metadatas else [{} for _ in texts]
+        entry_id = f"{time.time_ns()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        os.makedirs(self.spool_dir, exist_ok=True)
+        tmp_path = os.path.join(self.spool_dir, f".{entry_id}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "texts": texts,
+                    "metadatas": metadatas,
+                    "vectors": self._embedding.embed_documents(texts),
+                },
+                f,
+                ensure_ascii=False,
+                default=str,
+            )
+        os.replace(tmp_path, os.path.join(self.spool_dir, f"{entry_id}.json"))
+        return [f"{entry_id}:{i}" for i in range(len(texts))]
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        root: str = VECTOR_SNAPSHOT_DIR,
+        name: str = RAG_SNAPSHOT,
+        **kwargs: Any,
+    ) -> "SnapshotIndex":
+        metadatas = metadatas or [{} for _ in texts]
+        with snapshot_lock(root, name):
+            write_snapshot(
+                root,
+                name,
+                [np.asarray(embedding.embed_documents(texts), dtype=np.float32)],
+                ({"content": text, "metadata": metadata} for text, metadata in zip(texts, metadatas)),
+            )
+        return cls(root, name, embedding)
+
+
+def spool_dir(root: str, name: str) -> str:
+    return os.path.join(root, f"{name}.spool")
+
+
+def ensure_snapshot(root: str, name: str, build: Callable[[], None]) -> bool:
+    """Собирает снимок, если его еще нет; одновременно стартующие процессы ждут одного."""
+    if current_version(root, name) is not None:
+        return False
+    with snapshot_lock(root, name):
+        if current_version(root, name) is not None:
+            return False
+        build()
+        return True
+
+
+def publish_spool(root: str, name: str) -> int:
+    """
+    Единственный писатель: переносит накопленные в spool записи в новую версию
+    снимка. Возвращает число добавленных записей.
+    """
+    directory = spool_dir(root, name)
+    if not os.path.isdir(directory):
+        return 0
+    with snapshot_lock(root, name):
+        files = sorted(entry for entry in os.listdir(directory) if entry.endswith(".json"))
+        if not files:
+            return 0
+        blocks, records = [], []
+        for entry in files:
+            with open(os.path.join(directory, entry), encoding="utf-8") as f:
+                item = json.load(f)
+            blocks.append(np.asarray(item["vectors"], dtype=np.float32))
+            records.extend(
+                {"content": text, "metadata": metadata}
+                for text, metadata in zip(item["texts"], item["metadatas"])
+            )
+
+        version = current_version(root, name)
+        base = Snapshot(os.path.join(root, name, version)) if version else None
+        try:
+            write_snapshot(root, name, blocks, records, base=base)
+        finally:
+            if base is not None:
+                base.close()
+        for entry in files:
+            os.remove(os.path.join(directory, entry))
+    return len(records)
+
+
+def compile_from_chroma(root: str, name: str, chroma) -> int:
+    """Снимок из индекса Chroma: эмбеддинги берутся готовыми, без пересчета."""
+    data = chroma._collection.get(include=["embeddings", "documents", "metadatas"])
+    embeddings = data["embeddings"] if data["embeddings"] is not None else []
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    write_snapshot(
+        root,
+        name,
+        [vectors],
+        (
+            {"content": text, "metadata": metadata or {}}
+            for text, metadata in zip(data["documents"], data["metadatas"])
+        ),
+    )
+    return len(vectors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Снимки векторных индексов")
+    sub = parser.add_subparsers(dest="command", required=True)
+    compile_parser = sub.add_parser("compile", help="собрать снимок из индекса Chroma")
+    compile_parser.add_argument("name", choices=[RAG_SNAPSHOT, HISTORY_SNAPSHOT])
+    sub.add_parser("publish", help="опубликовать накопленные записи истории")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "publish":
+        print(f"Опубликовано записей: {publish_spool(VECTOR_SNAPSHOT_DIR, HISTORY_SNAPSHOT)}")
+        return
+
+    from vector_base import chroma_history_index, chroma_rag_index
+
+    chroma = chroma_rag_index() if args.name == RAG_SNAPSHOT else chroma_history_index()
+    with snapshot_lock(VECTOR_SNAPSHOT_DIR, args.name):
+        count = compile_from_chroma(VECTOR_SNAPSHOT_DIR, args.name, chroma)
+    print(f"Снимок {args.name}: {count} векторов")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+-- Очередь обработки писем: этап (stage) - последний успешно пройденный шаг,
+-- с него продолжается обработка после ошибки.
+CREATE TABLE IF NOT EXISTS letter_jobs (
+  job_id            BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+  message_id        TEXT NOT NULL UNIQUE,
+  priority          SMALLINT NOT NULL DEFAULT 1,
+  stage             TEXT NOT NULL DEFAULT 'fetched',
+  status            TEXT NOT NULL DEFAULT 'pending',
+  letter            JSONB NOT NULL,
+  extracted         JSONB,
+  llm_answer        TEXT,
+  attempts          INT NOT NULL DEFAULT 0,
+  last_error        TEXT,
+  next_attempt_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+  created_at        TIMESTAMPTZ NOT NULL DEFAULT now(),
+  updated_at        TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS letter_jobs_pending_idx
+  ON letter_jobs (priority, job_id)
+  WHERE status = 'pending';
+
+-- Письма, которые не удалось обработать за MAX_ATTEMPTS попыток
+CREATE TABLE IF NOT EXISTS letter_dead_jobs (
+  job_id            BIGINT PRIMARY KEY,
+  message_id        TEXT NOT NULL,
+  priority          SMALLINT NOT NULL,
+  stage             TEXT NOT NULL,
+  letter            JSONB NOT NULL,
+  extracted         JSONB,
+  llm_answer        TEXT,
+  attempts          INT NOT NULL,
+  last_error        TEXT,
+  created_at        TIMESTAMPTZ NOT NULL,
+  failed_at         TIMESTAMPTZ NOT NULL DEFAULT now()
+);
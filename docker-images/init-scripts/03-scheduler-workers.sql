@@ -0,0 +1,16 @@
+-- Аренда задач: воркер продлевает lease_until, пока обрабатывает письмо.
+-- Задачи упавших воркеров забираются повторно после истечения аренды.
+ALTER TABLE letter_jobs ADD COLUMN IF NOT EXISTS locked_by TEXT;
+ALTER TABLE letter_jobs ADD COLUMN IF NOT EXISTS lease_until TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS letter_jobs_lease_idx
+  ON letter_jobs (lease_until)
+  WHERE status = 'running';
+
+CREATE TABLE IF NOT EXISTS scheduler_workers (
+  worker_id         TEXT PRIMARY KEY,
+  hostname          TEXT NOT NULL,
+  role              TEXT NOT NULL,
+  started_at        TIMESTAMPTZ NOT NULL DEFAULT now(),
+  heartbeat_at      TIMESTAMPTZ NOT NULL DEFAULT now()
+);
@@ -0,0 +1,2 @@
+-- Идентификатор трейса обработки письма (OpenTelemetry)
+ALTER TABLE requests ADD COLUMN IF NOT EXISTS trace_id TEXT;
@@ -0,0 +1,7 @@
+-- Локальная копия почтового ящика для /api/fetchMails
+CREATE TABLE IF NOT EXISTS mailbox_messages (
+  uid               BIGINT PRIMARY KEY,
+  message_id        TEXT NOT NULL,
+  letter            JSONB NOT NULL,
+  fetched_at        TIMESTAMPTZ NOT NULL DEFAULT now()
+);
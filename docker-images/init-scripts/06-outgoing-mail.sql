@@ -0,0 +1,23 @@
+-- Очередь исходящих писем: /api/sendMail только ставит письмо в очередь,
+-- отправляют фоновые отправители API через пул SMTP-соединений.
+CREATE TABLE IF NOT EXISTS outgoing_mail (
+  mail_id           BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+  message_id        TEXT,
+  payload           JSONB NOT NULL,
+  status            TEXT NOT NULL DEFAULT 'pending',
+  attempts          INT NOT NULL DEFAULT 0,
+  last_error        TEXT,
+  next_attempt_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+  lease_until       TIMESTAMPTZ,
+  created_at        TIMESTAMPTZ NOT NULL DEFAULT now(),
+  sent_at           TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS outgoing_mail_pending_idx
+  ON outgoing_mail (next_attempt_at)
+  WHERE status IN ('pending', 'sending');
+
+-- Статус отправки ответа по обращению: queued, sent, failed
+ALTER TABLE requests ADD COLUMN IF NOT EXISTS send_status TEXT;
+ALTER TABLE requests ADD COLUMN IF NOT EXISTS send_error TEXT;
+ALTER TABLE requests ADD COLUMN IF NOT EXISTS sent_at TIMESTAMPTZ;
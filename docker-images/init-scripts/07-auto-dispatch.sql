@@ -0,0 +1,8 @@
+-- Закрытие обращений и статус отправки обновляются по message_id,
+-- без индекса каждый такой UPDATE - полный проход по requests.
+CREATE INDEX IF NOT EXISTS requests_message_id_idx ON requests (message_id);
+
+-- Уверенность в ответе (похожесть из истории или из поиска по инструкциям):
+-- по ней решается, отправлять ли ответ автоматически
+ALTER TABLE letter_jobs ADD COLUMN IF NOT EXISTS answer_confidence REAL;
+ALTER TABLE letter_jobs ADD COLUMN IF NOT EXISTS answer_source TEXT;
@@ -0,0 +1,80 @@
+-- Фильтры таблицы обращений по прибору и заводскому номеру
+CREATE INDEX IF NOT EXISTS requests_device_type_idx ON requests (device_type);
+CREATE INDEX IF NOT EXISTS requests_factory_number_idx ON requests (factory_number);
+CREATE INDEX IF NOT EXISTS requests_object_name_idx ON requests (object_name);
+CREATE INDEX IF NOT EXISTS requests_emotion_idx ON requests (emotion);
+CREATE INDEX IF NOT EXISTS requests_task_status_idx ON requests (task_status);
+
+-- Счетчики значений для /api/requests/facets без фильтров.
+-- Поддерживаются триггером, чтобы не группировать всю таблицу на каждый запрос.
+CREATE TABLE IF NOT EXISTS request_facets (
+  facet             TEXT NOT NULL,
+  value             TEXT NOT NULL,
+  count             BIGINT NOT NULL DEFAULT 0,
+  PRIMARY KEY (facet, value)
+);
+
+CREATE OR REPLACE FUNCTION request_facets_bump(p_facet TEXT, p_value TEXT, p_delta INT)
+RETURNS void AS $$
+BEGIN
+  IF p_value IS NULL THEN
+    RETURN;
+  END IF;
+  INSERT INTO request_facets (facet, value, count)
+  VALUES (p_facet, p_value, p_delta)
+  ON CONFLICT (facet, value) DO UPDATE SET count = request_facets.count + EXCLUDED.count;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION request_facets_sync()
+RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'UPDATE' THEN
+    IF OLD.device_type IS DISTINCT FROM NEW.device_type THEN
+      PERFORM request_facets_bump('device_type', OLD.device_type, -1);
+      PERFORM request_facets_bump('device_type', NEW.device_type, 1);
+    END IF;
+    IF OLD.object_name IS DISTINCT FROM NEW.object_name THEN
+      PERFORM request_facets_bump('object_name', OLD.object_name, -1);
+      PERFORM request_facets_bump('object_name', NEW.object_name, 1);
+    END IF;
+    IF OLD.emotion IS DISTINCT FROM NEW.emotion THEN
+      PERFORM request_facets_bump('emotion', OLD.emotion, -1);
+      PERFORM request_facets_bump('emotion', NEW.emotion, 1);
+    END IF;
+    IF OLD.task_status IS DISTINCT FROM NEW.task_status THEN
+      PERFORM request_facets_bump('task_status', OLD.task_status::text, -1);
+      PERFORM request_facets_bump('task_status', NEW.task_status::text, 1);
+    END IF;
+  ELSIF TG_OP = 'DELETE' THEN
+    PERFORM request_facets_bump('device_type', OLD.device_type, -1);
+    PERFORM request_facets_bump('object_name', OLD.object_name, -1);
+    PERFORM request_facets_bump('emotion', OLD.emotion, -1);
+    PERFORM request_facets_bump('task_status', OLD.task_status::text, -1);
+  ELSE
+    PERFORM request_facets_bump('device_type', NEW.device_type, 1);
+    PERFORM request_facets_bump('object_name', NEW.object_name, 1);
+    PERFORM request_facets_bump('emotion', NEW.emotion, 1);
+    PERFORM request_facets_bump('task_status', NEW.task_status::text, 1);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS request_facets_trigger ON requests;
+CREATE TRIGGER request_facets_trigger
+  AFTER INSERT OR DELETE OR UPDATE OF device_type, object_name, emotion, task_status
+  ON requests
+  FOR EACH ROW EXECUTE FUNCTION request_facets_sync();
+
+-- Начальное заполнение по уже существующим обращениям
+INSERT INTO request_facets (facet, value, count)
+SELECT 'device_type', device_type, count(*) FROM requests GROUP BY device_type
+UNION ALL
+SELECT 'object_name', object_name, count(*) FROM requests GROUP BY object_name
+UNION ALL
+SELECT 'emotion', emotion, count(*) FROM requests GROUP BY emotion
+UNION ALL
+SELECT 'task_status', task_status::text, count(*) FROM requests
+WHERE task_status IS NOT NULL GROUP BY task_status
+ON CONFLICT (facet, value) DO UPDATE SET count = EXCLUDED.count;
@@ -0,0 +1,34 @@
+-- Уведомления об изменениях обращений для /api/stream.
+-- Триггеры уровня оператора: пачечный UPDATE дает одно-два уведомления, а не по строке.
+-- В уведомлении только id (лимит pg_notify 8000 байт), по 500 штук.
+CREATE OR REPLACE FUNCTION requests_notify()
+RETURNS trigger AS $$
+DECLARE
+  ids INT[];
+  i INT;
+BEGIN
+  SELECT array_agg(request_id ORDER BY request_id) INTO ids FROM changed_rows;
+  IF ids IS NULL THEN
+    RETURN NULL;
+  END IF;
+  FOR i IN 1..array_length(ids, 1) BY 500 LOOP
+    PERFORM pg_notify(
+      'requests_changed',
+      json_build_object('op', lower(TG_OP), 'ids', ids[i:i + 499])::text
+    );
+  END LOOP;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS requests_notify_insert ON requests;
+CREATE TRIGGER requests_notify_insert
+  AFTER INSERT ON requests
+  REFERENCING NEW TABLE AS changed_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION requests_notify();
+
+DROP TRIGGER IF EXISTS requests_notify_update ON requests;
+CREATE TRIGGER requests_notify_update
+  AFTER UPDATE ON requests
+  REFERENCING NEW TABLE AS changed_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION requests_notify();
@@ -0,0 +1,192 @@
+-- Помесячное секционирование requests по req_date и холодный архив закрытых обращений.
+-- Горячая таблица держит только рабочие месяцы, фильтр по датам отсекает лишние секции.
+
+CREATE OR REPLACE FUNCTION create_month_partition(p_parent TEXT, p_month DATE, p_options TEXT DEFAULT '')
+RETURNS void AS $$
+DECLARE
+  month_start DATE := date_trunc('month', p_month)::date;
+BEGIN
+  -- Границы месяца в UTC, как и даты в ответах API
+  EXECUTE format(
+    'CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L) %s',
+    p_parent || '_' || to_char(month_start, 'YYYY_MM'),
+    p_parent,
+    month_start::timestamp AT TIME ZONE 'UTC',
+    (month_start + interval '1 month')::timestamp AT TIME ZONE 'UTC',
+    p_options
+  );
+END;
+$$ LANGUAGE plpgsql;
+
+-- Секции на текущий месяц и p_months_ahead вперед; вызывается задачей архивации
+CREATE OR REPLACE FUNCTION ensure_request_partitions(p_months_ahead INT)
+RETURNS void AS $$
+DECLARE
+  i INT;
+BEGIN
+  FOR i IN 0..p_months_ahead LOOP
+    BEGIN
+      PERFORM create_month_partition(
+        'requests', ((now() AT TIME ZONE 'UTC')::date + make_interval(months => i))::date
+      );
+    EXCEPTION WHEN check_violation THEN
+      -- В requests_default уже есть строки этого месяца, секция не создается
+      RAISE WARNING 'partition for month % overlaps requests_default', i;
+    END;
+  END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+ALTER TABLE requests RENAME TO requests_unpartitioned;
+
+CREATE TABLE requests (
+  request_id        INT GENERATED ALWAYS AS IDENTITY,
+  req_date          TIMESTAMPTZ NOT NULL DEFAULT now(),
+  full_name         TEXT NOT NULL,
+  object_name       TEXT NOT NULL,
+  phone             TEXT NOT NULL,
+  email             TEXT NOT NULL,
+  factory_number    TEXT NOT NULL,
+  device_type       TEXT NOT NULL,
+  emotion           TEXT NOT NULL,
+  question_summary  TEXT NOT NULL,
+  llm_answer        TEXT NOT NULL,
+  task_status       task_statuses DEFAULT 'OPEN',
+  message_id        TEXT NOT NULL,
+  trace_id          TEXT,
+  send_status       TEXT,
+  send_error        TEXT,
+  sent_at           TIMESTAMPTZ,
+  PRIMARY KEY (request_id, req_date)
+) PARTITION BY RANGE (req_date);
+
+-- Письма с датами вне созданных месяцев (старые пересланные, ошибки разбора)
+CREATE TABLE requests_default PARTITION OF requests DEFAULT;
+
+SELECT create_month_partition('requests', month::date)
+FROM generate_series(
+  date_trunc('month', COALESCE((SELECT min(req_date) FROM requests_unpartitioned), now()) AT TIME ZONE 'UTC'),
+  date_trunc('month', now() AT TIME ZONE 'UTC'),
+  interval '1 month'
+) AS month;
+SELECT ensure_request_partitions(3);
+
+INSERT INTO requests (
+  request_id, req_date, full_name, object_name, phone, email, factory_number,
+  device_type, emotion, question_summary, llm_answer, task_status, message_id,
+  trace_id, send_status, send_error, sent_at
+)
+OVERRIDING SYSTEM VALUE
+SELECT
+  request_id, req_date, full_name, object_name, phone, email, factory_number,
+  device_type, emotion, question_summary, llm_answer, task_status, message_id,
+  trace_id, send_status, send_error, sent_at
+FROM requests_unpartitioned;
+
+SELECT setval(
+  pg_get_serial_sequence('requests', 'request_id'),
+  COALESCE((SELECT max(request_id) FROM requests), 0) + 1,
+  false
+);
+
+-- Индексы и триггеры старой таблицы уходят вместе с ней
+DROP TABLE requests_unpartitioned;
+
+CREATE INDEX requests_message_id_idx ON requests (message_id);
+CREATE INDEX requests_device_type_idx ON requests (device_type);
+CREATE INDEX requests_factory_number_idx ON requests (factory_number);
+CREATE INDEX requests_object_name_idx ON requests (object_name);
+CREATE INDEX requests_emotion_idx ON requests (emotion);
+CREATE INDEX requests_task_status_idx ON requests (task_status);
+
+CREATE TRIGGER request_facets_trigger
+  AFTER INSERT OR DELETE OR UPDATE OF device_type, object_name, emotion, task_status
+  ON requests
+  FOR EACH ROW EXECUTE FUNCTION request_facets_sync();
+
+CREATE TRIGGER requests_notify_insert
+  AFTER INSERT ON requests
+  REFERENCING NEW TABLE AS changed_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION requests_notify();
+
+CREATE TRIGGER requests_notify_update
+  AFTER UPDATE ON requests
+  REFERENCING NEW TABLE AS changed_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION requests_notify();
+
+-- Холодный архив: те же колонки, тексты сжимаются lz4 и уходят в TOAST
+-- уже от 128 байт (toast_tuple_target задается на каждой секции)
+CREATE TABLE requests_archive (LIKE requests INCLUDING DEFAULTS)
+  PARTITION BY RANGE (req_date);
+ALTER TABLE requests_archive ADD PRIMARY KEY (request_id, req_date);
+ALTER TABLE requests_archive ALTER COLUMN question_summary SET COMPRESSION lz4;
+ALTER TABLE requests_archive ALTER COLUMN llm_answer SET COMPRESSION lz4;
+
+-- Экспорт с include_archive читает горячие и архивные обращения вместе.
+-- Новые колонки requests нужно добавлять и в requests_archive, и в представление.
+CREATE OR REPLACE VIEW requests_all AS
+  SELECT * FROM requests
+  UNION ALL
+  SELECT * FROM requests_archive;
+
+-- Переносит до p_limit закрытых обращений старше p_cutoff в архив, возвращает число
+CREATE OR REPLACE FUNCTION archive_closed_requests(p_cutoff TIMESTAMPTZ, p_limit INT)
+RETURNS INT AS $$
+DECLARE
+  month_start DATE;
+  moved INT;
+BEGIN
+  FOR month_start IN
+    SELECT DISTINCT date_trunc('month', req_date AT TIME ZONE 'UTC')::date
+    FROM (
+      SELECT req_date FROM requests
+      WHERE req_date < p_cutoff AND task_status = 'CLOSED'
+      ORDER BY req_date
+      LIMIT p_limit
+    ) AS batch
+  LOOP
+    PERFORM create_month_partition('requests_archive', month_start, 'WITH (toast_tuple_target = 128)');
+  END LOOP;
+
+  WITH moved_rows AS (
+    DELETE FROM requests
+    WHERE (request_id, req_date) IN (
+      SELECT request_id, req_date FROM requests
+      WHERE req_date < p_cutoff AND task_status = 'CLOSED'
+      ORDER BY req_date
+      LIMIT p_limit
+    )
+    RETURNING *
+  )
+  INSERT INTO requests_archive SELECT * FROM moved_rows;
+  GET DIAGNOSTICS moved = ROW_COUNT;
+  RETURN moved;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Удаляет опустевшие горячие секции целиком закончившихся до p_cutoff месяцев
+CREATE OR REPLACE FUNCTION drop_empty_request_partitions(p_cutoff TIMESTAMPTZ)
+RETURNS SETOF TEXT AS $$
+DECLARE
+  partition_name TEXT;
+  is_empty BOOLEAN;
+BEGIN
+  FOR partition_name IN
+    SELECT child.relname
+    FROM pg_inherits
+    JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE parent.relname = 'requests' AND child.relname ~ '^requests_\d{4}_\d{2}$'
+  LOOP
+    IF (to_date(substr(partition_name, 10), 'YYYY_MM') + interval '1 month')::timestamp
+       AT TIME ZONE 'UTC' > p_cutoff THEN
+      CONTINUE;
+    END IF;
+    EXECUTE format('SELECT NOT EXISTS (SELECT 1 FROM %I)', partition_name) INTO is_empty;
+    IF is_empty THEN
+      EXECUTE format('DROP TABLE %I', partition_name);
+      RETURN NEXT partition_name;
+    END IF;
+  END LOOP;
+END;
+$$ LANGUAGE plpgsql;
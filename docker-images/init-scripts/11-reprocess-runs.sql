@@ -0,0 +1,17 @@
+-- Прогресс повторной обработки обращений (reprocess.py): запуск продолжается
+-- с last_request_id, упавшие обращения повторяются через --retry-failed.
+CREATE TABLE IF NOT EXISTS reprocess_runs (
+  run_name          TEXT PRIMARY KEY,
+  mode              TEXT NOT NULL,
+  last_request_id   INT NOT NULL DEFAULT 0,
+  processed         BIGINT NOT NULL DEFAULT 0,
+  changed           BIGINT NOT NULL DEFAULT 0,
+  failed            BIGINT NOT NULL DEFAULT 0,
+  failed_ids        INT[] NOT NULL DEFAULT '{}',
+  started_at        TIMESTAMPTZ NOT NULL DEFAULT now(),
+  updated_at        TIMESTAMPTZ NOT NULL DEFAULT now(),
+  finished_at       TIMESTAMPTZ
+);
+
+-- Поиск сохраненного письма обращения, если задачи в letter_jobs уже нет
+CREATE INDEX IF NOT EXISTS mailbox_messages_message_id_idx ON mailbox_messages (message_id);
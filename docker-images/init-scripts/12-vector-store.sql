@@ -0,0 +1,26 @@
+-- Векторные индексы в Postgres для VECTOR_BACKEND=pgvector (vector_pg.py):
+-- vector_rag - фрагменты инструкций, vector_history - письма с готовыми ответами.
+-- Размерность - у EMBEDDING_MODEL (rubert-base-cased-sentence, 768); при смене
+-- модели колонки и индексы пересоздаются, а индексы наполняются заново.
+CREATE EXTENSION IF NOT EXISTS vector;
+
+CREATE TABLE IF NOT EXISTS vector_rag (
+  doc_id      BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+  content     TEXT NOT NULL,
+  metadata    JSONB NOT NULL DEFAULT '{}',
+  message_id  TEXT GENERATED ALWAYS AS (metadata->>'message_id') STORED,
+  embedding   vector(768) NOT NULL,
+  created_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS vector_history (LIKE vector_rag INCLUDING ALL);
+
+-- Эмбеддинги нормированы, поэтому порядок по L2 совпадает с косинусным, а
+-- расстояние переводится в близость так же, как для Chroma (distance_to_similarity)
+CREATE INDEX IF NOT EXISTS vector_rag_embedding_idx
+  ON vector_rag USING hnsw (embedding vector_l2_ops) WITH (m = 16, ef_construction = 64);
+CREATE INDEX IF NOT EXISTS vector_history_embedding_idx
+  ON vector_history USING hnsw (embedding vector_l2_ops) WITH (m = 16, ef_construction = 64);
+
+-- Связь ответа из истории с обращением в requests
+CREATE INDEX IF NOT EXISTS vector_history_message_id_idx ON vector_history (message_id);
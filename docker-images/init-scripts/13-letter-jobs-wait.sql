@@ -0,0 +1,7 @@
+-- Время ожидания писем по приоритетам: от постановки в очередь до первого
+-- взятия в работу. Статистика считается по письмам за последний час.
+ALTER TABLE letter_jobs ADD COLUMN IF NOT EXISTS started_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS letter_jobs_started_at_idx
+  ON letter_jobs (started_at)
+  WHERE started_at IS NOT NULL;
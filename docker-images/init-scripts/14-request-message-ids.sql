@@ -0,0 +1,15 @@
+-- Одно обращение на письмо. Уникальный индекс по message_id на секционированной
+-- requests невозможен (ключ должен включать req_date), поэтому уникальность
+-- держит отдельная таблица, запись в нее - в одной транзакции со вставкой обращения.
+CREATE TABLE IF NOT EXISTS request_message_ids (
+  message_id        TEXT PRIMARY KEY,
+  request_id        INT,
+  created_at        TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+INSERT INTO request_message_ids (message_id, request_id)
+SELECT message_id, min(request_id)
+FROM requests_all
+WHERE message_id <> ''
+GROUP BY message_id
+ON CONFLICT (message_id) DO NOTHING;
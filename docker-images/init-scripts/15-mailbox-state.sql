@@ -0,0 +1,7 @@
+-- UIDVALIDITY ящика, к которому относятся UID в mailbox_messages. При смене
+-- (ящик пересоздан) локальная копия очищается и загружается заново.
+CREATE TABLE IF NOT EXISTS mailbox_state (
+  mailbox           TEXT PRIMARY KEY,
+  uidvalidity       BIGINT,
+  synced_at         TIMESTAMPTZ NOT NULL DEFAULT now()
+);
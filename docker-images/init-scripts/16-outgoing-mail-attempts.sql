@@ -0,0 +1,5 @@
+-- Попытка отправки фиксируется до обращения к SMTP: Message-ID исходящего
+-- письма и время начала. Если после отправки не удалось записать 'sent',
+-- повтор уходит с тем же Message-ID, и его можно распознать как дубликат.
+ALTER TABLE outgoing_mail ADD COLUMN IF NOT EXISTS smtp_message_id TEXT;
+ALTER TABLE outgoing_mail ADD COLUMN IF NOT EXISTS send_started_at TIMESTAMPTZ;
@@ -0,0 +1,28 @@
+-- Счетчики фасетов вне пути записи: построчный триггер обновлял общие строки
+-- request_facets, и параллельные вставки обращений ждали друг друга на них.
+-- Теперь это материализованное представление, его периодически обновляет
+-- scheduler (REFRESH CONCURRENTLY, FACETS_REFRESH_SECONDS).
+DROP TRIGGER IF EXISTS request_facets_trigger ON requests;
+DROP FUNCTION IF EXISTS request_facets_sync();
+DROP FUNCTION IF EXISTS request_facets_bump(TEXT, TEXT, INT);
+DROP TABLE IF EXISTS request_facets;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS request_facets AS
+SELECT facet, value, count FROM (
+  SELECT
+    CASE
+      WHEN GROUPING(device_type) = 0 THEN 'device_type'
+      WHEN GROUPING(object_name) = 0 THEN 'object_name'
+      WHEN GROUPING(emotion) = 0 THEN 'emotion'
+      ELSE 'task_status'
+    END AS facet,
+    COALESCE(device_type, object_name, emotion, task_status::text) AS value,
+    count(*) AS count
+  FROM requests
+  GROUP BY GROUPING SETS ((device_type), (object_name), (emotion), (task_status))
+) AS grouped
+WHERE value IS NOT NULL;
+
+-- Уникальный индекс нужен для REFRESH MATERIALIZED VIEW CONCURRENTLY
+CREATE UNIQUE INDEX IF NOT EXISTS request_facets_facet_value_idx
+  ON request_facets (facet, value);
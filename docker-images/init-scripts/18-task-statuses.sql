@@ -0,0 +1,23 @@
+-- Значения task_statuses в том виде, в каком их отправляет фронтенд:
+-- OPEN, IN_PROGRESS, CLOSED. В прежнем 01-init-tables.sql не хватало запятой,
+-- и в базах, созданных им, вместо 'IN PROGRESS' и 'CLOSED' одно значение
+-- 'IN PROGRESSCLOSED'. Переименование значения enum меняет и все строки с ним.
+DO $$
+DECLARE
+  legacy TEXT;
+BEGIN
+  FOREACH legacy IN ARRAY ARRAY['IN PROGRESS', 'IN PROGRESSCLOSED'] LOOP
+    IF EXISTS (
+      SELECT 1 FROM pg_enum e JOIN pg_type t ON t.oid = e.enumtypid
+      WHERE t.typname = 'task_statuses' AND e.enumlabel = legacy
+    ) AND NOT EXISTS (
+      SELECT 1 FROM pg_enum e JOIN pg_type t ON t.oid = e.enumtypid
+      WHERE t.typname = 'task_statuses' AND e.enumlabel = 'IN_PROGRESS'
+    ) THEN
+      EXECUTE format('ALTER TYPE task_statuses RENAME VALUE %L TO %L', legacy, 'IN_PROGRESS');
+    END IF;
+  END LOOP;
+END $$;
+
+ALTER TYPE task_statuses ADD VALUE IF NOT EXISTS 'IN_PROGRESS';
+ALTER TYPE task_statuses ADD VALUE IF NOT EXISTS 'CLOSED';
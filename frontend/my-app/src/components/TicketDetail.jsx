@@ -2,10 +2,13 @@ import { useState, useEffect } from 'react';
 import './TicketDetail.css';
 
 const API_URL = 'http://localhost:8000/api/sendMail';
+const REQUESTS_URL = 'http://localhost:8000/api/requests';
 
 const STATUS_OPEN = 'OPEN';
 const STATUS_IN_PROGRESS = 'IN_PROGRESS';
 const STATUS_CLOSED = 'CLOSED';
+const SEND_QUEUED = 'queued';
+const SEND_FAILED = 'failed';
 
 const statusLabels = {
   [STATUS_OPEN]: 'Открыто',
@@ -17,9 +20,11 @@ function TicketDetail({ ticket, onClose, onStatusChange }) {
   const [subject, setSubject] = useState('');
   const [body, setBody] = useState('');
   const [sending, setSending] = useState(false);
+  const [regenerating, setRegenerating] = useState(false);
   const [loading, setLoading] = useState(true);
   const [taskStatus, setTaskStatus] = useState(ticket.task_status || STATUS_OPEN);
   const [hasSentAnswer, setHasSentAnswer] = useState(false);
+  const [sendStatus, setSendStatus] = useState(ticket.send_status || null);
 
   useEffect(() => {
     const defaultSubject = `Ответ на обращение: ${ticket.issue.substring(0, 50)}${ticket.issue.length > 50 ? '...' : ''}`;
@@ -27,9 +32,10 @@ function TicketDetail({ ticket, onClose, onStatusChange }) {
     setBody(ticket.llm_answer || '');
     const initialStatus = ticket.task_status || STATUS_OPEN;
     setTaskStatus(initialStatus);
+    setSendStatus(ticket.send_status || null);
     
-    // Если тикет уже закрыт, помечаем что ответ был отправлен
-    if (initialStatus === STATUS_CLOSED) {
+    // Если тикет уже закрыт или ответ ждет отправки, помечаем что ответ был отправлен
+    if (initialStatus === STATUS_CLOSED || ticket.send_status === SEND_QUEUED) {
       setHasSentAnswer(true);
     }
     
@@ -37,7 +43,8 @@ function TicketDetail({ ticket, onClose, onStatusChange }) {
   }, [ticket]);
 
   const isClosed = taskStatus === STATUS_CLOSED;
-  const isReadOnly = isClosed;
+  const isQueued = sendStatus === SEND_QUEUED;
+  const isReadOnly = isClosed || isQueued;
 
   const handleSendMail = async () => {
     if (!subject.trim()) {
@@ -78,14 +85,12 @@ function TicketDetail({ ticket, onClose, onStatusChange }) {
         throw new Error(errorData.detail || `Ошибка HTTP: ${response.status}`);
       }
 
-      // После отправки меняем статус на CLOSED
-      setTaskStatus(STATUS_CLOSED);
+      // Письмо только в очереди: обращение закроет сервер после отправки,
+      // новый статус придет через /api/stream
+      setSendStatus(SEND_QUEUED);
       setHasSentAnswer(true);
-      if (onStatusChange) {
-        onStatusChange(ticket.id, STATUS_CLOSED);
-      }
-      
-      alert('Письмо отправлено');
+
+      alert('Письмо поставлено в очередь на отправку');
       onClose();
     } catch (error) {
       console.error('Ошибка отправки письма:', error);
@@ -95,6 +100,53 @@ function TicketDetail({ ticket, onClose, onStatusChange }) {
     }
   };
 
+  const handleRegenerate = async () => {
+    const previousBody = body;
+    setRegenerating(true);
+    setBody('');
+    try {
+      const response = await fetch(`${REQUESTS_URL}/${ticket.id}/regenerate`, {
+        method: 'POST',
+      });
+      if (!response.ok) {
+        throw new Error(`Ошибка HTTP: ${response.status}`);
+      }
+
+      // Ответ приходит как Server-Sent Events: читаем поток и дописываем токены
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const event of events) {
+          const lines = event.split('\n');
+          const dataLine = lines.find((line) => line.startsWith('data: '));
+          if (!dataLine) continue;
+          const data = JSON.parse(dataLine.slice(6));
+          if (lines.includes('event: error')) {
+            // Сохраненный ответ на сервере не изменился
+            setBody(previousBody);
+            throw new Error(data.detail);
+          }
+          if (data.token) {
+            setBody((prev) => prev + data.token);
+          } else if (data.llm_answer !== undefined) {
+            setBody(data.llm_answer);
+          }
+        }
+      }
+    } catch (error) {
+      console.error('Ошибка генерации ответа:', error);
+      alert(`Ошибка при генерации: ${error.message}`);
+    } finally {
+      setRegenerating(false);
+    }
+  };
+
   const handleClose = () => {
     // Если закрыли без отправки ответа и тикет был в работе, возвращаем в OPEN
     if (!hasSentAnswer && taskStatus === STATUS_IN_PROGRESS) {
@@ -187,12 +239,24 @@ function TicketDetail({ ticket, onClose, onStatusChange }) {
         <div className="mail-section">
           <h3>Ответ на обращение</h3>
 
-          {isReadOnly && (
+          {isClosed && (
             <div className="readonly-notice">
               Обращение закрыто. Изменения недоступны.
             </div>
           )}
 
+          {!isClosed && isQueued && (
+            <div className="readonly-notice">
+              Письмо в очереди на отправку. Обращение закроется после отправки.
+            </div>
+          )}
+
+          {!isClosed && sendStatus === SEND_FAILED && (
+            <div className="readonly-notice">
+              Письмо не удалось отправить. Проверьте адрес и отправьте повторно.
+            </div>
+          )}
+
           <div className="form-group">
             <label htmlFor="subject">Тема письма</label>
             <input
@@ -215,15 +279,22 @@ function TicketDetail({ ticket, onClose, onStatusChange }) {
               placeholder="Текст письма..."
               rows={10}
               className="textarea-field"
-              disabled={sending || isReadOnly}
+              disabled={sending || regenerating || isReadOnly}
             />
           </div>
 
           <div className="action-buttons">
+            <button
+              className="btn-secondary"
+              onClick={handleRegenerate}
+              disabled={sending || regenerating || isReadOnly}
+            >
+              {regenerating ? 'Генерация...' : 'Перегенерировать ответ'}
+            </button>
             <button
               className="btn-send"
               onClick={handleSendMail}
-              disabled={sending || !subject.trim() || !body.trim() || isReadOnly}
+              disabled={sending || regenerating || !subject.trim() || !body.trim() || isReadOnly}
             >
               {sending ? 'Отправка...' : 'Отправить письмо'}
             </button>
@@ -4,8 +4,12 @@ import AddTicketModal from './AddTicketModal';
 import './TicketsTable.css';
 
 const API_URL = 'http://localhost:8000/api/requests';
+const FACETS_URL = 'http://localhost:8000/api/requests/facets';
 const CSV_URL = 'http://localhost:8000/api/getCsv';
 const EXCEL_URL = 'http://localhost:8000/api/getExcel';
+const STREAM_URL = 'http://localhost:8000/api/stream';
+// Таблице не нужны ответ модели и message_id: полная строка грузится при открытии
+const TABLE_FIELDS = 'id,date,fullName,object,phone,email,factoryNumber,deviceType,emotion,issue,task_status,send_status';
 
 const EMOTION_FILTERS = [
   { value: '', label: 'Все эмоции' },
@@ -27,6 +31,16 @@ const statusLabels = {
   'CLOSED': 'Закрыто',
 };
 
+// Ответ в очереди отправки: обращение еще не закрыто
+const ticketStatus = (ticket) => (
+  ticket.send_status === 'queued' && ticket.task_status !== 'CLOSED'
+    ? { className: 'queued', label: 'Отправляется' }
+    : {
+      className: ticket.task_status?.toLowerCase() || 'open',
+      label: statusLabels[ticket.task_status] || 'Открыто',
+    }
+);
+
 function TicketsTable({ onTicketSelect }) {
   const { getAuthHeaders } = useAuth();
   const [tickets, setTickets] = useState([]);
@@ -45,6 +59,7 @@ function TicketsTable({ onTicketSelect }) {
   const [viewMode, setViewMode] = useState('table');
   const [showExportMenu, setShowExportMenu] = useState(false);
   const exportButtonRef = useRef(null);
+  const streamHandlerRef = useRef(null);
 
   const fetchTickets = useCallback(async () => {
     try {
@@ -54,6 +69,7 @@ function TicketsTable({ onTicketSelect }) {
       const params = new URLSearchParams();
       params.set('page', page);
       params.set('limit', limit);
+      params.set('fields', TABLE_FIELDS);
 
       if (searchTerm) {
         params.set('full_name', searchTerm);
@@ -100,10 +116,10 @@ function TicketsTable({ onTicketSelect }) {
   const fetchFilters = useCallback(async () => {
     try {
       const headers = { ...getAuthHeaders() };
-      const response = await fetch(`${API_URL}?page=1&limit=1000`, { headers });
+      const response = await fetch(FACETS_URL, { headers });
       if (response.ok) {
         const data = await response.json();
-        setAvailableDevices([...new Set(data.map((t) => t.deviceType))]);
+        setAvailableDevices(data.device_type.map((facet) => facet.value));
       }
     } catch (err) {
       console.error('Ошибка загрузки фильтров:', err);
@@ -118,6 +134,62 @@ function TicketsTable({ onTicketSelect }) {
     fetchTickets();
   }, [fetchTickets]);
 
+  // Изменения из /api/stream: дочитываем только затронутые обращения
+  const applyChanges = async (op, ids) => {
+    const params = new URLSearchParams(getExportParams());
+    params.set('fields', TABLE_FIELDS);
+    ids.forEach((id) => params.append('ids', id));
+    try {
+      const response = await fetch(`${API_URL}?${params.toString()}`, {
+        headers: { ...getAuthHeaders() },
+      });
+      if (!response.ok) {
+        return;
+      }
+      const changed = await response.json();
+      const changedIds = new Set(ids);
+      const byId = new Map(changed.map((t) => [t.id, t]));
+      setTickets((prev) => {
+        // Строки, переставшие подходить под фильтры, убираем со страницы
+        const next = prev
+          .filter((t) => !changedIds.has(t.id) || byId.has(t.id))
+          .map((t) => byId.get(t.id) || t);
+        if (op === 'insert') {
+          // Сортировка по id: новые обращения попадают в конец, пока страница не заполнена
+          const known = new Set(next.map((t) => t.id));
+          changed
+            .filter((t) => !known.has(t.id))
+            .slice(0, Math.max(limit - next.length, 0))
+            .forEach((t) => next.push(t));
+        }
+        return next;
+      });
+    } catch (err) {
+      console.error('Ошибка обновления обращений:', err);
+    }
+  };
+
+  streamHandlerRef.current = (op, data) => {
+    if (op === 'reset') {
+      fetchTickets();
+      fetchFilters();
+    } else {
+      applyChanges(op, data.ids);
+      if (op === 'insert') {
+        fetchFilters();
+      }
+    }
+  };
+
+  useEffect(() => {
+    const source = new EventSource(STREAM_URL);
+    const listen = (op) => (event) => {
+      streamHandlerRef.current(op, JSON.parse(event.data));
+    };
+    ['insert', 'update', 'reset'].forEach((op) => source.addEventListener(op, listen(op)));
+    return () => source.close();
+  }, []);
+
   const handleAddSuccess = () => {
     setShowAddModal(false);
     fetchTickets();
@@ -339,8 +411,8 @@ function TicketsTable({ onTicketSelect }) {
                     <span className="emotion-badge">{ticket.emotion}</span>
                   </td>
                   <td>
-                    <span className={`status-badge status-${ticket.task_status?.toLowerCase() || 'open'}`}>
-                      {statusLabels[ticket.task_status] || 'Открыто'}
+                    <span className={`status-badge status-${ticketStatus(ticket).className}`}>
+                      {ticketStatus(ticket).label}
                     </span>
                   </td>
                   <td className="issue-cell" title={ticket.issue}>
@@ -361,8 +433,8 @@ function TicketsTable({ onTicketSelect }) {
             >
               <div className="ticket-header">
                 <span className="emotion-badge">{ticket.emotion}</span>
-                <span className={`status-badge status-${ticket.task_status?.toLowerCase() || 'open'}`}>
-                  {statusLabels[ticket.task_status] || 'Открыто'}
+                <span className={`status-badge status-${ticketStatus(ticket).className}`}>
+                  {ticketStatus(ticket).label}
                 </span>
               </div>
               <h3 className="ticket-issue">{ticket.issue}</h3>
@@ -11,21 +11,21 @@ export function AuthProvider({ children }) {
   useEffect(() => {
     const storedUser = localStorage.getItem('user');
     const token = localStorage.getItem('authToken');
-    if (storedUser && token) {
+    const expiresAt = Number(localStorage.getItem('authExpiresAt'));
+    if (storedUser && token && expiresAt > Date.now()) {
       setUser(JSON.parse(storedUser));
     }
     setLoading(false);
   }, []);
 
   const login = async (username, password) => {
-    const credentials = btoa(`${username}:${password}`);
-    
     try {
-      const response = await fetch(`${API_URL}/users/me`, {
-        method: 'GET',
+      const response = await fetch(`${API_URL}/api/login`, {
+        method: 'POST',
         headers: {
-          'Authorization': `Basic ${credentials}`,
+          'Content-Type': 'application/json',
         },
+        body: JSON.stringify({ login: username, password }),
       });
 
       if (!response.ok) {
@@ -33,10 +33,12 @@ export function AuthProvider({ children }) {
         throw new Error(errorData.detail || 'Ошибка аутентификации');
       }
 
-      const userData = await response.json();
+      const data = await response.json();
+      const userData = { username: data.username };
       setUser(userData);
       localStorage.setItem('user', JSON.stringify(userData));
-      localStorage.setItem('authToken', credentials);
+      localStorage.setItem('authToken', data.access_token);
+      localStorage.setItem('authExpiresAt', String(Date.now() + data.expires_in * 1000));
       
       return { success: true };
     } catch (error) {
@@ -49,13 +51,14 @@ export function AuthProvider({ children }) {
     setUser(null);
     localStorage.removeItem('user');
     localStorage.removeItem('authToken');
+    localStorage.removeItem('authExpiresAt');
   };
 
   const getAuthHeaders = () => {
     const token = localStorage.getItem('authToken');
     if (token) {
       return {
-        'Authorization': `Basic ${token}`,
+        'Authorization': `Bearer ${token}`,
       };
     }
     return {};
@@ -1,26 +1,70 @@
 import { useState } from 'react';
+import { useAuth } from '../context/AuthContext';
 import TicketsTable from '../components/TicketsTable';
 import TicketDetail from '../components/TicketDetail';
 import './TicketsPage.css';
 
+const REQUESTS_URL = 'http://localhost:8000/api/requests';
+const BULK_URL = 'http://localhost:8000/api/requests/bulk';
+
 function TicketsPage() {
+  const { getAuthHeaders } = useAuth();
   const [selectedTicket, setSelectedTicket] = useState(null);
   const [tickets, setTickets] = useState([]);
 
-  const handleTicketSelect = (ticket) => {
+  const saveStatus = async (ids, taskStatus) => {
+    try {
+      const response = await fetch(BULK_URL, {
+        method: 'PATCH',
+        headers: {
+          'Content-Type': 'application/json',
+          ...getAuthHeaders(),
+        },
+        body: JSON.stringify({ ids, task_status: taskStatus }),
+      });
+      if (!response.ok) {
+        throw new Error(`Ошибка HTTP: ${response.status}`);
+      }
+    } catch (err) {
+      console.error('Ошибка сохранения статуса:', err);
+    }
+  };
+
+  const fetchFullTicket = async (ticket) => {
+    // В таблице строки без ответа модели, дочитываем обращение целиком
+    try {
+      const response = await fetch(`${REQUESTS_URL}?ids=${ticket.id}`, {
+        headers: { ...getAuthHeaders() },
+      });
+      if (response.ok) {
+        const [full] = await response.json();
+        if (full) {
+          return { ...full, task_status: ticket.task_status };
+        }
+      }
+    } catch (err) {
+      console.error('Ошибка загрузки обращения:', err);
+    }
+    return ticket;
+  };
+
+  const handleTicketSelect = async (ticket) => {
     // При открытии тикета меняем статус на "в работе", если он был "открыт"
     if (ticket.task_status === 'OPEN') {
       ticket.task_status = 'IN_PROGRESS';
+      saveStatus([ticket.id], 'IN_PROGRESS');
     }
-    setSelectedTicket(ticket);
+    setSelectedTicket(await fetchFullTicket(ticket));
   };
 
   const handleStatusChange = (ticketId, newStatus) => {
+    saveStatus([ticketId], newStatus);
+
     // Обновляем статус в списке тикетов
-    setTickets(prev => prev.map(t => 
+    setTickets(prev => prev.map(t =>
       t.id === ticketId ? { ...t, task_status: newStatus } : t
     ));
-    
+
     // Если выбран этот тикет, обновляем и его
     if (selectedTicket && selectedTicket.id === ticketId) {
       setSelectedTicket({ ...selectedTicket, task_status: newStatus });
@@ -31,9 +75,9 @@ function TicketsPage() {
     <div className="tickets-page">
       <TicketsTable onTicketSelect={handleTicketSelect} />
       {selectedTicket && (
-        <TicketDetail 
-          ticket={selectedTicket} 
-          onClose={() => setSelectedTicket(null)} 
+        <TicketDetail
+          ticket={selectedTicket}
+          onClose={() => setSelectedTicket(null)}
           onStatusChange={handleStatusChange}
         />
       )}